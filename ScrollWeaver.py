@@ -12,7 +12,8 @@ from modules.main_performer import Performer
 from modules.user_agent import UserAgent
 from modules.npc_agent import NPCAgent
 from modules.orchestrator import Orchestrator
-from modules.history_manager import HistoryManager
+from modules.history_manager import HistoryManager, HistoryRecord
+from modules.history_summarizer import HistorySummarizer
 from modules.embedding import get_embedding_model
 from modules.time_simulator import TimeSimulator, get_time_simulator
 import argparse
@@ -20,6 +21,10 @@ from datetime import datetime
 
 warnings.filterwarnings('ignore')
 
+# 历史消息分页（重连增量同步）
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+
 class Server():
     def __init__(self,
                  preset_path: str,
@@ -56,6 +61,8 @@ class Server():
         self.script: str = config["script"] if "script" in config else ""
         self.language: str = config["language"] if "language" in config else "zh"
         self.source:str = config["source"] if "source" in config else ""
+        # 向量库后端："chroma"（默认）或 "numpy"（进程内矩阵，适合小集合）
+        self.db_type: str = config["db_type"] if "db_type" in config else "chroma"
         
         # 强制使用Soulverse模式：不再支持传统Performer
         # 所有Agent必须通过add_user_agent()或add_npc_agent()动态添加
@@ -96,6 +103,8 @@ class Server():
             self.world_llm = self.role_llm
         else:
             self.world_llm = get_models(world_llm_name)
+        # 已结束轮次的分层摘要（后台生成），用于限制每回合提示词长度
+        self.history_summarizer = HistorySummarizer(self.history_manager, self.world_llm, language=self.language)
         self.init_orchestrator_from_file(world_file_path = world_file_path,
                                         map_file_path = map_file_path,
                                         loc_file_path = loc_file_path,
@@ -184,6 +193,7 @@ class Server():
                                                   llm = llm,
                                                   embedding_name=self.embedding_name,
                                                   embedding = embedding,
+                                                  db_type=self.db_type,
                                                   language=self.language)
         for role_code in self.performers:
             self.performers[role_code].world_db = self.orchestrator.db
@@ -272,7 +282,7 @@ class Server():
             world_file_path=self.config.get("world_file_path", ""),
             soul_profile=soul_profile,
             language=self.language,
-            db_type="chroma",
+            db_type=self.db_type,
             llm_name=self.role_llm_name,
             llm=self.role_llm,
             embedding_name=self.embedding_name,
@@ -300,6 +310,8 @@ class Server():
         user_agent.history_manager = self.history_manager
         # 保存performers引用，用于格式化历史记录
         user_agent._performers_ref = self.performers
+        # 最近历史之外的内容以摘要形式进入该角色的提示词
+        user_agent._summarizer_ref = self.history_summarizer
         
         # 添加到系统
         self.role_codes.append(role_code)
@@ -348,7 +360,7 @@ class Server():
             preset_config=preset_config,
             preset_id=preset_id,
             language=self.language,
-            db_type="chroma",
+            db_type=self.db_type,
             llm_name=self.role_llm_name,
             llm=self.role_llm,
             embedding_name=self.embedding_name,
@@ -376,6 +388,8 @@ class Server():
         npc_agent.history_manager = self.history_manager
         # 保存performers引用，用于格式化历史记录
         npc_agent._performers_ref = self.performers
+        # 最近历史之外的内容以摘要形式进入该角色的提示词
+        npc_agent._summarizer_ref = self.history_summarizer
         
         # 添加到系统
         self.role_codes.append(role_code)
@@ -493,6 +507,7 @@ class Server():
         # Simulating
         for current_round in range(start_round, rounds):
             self.cur_round = current_round
+            self.history_summarizer.schedule(current_round)
             self.log(f"========== Round {current_round+1} Started ==========")
             if self.event and current_round >= 1:
                 event_text = self._safe_str(self.event)
@@ -711,7 +726,7 @@ class Server():
                                             group = group)
                     self._save_current_simulation("action", current_round, sub_round)
 
-                if_end,epilogue = self.orchestrator.judge_if_ended("\n".join(self.history_manager.get_recent_history(len(self.history_manager)-start_idx)))
+                if_end,epilogue = self.orchestrator.judge_if_ended(self._get_scene_history_text(start_idx))
                 if if_end:
                     record_id = str(uuid.uuid4())
                     epilogue = self._safe_str(epilogue)
@@ -962,7 +977,7 @@ class Server():
             
             if interaction["if_end_interaction"]:
                 break
-            if_end,epilogue = self.orchestrator.judge_if_ended("\n".join(self.history_manager.get_subsequent_history(start_idx)))
+            if_end,epilogue = self.orchestrator.judge_if_ended(self._get_scene_history_text(start_idx))
             if if_end:
                 break
                 
@@ -1058,7 +1073,7 @@ class Server():
                 result = yield from self.start_enviroment_interaction(plan=interaction,role_code=acted_role_code,record_id=record_id)
                 interaction["detail"] = result
                 
-            if_end,epilogue = self.orchestrator.judge_if_ended("\n".join(self.history_manager.get_subsequent_history(start_idx)))
+            if_end,epilogue = self.orchestrator.judge_if_ended(self._get_scene_history_text(start_idx))
             if if_end:
                 break
             acted_role_code,acting_role_code = acting_role_code,acted_role_code
@@ -1166,7 +1181,7 @@ class Server():
             result = self._safe_str(result)
             interaction["detail"] = record_detail + result
             acted_role_code = acting_role_code
-            if_end,epilogue = self.orchestrator.judge_if_ended("\n".join(self.history_manager.get_subsequent_history(start_idx)))
+            if_end,epilogue = self.orchestrator.judge_if_ended(self._get_scene_history_text(start_idx))
             if if_end:
                 break
             
@@ -1280,19 +1295,19 @@ class Server():
         # 获取虚拟时间戳
         virtual_time = self.time_simulator.get_virtual_time() if hasattr(self, 'time_simulator') else datetime.now()
         
-        record = {
-            "cur_round":self.cur_round,
-            "role_code":role_code,
-            "detail":detail,
-            "actor":actor,
-            "group":group,      # visible group
-            "actor_type":actor_type,
-            "act_type":act_type,
-            "other_info":other_info,
-            "record_id":record_id,
-            "virtual_time": virtual_time.strftime("%Y-%m-%d %H:%M:%S"),
-            "virtual_timestamp": virtual_time.timestamp()
-        }
+        # virtual_time 字符串由 HistoryRecord 按需格式化
+        record = HistoryRecord(
+            cur_round=self.cur_round,
+            role_code=role_code,
+            detail=detail,
+            actor=actor,
+            group=group,      # visible group
+            actor_type=actor_type,
+            act_type=act_type,
+            other_info=other_info,
+            record_id=record_id,
+            virtual_timestamp=virtual_time.timestamp()
+        )
         self.history_manager.add_record(record)
         for code in group:
             if code in self.performers:
@@ -1435,6 +1450,13 @@ class Server():
                     return matched
         return roles
     
+    def _get_scene_history_text(self, start_idx: int):
+        """
+        当前场景的完整原始记录（场景长度受子轮次上限约束）。
+        进行中的轮次尚未生成摘要，截断会让 judge_if_ended 看不到场景前半段
+        """
+        return "\n".join(self.history_manager.get_subsequent_history(start_idx))
+
     def log(self,text):
         self.logger.info(text)
         print(text)
@@ -1575,19 +1597,34 @@ class ScrollWeaver():
         else:
             self.selected_scene = str(scene_number)
         
+    def _status_codes(self):
+        if self.selected_scene == None:
+            return self.server.role_codes
+        return self.server.scene_characters[str(self.selected_scene)]
+
+    def _character_location(self, code):
+        location = self.server.performers[code].location_name
+        if code in self.server.moving_roles_info:
+            location_name = self.server.orchestrator.find_location_name(self.server.moving_roles_info[code]["location_code"])
+            distance = self.server.moving_roles_info[code]['distance']
+            location = f"Reaching {location_name}... ({distance})"
+        return location
+
+    @staticmethod
+    def _character_mood(agent):
+        """心情与能量值（没有人格档案的角色返回 None）"""
+        profile = getattr(agent, 'personality_profile', None)
+        dynamic_state = getattr(profile, 'dynamic_state', None)
+        if dynamic_state is None:
+            return None, None
+        return dynamic_state.current_mood, dynamic_state.energy_level
+
     def get_characters_info(self):
         characters_info = []
-        if self.selected_scene == None:
-            codes = self.server.role_codes
-        else:
-            codes = self.server.scene_characters[str(self.selected_scene)]
+        codes = self._status_codes()
         for (i, code) in enumerate(codes):
             agent = self.server.performers[code]
-            location = agent.location_name
-            if code in self.server.moving_roles_info:
-                location_name = self.server.orchestrator.find_location_name(self.server.moving_roles_info[code]["location_code"])
-                distance = self.server.moving_roles_info[code]['distance']
-                location = f"Reaching {location_name}... ({distance})"
+            location = self._character_location(code)
             chara_info = {
                 "id": i,
                 "name": agent.nickname,
@@ -1598,6 +1635,7 @@ class ScrollWeaver():
                 "location": location,
                 "code": code  # 添加role_code用于识别
             }
+            chara_info["mood"], chara_info["energy"] = self._character_mood(agent)
             
             # 标记是否为用户Agent
             if hasattr(agent, 'is_user_agent') and agent.is_user_agent:
@@ -1681,60 +1719,157 @@ class ScrollWeaver():
             'icon': icon_path,
             "uuid": message_id,
             "scene": self.server.cur_round,
-            "role_code": code if message_type == "role" else None  # 添加role_code字段用于前端区分不同用户
+            "role_code": code if message_type == "role" else None,  # 添加role_code字段用于前端区分不同用户
+            "cursor": len(self.server.history_manager)  # 历史游标，重连时用于增量同步
         }
         return message
         
+    def get_memory_stats(self):
+        """各角色记忆的容量、淘汰与合并计数"""
+        stats = {}
+        for code, performer in self.server.performers.items():
+            memory = getattr(performer, 'memory', None)
+            if memory is not None and hasattr(memory, 'stats'):
+                stats[code] = memory.stats()
+        return stats
+
+    def flush_dbs(self):
+        """把世界库与各角色的角色库、记忆库中尚未写入的缓冲落盘"""
+        dbs = [getattr(self.server.orchestrator, 'db', None)]
+        for performer in self.server.performers.values():
+            dbs.append(getattr(performer, 'db', None))
+            dbs.append(getattr(performer, 'world_db', None))
+            dbs.append(getattr(getattr(performer, 'memory', None), 'db', None))
+        flushed = set()
+        for db in dbs:
+            if db is None or id(db) in flushed:
+                continue
+            flushed.add(id(db))
+            try:
+                db.flush()
+            except Exception as e:
+                print(f"Flush error: {e}")
+
     def get_settings_info(self):
         return self.server.orchestrator.world_settings
     
-    def get_current_status(self):
-        status = self.server.current_status
-        status['event'] = self.server.event
+    def _status_group(self):
+        """当前分组的昵称列表（server.current_status['group'] 始终保存角色代码，不能原地改写）"""
         group = []
-        for code in status['group']:
+        for code in self.server.current_status.get('group', []):
             if code in self.server.role_codes:
                 group.append(self.server.performers[code].nickname)
             else:
                 group.append(code)
-        status['group'] = group
+        return group
+
+    def _status_location(self):
         location_code = self.server.current_status['location_code']
         if location_code not in self.server.orchestrator.locations_info:
             location_name,location_description = "Undefined","Undefined"
         else:
             location_name,location_description = self.server.orchestrator.find_location_name(location_code),self.server.orchestrator.locations_info[location_code]["description"]
-        status['location'] = {'name': location_name, 'description': location_description}
+        return {'name': location_name, 'description': location_description}
+
+    def get_status_state(self):
+        """
+        状态中会随模拟变化的部分（分组、地点、事件、每个角色的位置/状态/心情/能量），
+        不含头像、简介等档案信息，用于计算增量
+        """
+        characters = {}
+        for code in self._status_codes():
+            agent = self.server.performers[code]
+            mood, energy = self._character_mood(agent)
+            characters[code] = {
+                "state": agent.status,
+                "location": self._character_location(code),
+                "mood": mood,
+                "energy": energy,
+            }
+        return {
+            'event': self.server.event,
+            'group': self._status_group(),
+            'location': self._status_location(),
+            'characters': characters,
+        }
+
+    def get_current_status(self):
+        status = dict(self.server.current_status)
+        status['event'] = self.server.event
+        status['group'] = self._status_group()
+        status['location'] = self._status_location()
         status['characters'] = self.get_characters_info()
         return status
     
     def handle_message_edit(self,record_id,new_text):
+        self.server.history_summarizer.invalidate(record_id)
         group = self.server.history_manager.modify_record(record_id,new_text)
         for code in group:
             self.server.performers[code].history_manager.modify_record(record_id,new_text)
         return
 
+    def _record_to_message(self, record, timestamp: str, cursor: int):
+        message_type = record["actor_type"]
+        code = record["role_code"]
+        if message_type == "role" and code in self.server.performers:
+            username = self.server.performers[code].role_name
+            icon_path = self.server.performers[code].icon_path
+        else:
+            username = message_type
+            icon_path = "./frontend/assets/images/default-icon.jpg"
+        return {
+            'username': username,
+            'type': message_type, # role, world, system
+            'timestamp': timestamp,
+            'text': record["detail"],
+            'icon': icon_path,
+            "uuid": record["record_id"],
+            "scene": record["cur_round"],
+            "cursor": cursor
+        }
+
     def get_history_messages(self,save_dir):
-        
-        messages = []
-        for record in self.server.history_manager.detailed_history:
-            message_type = record["actor_type"]
-            code = record["role_code"]
-            if message_type == "role" and code in self.server.performers:
-                username = self.server.performers[code].role_name
-                icon_path = self.server.performers[code].icon_path
-            else:
-                username = message_type
-                icon_path = "./frontend/assets/images/default-icon.jpg"
-            messages.append({
-                'username': username,
-                'type': message_type, # role, world, system
-                'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                'text': record["detail"],
-                'icon': icon_path,
-                "uuid": record["record_id"],
-                "scene": record["cur_round"]
-            })
-        return messages
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return [self._record_to_message(record, timestamp, idx + 1)
+                for idx, record in enumerate(self.server.history_manager.detailed_history)]
+
+    def get_history_page(self,
+                         cursor: Optional[int] = None,
+                         record_id: Optional[str] = None,
+                         limit: int = HISTORY_PAGE_SIZE):
+        """
+        按游标分页获取历史消息，供重连客户端增量同步。
+
+        Args:
+            cursor: 客户端已看到的记录数（即下一条记录的下标）。
+            record_id: 客户端最后看到的消息 uuid，优先于 cursor。
+            limit: 每页条数，最大 MAX_HISTORY_PAGE_SIZE。
+            两者都未提供时返回最近一页（初次加载）。
+
+        Returns:
+            {"messages", "start", "cursor", "total", "has_more"}，
+            "cursor" 为下一次请求应携带的游标，"start" > 0 表示更早的记录未发送。
+        """
+        history_manager = self.server.history_manager
+        total = len(history_manager)
+        limit = max(1, min(int(limit or HISTORY_PAGE_SIZE), MAX_HISTORY_PAGE_SIZE))
+        if record_id:
+            idx = history_manager.find_record_index(record_id)
+            # 找不到（例如记录已被清空）时从头同步
+            start = idx + 1 if idx is not None else 0
+        elif cursor is not None:
+            start = max(0, int(cursor))
+        else:
+            start = max(0, total - limit)
+        records, next_cursor = history_manager.get_records_page(start, limit)
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return {
+            "messages": [self._record_to_message(record, timestamp, start + i + 1) for i, record in enumerate(records)],
+            "start": min(start, total),
+            "cursor": next_cursor,
+            "total": total,
+            "has_more": next_cursor < total
+        }
     
     def generate_social_report(self, agent_code: Optional[str] = None, format: str = "text"):
         """
@@ -1,17 +1,42 @@
 # BaseDB.py
 
 from abc import ABC, abstractmethod
+import hashlib
+
+
+def content_id(text):
+    """由文本内容得到确定性的文档ID"""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
 
 class BaseDB(ABC):
     
     @abstractmethod
-    def init_from_data(self, data):
+    def init_from_data(self, data, db_name):
+        pass
+
+    @abstractmethod
+    def search(self, query, n_results, db_name, query_vector=None):
+        """query_vector 为预先计算好的查询向量（可选），提供时不再对 query 编码"""
         pass
 
     @abstractmethod
-    def search(self, query, n_results):
+    def add(self, text, db_name=""):
         pass
 
- 
+    @abstractmethod
+    def delete(self, text, db_name):
+        pass
+
+    def add_batch(self, texts, db_name=""):
+        """批量添加，默认逐条调用 add；返回新增的条数"""
+        return sum(1 for text in texts if text and self.add(text, db_name))
+
+    def search_with_scores(self, query, n_results, db_name, query_vector=None):
+        """返回 [(文档, 相似度), ...]；未实现打分的后端相似度为 None"""
+        return [(doc, None) for doc in self.search(query, n_results, db_name, query_vector=query_vector)]
+
+    def flush(self, db_name=None):
+        """把尚未写入的缓冲落盘（无缓冲的实现可以不重写）"""
+        pass
 
-    
\ No newline at end of file
@@ -1,160 +1,412 @@
 import chromadb
-from .BaseDB import BaseDB
+from .BaseDB import BaseDB, content_id
 import os
 from tqdm import tqdm
-import uuid
+import atexit
+import hashlib
+import threading
+import weakref
+import numpy as np
+
+# 进程退出前把所有实例中尚未写入的缓冲刷入数据库
+_LIVE_DBS = weakref.WeakSet()
+
+
+def _flush_all():
+    for db in list(_LIVE_DBS):
+        try:
+            db.flush()
+        except Exception as e:
+            print(f"Flush error: {str(e)}")
+
+
+atexit.register(_flush_all)
+
+
+MANIFEST_KEY = "manifest"
+# 单次 collection 写入的最大条数（Chroma 对单批大小有上限）
+MAX_WRITE_BATCH = 1024
+# 缓冲中的写入最多停留的秒数，未攒满 batch_size 时也会按时写入
+FLUSH_INTERVAL = 2.0
+
+
+def manifest_fingerprint(ids):
+    """集合数据清单的指纹（与顺序无关）"""
+    digest = hashlib.sha1()
+    for id_ in sorted(ids):
+        digest.update(id_.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class _ClientEntry:
+    """
+    同一 (path, mode) 下所有 ChromaDB 包装共享的客户端、集合句柄、去重哈希与写入缓冲。
+    lock 只保护这些内存结构；集合的读改写由各集合自己的锁串行，向量计算不持有任何锁，
+    一个房间同步大集合时不会阻塞其他房间的检索和记忆写入
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.collections = {}
+        # 写入缓冲：{db_name: {content_id: text}}，在达到 batch_size 或检索/删除前统一写入
+        self.pending = {}
+        # 每个集合中已存在文本的内容哈希，首次写入时从集合加载一次
+        self.hashes = {}
+        self.lock = threading.RLock()
+        self.collection_locks = {}
+        # 每个有缓冲的集合一个定时写入的计时器
+        self.flush_timers = {}
+
+    def collection_lock(self, db_name):
+        with self.lock:
+            if db_name not in self.collection_locks:
+                self.collection_locks[db_name] = threading.Lock()
+            return self.collection_locks[db_name]
+
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_client_entry(path, save_type):
+    """进程级客户端注册表：按 (path, mode) 复用客户端，避免每个 Agent/房间各开一个 SQLite 客户端"""
+    key = (path, save_type)
+    with _CLIENTS_LOCK:
+        if key not in _CLIENTS:
+            if save_type == "persistent":
+                os.makedirs(path, exist_ok=True)
+                client = chromadb.PersistentClient(path=path)
+            else:
+                client = chromadb.Client()
+            _CLIENTS[key] = _ClientEntry(client)
+        return _CLIENTS[key]
+
 
 class ChromaDB(BaseDB):
-    def __init__(self, embedding, save_type="persistent"):
+    def __init__(self, embedding, save_type="persistent", batch_size=32, flush_interval=FLUSH_INTERVAL):
         try:
-            self.collections = {}
             self.embedding = embedding
+            self.batch_size = batch_size
+            self.flush_interval = flush_interval
 
             base_dir = os.path.dirname(os.path.abspath(__file__))
             if save_type == "persistent":
                 self.path = os.path.join(base_dir, "./chromadb_saves/")
-                os.makedirs(self.path, exist_ok=True)
-                self.client = chromadb.PersistentClient(path=self.path)
+                entry = get_client_entry(self.path, "persistent")
             else:
-                self.client = chromadb.Client()
+                entry = get_client_entry(None, "temporary")
+            self.client = entry.client
+            self.collections = entry.collections
+            self._pending = entry.pending
+            self._hashes = entry.hashes
+            self._lock = entry.lock
+            self._entry = entry
+            _LIVE_DBS.add(self)
         except Exception as e:
             raise Exception(f"Failed to initialize ChromaDB: {str(e)}")
 
     def init_from_data(self, data, db_name):
+        """
+        用 data 同步集合：文档ID由内容哈希得到，集合元数据中记录数据清单指纹，
+        指纹一致时直接复用；否则只删除/写入发生变化的行
+        """
         if not db_name:
             raise ValueError("Invalid db_name")
         if not data:
-            collection = self.client.get_collection(
-                    name=db_name,
-                    embedding_function=self.embedding
-                )
-            self.collections[db_name] = collection
+            # 空数据：只打开（或创建）集合，供后续增量写入
+            self._get_collection(db_name)
+            return
         try:
-            new_data_set = set(data)
-            if db_name in [c.name for c in self.client.list_collections()]:
-                collection = self.client.get_collection(
-                    name=db_name,
-                    embedding_function=self.embedding
-                )
-                self.collections[db_name] = collection
-                
-                # 获取现有collection中的所有数据
-                existing_data = collection.get()
-                existing_docs = existing_data['documents']
-                existing_ids = existing_data['ids']
-                
-                # 创建现有文档的映射 {文档内容: ID}
-                existing_doc_map = {doc: id_ for doc, id_ in zip(existing_docs, existing_ids)}
-                
-                # 找出需要删除的文档（在现有数据中但不在新数据中的）
-                docs_to_delete = [id_ for doc, id_ in existing_doc_map.items() 
-                                if doc not in new_data_set]
-                if docs_to_delete:
-                    collection.delete(ids=docs_to_delete)
-                
-                # 找出需要添加的文档（在新数据中但不在现有数据中的）
-                docs_to_add = [doc for doc in new_data_set 
-                            if doc not in existing_doc_map]
-                
-                # 批量添加新文档
-                if docs_to_add:
-                    new_ids = [str(uuid.uuid4()) for _ in range(len(docs_to_add))]
-                    collection.add(
-                        documents=docs_to_add,
-                        ids=new_ids
-                    )
-                    
-            else:
-                collection = self.client.create_collection(
-                    name=db_name,
-                    embedding_function=self.embedding
-                )
-                self.collections[db_name] = collection
-                
-                ids = [str(uuid.uuid4()) for _ in range(len(data))]
-                collection.add(
-                    documents=data,
-                    ids=ids
-                )
-            
+            docs = {content_id(doc): doc for doc in data if doc}
+            fingerprint = manifest_fingerprint(docs)
+            collection = self._get_collection(db_name)
+            if (collection.metadata or {}).get(MANIFEST_KEY) == fingerprint:
+                return
+
+            collection_lock = self._entry.collection_lock(db_name)
+            with collection_lock:
+                # 只取ID；旧版本遗留的 uuid 文档不在新ID集合中，会被替换为内容ID
+                existing_ids = set(collection.get(include=[])['ids'])
+            embedded = {}
+            while True:
+                # 向量在锁外计算；计算期间集合可能被其他房间修改，写入前重新核对
+                ids_to_add = [id_ for id_ in docs if id_ not in existing_ids and id_ not in embedded]
+                for start in tqdm(range(0, len(ids_to_add), self.batch_size),
+                                  desc=f"Syncing {db_name}", disable=len(ids_to_add) <= self.batch_size):
+                    batch = ids_to_add[start:start + self.batch_size]
+                    embedded.update(zip(batch, self._embed([docs[id_] for id_ in batch])))
+                with collection_lock:
+                    if (collection.metadata or {}).get(MANIFEST_KEY) == fingerprint:
+                        with self._lock:
+                            self._hashes[db_name] = set(docs)
+                        break
+                    existing_ids = set(collection.get(include=[])['ids'])
+                    if any(id_ not in existing_ids and id_ not in embedded for id_ in docs):
+                        continue
+                    ids_to_delete = [id_ for id_ in existing_ids if id_ not in docs]
+                    if ids_to_delete:
+                        collection.delete(ids=ids_to_delete)
+                    ids = [id_ for id_ in docs if id_ not in existing_ids]
+                    for start in range(0, len(ids), MAX_WRITE_BATCH):
+                        batch = ids[start:start + MAX_WRITE_BATCH]
+                        self._upsert(collection, batch, [docs[id_] for id_ in batch],
+                                     [embedded[id_] for id_ in batch])
+                    self._set_manifest(collection, fingerprint)
+                    with self._lock:
+                        self._hashes[db_name] = set(docs)
+                    break
+
         except Exception as e:
             raise Exception(f"Failed to initialize data: {str(e)}")
 
+    def _embed(self, documents):
+        """批量计算向量（不持有锁）；未配置 embedding 时由集合自行计算"""
+        if self.embedding is None:
+            return [None] * len(documents)
+        return list(self.embedding(documents))
+
+    @staticmethod
+    def _upsert(collection, ids, documents, embeddings):
+        kwargs = {"ids": ids, "documents": documents}
+        if embeddings and embeddings[0] is not None:
+            kwargs["embeddings"] = embeddings
+        # ID 由内容决定，upsert 使失败后的重试写入保持幂等
+        collection.upsert(**kwargs)
+
+    @staticmethod
+    def _set_manifest(collection, fingerprint):
+        # hnsw:* 参数创建后不可修改，只回写其余元数据
+        metadata = {k: v for k, v in (collection.metadata or {}).items() if not k.startswith("hnsw:")}
+        metadata[MANIFEST_KEY] = fingerprint
+        collection.modify(metadata=metadata)
 
-    def search(self, query, n_results, db_name):
+    def _invalidate_manifest(self, collection):
+        # 集合内容被增量修改后，清单指纹不再代表集合内容
+        if (collection.metadata or {}).get(MANIFEST_KEY):
+            self._set_manifest(collection, "")
+
+    def search(self, query, n_results, db_name, query_vector=None):
         if not query or not db_name or db_name not in self.collections:
             return []
         
         try:
+            self.flush(db_name)
             n_results = min(self.collections[db_name].count(), n_results)
             if n_results < 1:
                 return []
-            results = self.collections[db_name].query(
-                query_texts=[query], 
-                n_results=n_results
-            )
+            if query_vector is not None:
+                results = self.collections[db_name].query(
+                    query_embeddings=[list(query_vector)],
+                    n_results=n_results
+                )
+            else:
+                results = self.collections[db_name].query(
+                    query_texts=[query], 
+                    n_results=n_results
+                )
             return results['documents'][0]
         except Exception as e:
             print(f"Search error: {str(e)}")
             return []
 
-    def check_text_exists(self, text, collection):
-        """检查文本是否已存在于集合中"""
+    def search_with_scores(self, query, n_results, db_name, query_vector=None):
+        """返回 [(文档, 余弦相似度), ...]，按相似度降序"""
+        if not query or not db_name or db_name not in self.collections:
+            return []
         try:
+            self.flush(db_name)
+            collection = self.collections[db_name]
+            n_results = min(collection.count(), n_results)
+            if n_results < 1:
+                return []
+            if query_vector is None:
+                query_vector = self.embedding([query])[0]
             results = collection.query(
-                query_texts=[text],
-                n_results=1
+                query_embeddings=[list(query_vector)],
+                n_results=n_results,
+                include=["documents", "embeddings"]
             )
-            print(results)
-            return bool(results['documents'][0] and results['documents'][0][0] == text)
+            query_vector = np.asarray(query_vector, dtype=np.float32)
+            vectors = np.asarray(results['embeddings'][0], dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector)
+            scores = vectors @ query_vector / np.maximum(norms, 1e-12)
+            pairs = list(zip(results['documents'][0], scores.tolist()))
+            return sorted(pairs, key=lambda pair: pair[1], reverse=True)
+        except Exception as e:
+            print(f"Search error: {str(e)}")
+            return []
+
+    def _get_collection(self, db_name):
+        with self._lock:
+            if db_name not in self.collections:
+                self.collections[db_name] = self.client.get_or_create_collection(
+                    name=db_name,
+                    embedding_function=self.embedding
+                )
+            return self.collections[db_name]
+
+    def _ensure_hashes(self, db_name):
+        """
+        确保 self._hashes 中有该集合已有文本的内容哈希集合（包括旧的 uuid 文档）。
+        首次加载需要扫描集合，在集合锁内、共享锁外进行：其他房间的检索和写入不受影响，
+        而同一集合的写入/删除与扫描串行，扫描结果不会漏掉或残留它们的修改
+        """
+        with self._lock:
+            if db_name in self._hashes:
+                return
+        collection = self._get_collection(db_name)
+        with self._entry.collection_lock(db_name):
+            with self._lock:
+                if db_name in self._hashes:
+                    return
+            if (collection.metadata or {}).get(MANIFEST_KEY):
+                # 带清单的集合中所有ID都是内容ID，无需取回文档
+                hashes = set(collection.get(include=[])['ids'])
+            else:
+                existing = collection.get(include=["documents"])
+                hashes = {content_id(doc) for doc in existing['documents'] if doc}
+            with self._lock:
+                self._hashes.setdefault(db_name, hashes)
+
+    def check_text_exists(self, text, collection):
+        """检查文本是否已存在于集合中"""
+        db_name = collection.name
+        try:
+            self._ensure_hashes(db_name)
         except Exception:
             return False
+        with self._lock:
+            if db_name in self._pending and content_id(text) in self._pending[db_name]:
+                return True
+            return content_id(text) in self._hashes[db_name]
 
     def find_text_id(self, text, collection):
-        """查找与给定文本匹配的ID"""
+        """查找与给定文本匹配的ID（内容ID直接命中，旧版 uuid 文档才回退到扫描）"""
         try:
-            all_data = collection.get()
-            for i, doc in enumerate(all_data['documents']):
+            text_id = content_id(text)
+            if collection.get(ids=[text_id], include=[])['ids']:
+                return text_id
+            results = collection.get(where_document={"$contains": text}, include=["documents"])
+            for doc, id_ in zip(results['documents'], results['ids']):
                 if doc == text:
-                    return all_data['ids'][i]
+                    return id_
             return None
         except Exception:
             return None
 
     def add(self, text, db_name=""):
+        """
+        添加文本：按内容哈希去重，写入先进入缓冲，攒够 batch_size 后
+        以一次 collection.add（预先批量计算好的向量）写入
+        Returns: True 表示新增，False 表示文本已存在
+        """
         if not text:
             raise ValueError("Text cannot be empty")
 
         try:
-            if db_name not in self.collections:
-                self.collections[db_name] = self.client.get_or_create_collection(
-                    name=db_name,
-                    embedding_function=self.embedding
-                )
+            self._ensure_hashes(db_name)
+            with self._lock:
+                text_id = content_id(text)
+                pending = self._pending.setdefault(db_name, {})
+                if text_id in pending or text_id in self._hashes[db_name]:
+                    return False
+                pending[text_id] = text
+                full = len(pending) >= self.batch_size
+                if not full:
+                    self._schedule_flush(db_name)
+            if full:
+                self.flush(db_name)
+            return True
+        except Exception as e:
+            raise Exception(f"Failed to add document: {str(e)}")
 
-            collection = self.collections[db_name]
+    def add_batch(self, texts, db_name=""):
+        """批量添加：去重后一次性编码、写入；返回新增的条数"""
+        try:
+            self._ensure_hashes(db_name)
+            with self._lock:
+                known = self._hashes[db_name]
+                pending = self._pending.setdefault(db_name, {})
+                added = 0
+                for text in texts:
+                    if not text:
+                        continue
+                    text_id = content_id(text)
+                    if text_id in pending or text_id in known:
+                        continue
+                    pending[text_id] = text
+                    added += 1
+            self.flush(db_name)
+            return added
+        except Exception as e:
+            raise Exception(f"Failed to add documents: {str(e)}")
 
-            if not self.check_text_exists(text, collection):
-                new_id = str(uuid.uuid4())
-                collection.add(
-                    documents=[text],
-                    ids=[new_id]
-                )
-                return True  
-            return False  
+    def _schedule_flush(self, db_name):
+        """缓冲中有写入时启动定时写入（调用方持有 self._lock）；已有计时器时不重复启动"""
+        if self.flush_interval is None or db_name in self._entry.flush_timers:
+            return
+        timer = threading.Timer(self.flush_interval, self._timed_flush, args=(db_name,))
+        timer.daemon = True
+        self._entry.flush_timers[db_name] = timer
+        timer.start()
+
+    def _timed_flush(self, db_name):
+        with self._lock:
+            self._entry.flush_timers.pop(db_name, None)
+        try:
+            self.flush(db_name)
         except Exception as e:
-            raise Exception(f"Failed to add document: {str(e)}")
+            print(f"Flush error: {str(e)}")
+
+    def flush(self, db_name=None):
+        """把缓冲中的文本写入集合（db_name 为空时写入全部集合）；向量在锁外计算"""
+        with self._lock:
+            names = [db_name] if db_name else list(self._pending)
+            batches = [(name, self._pending.pop(name, None)) for name in names]
+        for name, pending in batches:
+            if not pending:
+                continue
+            ids = list(pending)
+            documents = list(pending.values())
+            try:
+                embeddings = self._embed(documents)
+                collection = self._get_collection(name)
+                with self._entry.collection_lock(name):
+                    for start in range(0, len(ids), MAX_WRITE_BATCH):
+                        self._upsert(collection, ids[start:start + MAX_WRITE_BATCH],
+                                     documents[start:start + MAX_WRITE_BATCH],
+                                     embeddings[start:start + MAX_WRITE_BATCH])
+                    self._invalidate_manifest(collection)
+                    # 在集合锁内更新哈希，与首次加载的扫描串行
+                    with self._lock:
+                        if name in self._hashes:
+                            self._hashes[name].update(ids)
+            except Exception:
+                # 写入失败时放回缓冲，由计时器稍后重试
+                with self._lock:
+                    self._pending.setdefault(name, {}).update(pending)
+                    self._schedule_flush(name)
+                raise
 
     def delete(self, text, db_name):
         if not text or not db_name or db_name not in self.collections:
             return False
 
         try:
+            with self._lock:
+                pending = self._pending.get(db_name)
+                if pending and pending.pop(content_id(text), None) is not None:
+                    return True
             collection = self.collections[db_name]
             text_id = self.find_text_id(text, collection)
             
             if text_id:
-                collection.delete(ids=[text_id])
+                with self._entry.collection_lock(db_name):
+                    collection.delete(ids=[text_id])
+                    self._invalidate_manifest(collection)
+                    with self._lock:
+                        if db_name in self._hashes:
+                            self._hashes[db_name].discard(content_id(text))
                 return True 
             return False 
         except Exception as e:
@@ -0,0 +1,320 @@
+from .BaseDB import BaseDB, content_id
+import os
+import json
+import atexit
+import threading
+import weakref
+import numpy as np
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# 集合规模超过该值且安装了 faiss 时，用 faiss 的精确内积索引检索
+FAISS_MIN_SIZE = 4096
+
+_LIVE_DBS = weakref.WeakSet()
+
+# persistent 模式下同一目录的集合在进程内共享：多个房间/Agent 用同一 db_name 时读写同一份内存数据，
+# 落盘的是合并后的结果，而不是最后一个实例的内容覆盖其他实例
+_STORES = {}
+_STORES_LOCK = threading.RLock()
+
+
+def _shared_collections(path):
+    with _STORES_LOCK:
+        return _STORES.setdefault(path, {})
+
+
+def _save_all():
+    for db in list(_LIVE_DBS):
+        try:
+            db.flush()
+        except Exception as e:
+            print(f"Save error: {str(e)}")
+
+
+atexit.register(_save_all)
+
+
+class _MatrixCollection:
+    """一个集合：连续的 float32 矩阵（行已 L2 归一化）+ 文档/ID 列表"""
+
+    def __init__(self, dim=0):
+        self.ids = []
+        self.documents = []
+        self.index = {}     # id -> 行号
+        self.matrix = np.zeros((0, dim), dtype=np.float32)
+        self.size = 0
+        self.dirty = False
+        self.version = 0        # 每次修改加一，落盘时跳过比磁盘上更旧的快照
+        self.saved_version = 0
+        self.write_lock = threading.Lock()   # 串行同一集合的磁盘写入（不持有共享锁）
+        self._faiss_index = None
+
+    @property
+    def vectors(self):
+        return self.matrix[:self.size]
+
+    def add(self, ids, documents, vectors):
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        if self.matrix.shape[1] != vectors.shape[1]:
+            self.matrix = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+        needed = self.size + len(ids)
+        if needed > self.matrix.shape[0]:
+            # 按倍数扩容，追加写入保持摊还 O(1)
+            capacity = max(needed, self.matrix.shape[0] * 2, 16)
+            grown = np.zeros((capacity, vectors.shape[1]), dtype=np.float32)
+            grown[:self.size] = self.matrix[:self.size]
+            self.matrix = grown
+        self.matrix[self.size:needed] = vectors
+        for offset, (id_, doc) in enumerate(zip(ids, documents)):
+            self.index[id_] = self.size + offset
+            self.ids.append(id_)
+            self.documents.append(doc)
+        self.size = needed
+        self.dirty = True
+        self.version += 1
+        self._faiss_index = None
+
+    def delete(self, id_):
+        """与最后一行交换后删除，O(1)"""
+        row = self.index.pop(id_, None)
+        if row is None:
+            return False
+        last = self.size - 1
+        if row != last:
+            self.matrix[row] = self.matrix[last]
+            self.ids[row] = self.ids[last]
+            self.documents[row] = self.documents[last]
+            self.index[self.ids[row]] = row
+        self.ids.pop()
+        self.documents.pop()
+        self.size = last
+        self.dirty = True
+        self.version += 1
+        self._faiss_index = None
+        return True
+
+    def _top(self, query_vector, n_results):
+        """返回按相似度降序的 (行号, 余弦相似度)；集合较大且安装了 faiss 时用 faiss 精确索引"""
+        n_results = min(n_results, self.size)
+        if n_results < 1:
+            return []
+        query = _normalize(np.asarray(query_vector, dtype=np.float32).reshape(1, -1))
+        if faiss is not None and self.size >= FAISS_MIN_SIZE:
+            if self._faiss_index is None:
+                self._faiss_index = faiss.IndexFlatIP(self.vectors.shape[1])
+                self._faiss_index.add(np.ascontiguousarray(self.vectors))
+            scores, rows = self._faiss_index.search(query, n_results)
+            return [(int(row), float(score)) for row, score in zip(rows[0], scores[0]) if row >= 0]
+        scores = self.vectors @ query[0]
+        if n_results < self.size:
+            top = np.argpartition(-scores, n_results - 1)[:n_results]
+        else:
+            top = np.arange(self.size)
+        top = top[np.argsort(-scores[top])]
+        return [(int(row), float(scores[row])) for row in top]
+
+    def search(self, query_vector, n_results):
+        return [self.documents[row] for row, _ in self._top(query_vector, n_results)]
+
+    def search_with_scores(self, query_vector, n_results):
+        return [(self.documents[row], score) for row, score in self._top(query_vector, n_results)]
+
+    def snapshot(self):
+        """落盘用的副本（在锁内调用）；没有未保存的修改时返回 None"""
+        if not self.dirty:
+            return None
+        self.dirty = False
+        return self.version, self.vectors.copy(), list(self.ids), list(self.documents)
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class NumpyDB(BaseDB):
+    """
+    进程内向量库：每个集合是一块连续的 float32 矩阵，检索为精确的余弦（归一化后的内积），
+    集合较大且安装了 faiss 时改用 faiss 精确索引；persistent 模式下以 .npy + json 落盘。
+    适合每个 Agent 只有几十到几百条文档的小集合。
+    """
+
+    def __init__(self, embedding, save_type="persistent"):
+        self.collections = {}
+        self.embedding = embedding
+        self.save_type = save_type
+        self._lock = threading.RLock()
+        self.path = None
+        if save_type == "persistent":
+            base_dir = os.path.dirname(os.path.abspath(__file__))
+            self.path = os.path.join(base_dir, "./numpy_saves/")
+            os.makedirs(self.path, exist_ok=True)
+            # 共享的集合由共享的锁保护
+            self.collections = _shared_collections(self.path)
+            self._lock = _STORES_LOCK
+        _LIVE_DBS.add(self)
+
+    def _embed(self, texts):
+        return np.asarray(self.embedding(list(texts)), dtype=np.float32)
+
+    def _collection_dir(self, db_name):
+        return os.path.join(self.path, db_name)
+
+    def _get_collection(self, db_name):
+        """取出集合；首次使用时在锁外读盘，再在锁内安装（并发加载时以先安装的为准）"""
+        with self._lock:
+            collection = self.collections.get(db_name)
+        if collection is not None:
+            return collection
+        loaded = self._load(db_name) or _MatrixCollection()
+        with self._lock:
+            return self.collections.setdefault(db_name, loaded)
+
+    def _load(self, db_name):
+        if self.path is None:
+            return None
+        collection_dir = self._collection_dir(db_name)
+        vectors_path = os.path.join(collection_dir, "vectors.npy")
+        documents_path = os.path.join(collection_dir, "documents.json")
+        if not (os.path.exists(vectors_path) and os.path.exists(documents_path)):
+            return None
+        try:
+            with open(documents_path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            collection = _MatrixCollection()
+            vectors = np.load(vectors_path)
+            if len(stored["ids"]) == len(vectors):
+                collection.add(stored["ids"], stored["documents"], vectors)
+                collection.dirty = False
+            return collection
+        except Exception as e:
+            print(f"Load error: {str(e)}")
+            return None
+
+    def _save(self, db_name, collection):
+        """在锁内取快照，在锁外写入临时文件后原子替换；编码和写盘都不阻塞其他房间的检索"""
+        if self.path is None:
+            return
+        with self._lock:
+            snapshot = collection.snapshot()
+        if snapshot is None:
+            return
+        version, vectors, ids, documents = snapshot
+        with collection.write_lock:
+            # 另一个线程已写入了更新的快照
+            if version <= collection.saved_version:
+                return
+            try:
+                collection_dir = self._collection_dir(db_name)
+                os.makedirs(collection_dir, exist_ok=True)
+                vectors_path = os.path.join(collection_dir, "vectors.npy")
+                documents_path = os.path.join(collection_dir, "documents.json")
+                with open(vectors_path + ".tmp", "wb") as f:
+                    np.save(f, vectors)
+                with open(documents_path + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump({"ids": ids, "documents": documents}, f, ensure_ascii=False)
+                os.replace(vectors_path + ".tmp", vectors_path)
+                os.replace(documents_path + ".tmp", documents_path)
+                collection.saved_version = version
+            except Exception:
+                with self._lock:
+                    collection.dirty = True
+                raise
+
+    def init_from_data(self, data, db_name):
+        if not db_name:
+            raise ValueError("Invalid db_name")
+        docs = {content_id(doc): doc for doc in data if doc}
+        collection = self._get_collection(db_name)
+        with self._lock:
+            for id_ in [id_ for id_ in collection.ids if id_ not in docs]:
+                collection.delete(id_)
+            ids_to_add = [id_ for id_ in docs if id_ not in collection.index]
+        if ids_to_add:
+            # 在锁外编码，再在锁内复查后写入（期间可能已被其他实例写入）
+            vectors = self._embed([docs[id_] for id_ in ids_to_add])
+            with self._lock:
+                keep = [i for i, id_ in enumerate(ids_to_add) if id_ not in collection.index]
+                if keep:
+                    collection.add([ids_to_add[i] for i in keep], [docs[ids_to_add[i]] for i in keep],
+                                   vectors[keep])
+        self._save(db_name, collection)
+
+    def search(self, query, n_results, db_name, query_vector=None):
+        if not query or not db_name or db_name not in self.collections:
+            return []
+        try:
+            with self._lock:
+                collection = self.collections[db_name]
+                if collection.size == 0:
+                    return []
+            if query_vector is None:
+                query_vector = self._embed([query])[0]
+            with self._lock:
+                return collection.search(query_vector, n_results)
+        except Exception as e:
+            print(f"Search error: {str(e)}")
+            return []
+
+    def search_with_scores(self, query, n_results, db_name, query_vector=None):
+        """返回 [(文档, 余弦相似度), ...]，按相似度降序"""
+        if not query or not db_name or db_name not in self.collections:
+            return []
+        try:
+            if query_vector is None:
+                query_vector = self._embed([query])[0]
+            with self._lock:
+                return self.collections[db_name].search_with_scores(query_vector, n_results)
+        except Exception as e:
+            print(f"Search error: {str(e)}")
+            return []
+
+    def add_batch(self, texts, db_name=""):
+        """批量添加：去重后一次性编码写入；返回新增的条数"""
+        collection = self._get_collection(db_name)
+        with self._lock:
+            docs = {}
+            for text in texts:
+                if text and content_id(text) not in collection.index:
+                    docs.setdefault(content_id(text), text)
+        if not docs:
+            return 0
+        vectors = self._embed(list(docs.values()))
+        with self._lock:
+            keep = [i for i, id_ in enumerate(docs) if id_ not in collection.index]
+            ids = list(docs)
+            if keep:
+                collection.add([ids[i] for i in keep], [docs[ids[i]] for i in keep], vectors[keep])
+            return len(keep)
+
+    def add(self, text, db_name=""):
+        if not text:
+            raise ValueError("Text cannot be empty")
+        text_id = content_id(text)
+        collection = self._get_collection(db_name)
+        with self._lock:
+            if text_id in collection.index:
+                return False
+        vector = self._embed([text])
+        with self._lock:
+            if text_id in collection.index:
+                return False
+            collection.add([text_id], [text], vector)
+            return True
+
+    def delete(self, text, db_name):
+        if not text or not db_name or db_name not in self.collections:
+            return False
+        with self._lock:
+            return self.collections[db_name].delete(content_id(text))
+
+    def flush(self, db_name=None):
+        with self._lock:
+            names = [db_name] if db_name else list(self.collections)
+            collections = [(name, self.collections[name]) for name in names if name in self.collections]
+        for name, collection in collections:
+            self._save(name, collection)
@@ -3,23 +3,393 @@ sys.path.append("../")
 from chromadb.api.types import Embeddings, Documents, EmbeddingFunction, Space
 from modelscope import AutoModel, AutoTokenizer
 from functools import partial
-from sw_utils import get_child_folders
+from sw_utils import get_child_folders, load_json_file, PROJECT_CACHE_DIR
 import torch
+import numpy as np
 import os
 import hashlib
-import random
-from typing import Iterable, List
+import queue
+import sqlite3
+import threading
+import time
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Optional
 
 # 全局缓存：避免重复加载相同的embedding模型
 _embedding_model_cache = {}
 
 
+class EmbeddingCache:
+    """
+    向量缓存：键为 (模型命名空间, 文本) 的内容哈希，向量以 float32 数组保存。
+    内存层为按字节数限额的 LRU；磁盘层为 sqlite（float32 二进制），按行数限额，
+    超出时按最近使用时间淘汰最久未用的行，进程重启后仍可命中。
+    _lock 只保护内存层和计数；sqlite 连接由 _disk_lock 串行，磁盘读写不阻塞其他线程的内存命中。
+    """
+
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024, path: Optional[str] = None,
+                 max_disk_rows: int = 200000):
+        self.max_bytes = max_bytes
+        self.max_disk_rows = max_disk_rows
+        self.path = path
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._conn = None
+        self._disk_enabled = path is not None
+        self._disk_writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+
+    @staticmethod
+    def make_key(namespace: str, text: str) -> str:
+        return hashlib.sha1(f"{namespace}\0{text}".encode("utf-8")).hexdigest()
+
+    # --- 磁盘层（调用方持有 _disk_lock） ---
+    def _get_conn(self):
+        if not self._disk_enabled:
+            return None
+        if self._conn is None:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._conn = sqlite3.connect(self.path, check_same_thread=False)
+                self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB)")
+                columns = {row[1] for row in self._conn.execute("PRAGMA table_info(embeddings)")}
+                if "used" not in columns:
+                    # 旧版缓存没有使用时间，视为最久未用
+                    self._conn.execute("ALTER TABLE embeddings ADD COLUMN used REAL DEFAULT 0")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+                self._conn.commit()
+                self._prune()
+            except Exception as e:
+                print(f"[EmbeddingCache] Disk tier disabled: {e}")
+                self._disk_enabled = False
+                self._conn = None
+        return self._conn
+
+    def _prune(self):
+        """行数超过上限时删除最久未用的行，留出 10% 余量，避免每次写入都触发"""
+        rows = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if rows <= self.max_disk_rows:
+            return
+        excess = rows - int(self.max_disk_rows * 0.9)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY used LIMIT ?)", (excess,))
+        self._conn.commit()
+        self.disk_evictions += excess
+
+    def _disk_get(self, keys: List[str]) -> dict:
+        if not keys:
+            return {}
+        found = {}
+        with self._disk_lock:
+            conn = self._get_conn()
+            if conn is None:
+                return {}
+            try:
+                now = time.time()
+                # sqlite 单条语句的参数个数有限，分块查询
+                for start in range(0, len(keys), 500):
+                    chunk = keys[start:start + 500]
+                    placeholders = ','.join('?' * len(chunk))
+                    rows = conn.execute(
+                        f"SELECT key, vec FROM embeddings WHERE key IN ({placeholders})", chunk
+                    ).fetchall()
+                    for key, blob in rows:
+                        found[key] = np.frombuffer(blob, dtype=np.float32).copy()
+                    if rows:
+                        conn.execute(f"UPDATE embeddings SET used = ? WHERE key IN ({placeholders})", [now] + chunk)
+                if found:
+                    conn.commit()
+            except Exception as e:
+                print(f"[EmbeddingCache] Disk read failed: {e}")
+        return found
+
+    def _disk_put(self, items: List[tuple]):
+        if not items:
+            return
+        now = time.time()
+        rows = [(key, vec.tobytes(), now) for key, vec in items]
+        with self._disk_lock:
+            conn = self._get_conn()
+            if conn is None:
+                return
+            try:
+                conn.executemany("INSERT OR REPLACE INTO embeddings (key, vec, used) VALUES (?, ?, ?)", rows)
+                conn.commit()
+                self._disk_writes += len(rows)
+                if self._disk_writes >= max(1, self.max_disk_rows // 10):
+                    self._disk_writes = 0
+                    self._prune()
+            except Exception as e:
+                print(f"[EmbeddingCache] Disk write failed: {e}")
+
+    # --- 内存层 ---
+    def _memory_put(self, key: str, vec: np.ndarray):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._bytes -= old.nbytes
+        self._memory[key] = vec
+        self._bytes += vec.nbytes
+        while self._bytes > self.max_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self.memory_evictions += 1
+
+    def embed(self, namespace: str, texts: List[str],
+              compute: Callable[[List[str]], List[List[float]]]) -> List[np.ndarray]:
+        """返回 texts 的 float32 向量；未命中的文本（去重后）交给 compute 一次性计算"""
+        keys = [self.make_key(namespace, text) for text in texts]
+        results: List[Optional[np.ndarray]] = [None] * len(texts)
+        with self._lock:
+            missing = {}
+            for i, key in enumerate(keys):
+                vec = self._memory.get(key)
+                if vec is not None:
+                    self._memory.move_to_end(key)
+                    results[i] = vec
+                    self.memory_hits += 1
+                else:
+                    missing.setdefault(key, []).append(i)
+
+        # 磁盘层的读写都在内存锁之外进行
+        disk_found = self._disk_get(list(missing))
+        if disk_found:
+            with self._lock:
+                for key, vec in disk_found.items():
+                    self._memory_put(key, vec)
+                    for i in missing.pop(key):
+                        results[i] = vec
+                        self.disk_hits += 1
+
+        if missing:
+            miss_keys = list(missing)
+            # 复制为独立数组：前向结果的行视图会让整批数组常驻内存，使按字节计的限额失真
+            vectors = [np.array(vec, dtype=np.float32).ravel()
+                       for vec in compute([texts[missing[key][0]] for key in miss_keys])]
+            with self._lock:
+                for key, vec in zip(miss_keys, vectors):
+                    self._memory_put(key, vec)
+                    for i in missing[key]:
+                        results[i] = vec
+                    self.misses += len(missing[key])
+            self._disk_put(list(zip(miss_keys, vectors)))
+        return results
+
+    def stats(self) -> dict:
+        total = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / total if total else 0.0,
+            "memory_size": len(self._memory),
+            "memory_bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "memory_evictions": self.memory_evictions,
+            "max_disk_rows": self.max_disk_rows,
+            "disk_evictions": self.disk_evictions,
+        }
+
+    def clear(self, disk: bool = False):
+        with self._lock:
+            self._memory.clear()
+            self._bytes = 0
+        if disk:
+            with self._disk_lock:
+                if self._get_conn() is not None:
+                    self._conn.execute("DELETE FROM embeddings")
+                    self._conn.commit()
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """进程内共享的向量缓存（所有模型、房间共用，按模型命名空间区分），容量取自 config.json"""
+    global _embedding_cache
+    if _embedding_cache is None:
+        with _embedding_cache_lock:
+            if _embedding_cache is None:
+                try:
+                    config = load_json_file('config.json')
+                except Exception:
+                    config = {}
+                _embedding_cache = EmbeddingCache(
+                    max_bytes=int(config.get("embedding_cache_max_mb", 128) * 1024 * 1024),
+                    path=os.path.join(PROJECT_CACHE_DIR, "embedding_cache.sqlite"),
+                    max_disk_rows=config.get("embedding_cache_max_disk_rows", 200000),
+                )
+    return _embedding_cache
+
+
+# 哈希嵌入的版本；哈希函数变化时递增，持久化的回退向量随模型键一同失效
+HASH_EMBED_VERSION = 2
+_FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+_FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def hash_embed_batch(texts: List[str], dim: int = 384, ngram_range=(1, 3)) -> np.ndarray:
+    """
+    模型不可用时的向量化哈希嵌入：字符 n-gram 经带符号的特征哈希投影到 dim 维
+    （等价于稀疏随机投影），L2 归一化后返回 float32 矩阵。
+    所有文本拼接为一个码点数组，每种长度的 n-gram 以逐列 FNV-1a 在整个数组上一次算出哈希，
+    跨越文本边界的窗口被剔除，不再逐个 n-gram 调用 Python 哈希。
+    共享 n-gram 越多的文本相似度越高，中英文均适用，离线检索结果因此有参考意义。
+    """
+    normalized = [" ".join((text or "").lower().split()) for text in texts]
+    matrix = np.zeros(len(texts) * dim, dtype=np.float32)
+    lengths = np.fromiter((len(text) for text in normalized), dtype=np.int64, count=len(normalized))
+    codes = np.frombuffer("".join(normalized).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    owner = np.repeat(np.arange(len(texts), dtype=np.int64), lengths)   # 每个字符所属的文本
+    for n in range(ngram_range[0], ngram_range[1] + 1):
+        count = len(codes) - n + 1
+        if count <= 0:
+            continue
+        # 不同长度的 n-gram 使用不同的初值，避免相互碰撞
+        h = np.full(count, _FNV_OFFSET ^ np.uint64(n), dtype=np.uint64)
+        for k in range(n):
+            h = (h ^ codes[k:k + count]) * _FNV_PRIME
+        h ^= h >> np.uint64(29)
+        valid = owner[:count] == owner[n - 1:n - 1 + count]
+        h = h[valid]
+        cells = owner[:count][valid] * dim + (h % np.uint64(dim)).astype(np.int64)
+        signs = np.where((h >> np.uint64(63)) & np.uint64(1), 1.0, -1.0)
+        matrix += np.bincount(cells, weights=signs, minlength=len(matrix)).astype(np.float32)
+    matrix = matrix.reshape(len(texts), dim)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+# 进程内所有的微批处理器，供统计接口汇总
+_BATCHERS = weakref.WeakSet()
+
+
+class EmbeddingBatcher:
+    """
+    进程内的动态微批处理：各线程提交的请求进入队列，由专用工作线程在很短的
+    时间窗口内合并，按文本长度分桶（减少 padding）后执行前向计算，再把结果
+    分发给各调用方的 Future。同一个模型实例在所有房间/Agent 之间共享。
+    """
+
+    def __init__(self,
+                 forward: Callable[[List[str]], List[List[float]]],
+                 max_batch_size: int = 64,
+                 max_wait_ms: float = 5,
+                 bucket_size: int = 16,
+                 num_threads: Optional[int] = None,
+                 name: str = "embedding"):
+        """
+        Args:
+            forward: 实际执行前向计算的函数（输入一批文本，返回向量列表）
+            max_batch_size: 单次合并的最大文本数
+            max_wait_ms: 收到第一个请求后等待更多请求的时间窗口（毫秒）
+            bucket_size: 按长度排序后每个前向批次的文本数
+            num_threads: 工作线程使用的 torch 线程数（None 表示不修改）
+        """
+        self.forward = forward
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.bucket_size = bucket_size
+        self.num_threads = num_threads
+        self.name = name
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.texts = 0
+        _BATCHERS.add(self)
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=f"embed-{self.name}", daemon=True)
+                    self._thread.start()
+
+    def submit(self, texts: List[str]) -> Future:
+        future: Future = Future()
+        if not texts:
+            future.set_result([])
+            return future
+        self._ensure_started()
+        self._queue.put((list(texts), future))
+        return future
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        # 工作线程内部的重入调用直接计算，避免自己等待自己
+        if threading.current_thread() is self._thread:
+            return self.forward(list(texts))
+        return self.submit(texts).result()
+
+    def _run(self):
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        while True:
+            requests = [self._queue.get()]
+            count = len(requests[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while count < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                requests.append(request)
+                count += len(request[0])
+            self._process(requests)
+
+    def _process(self, requests):
+        try:
+            unique: dict = {}
+            for texts, _ in requests:
+                for text in texts:
+                    unique.setdefault(text, None)
+            # 按长度排序后分桶，同一桶内的文本长度接近，padding 更少
+            ordered = sorted(unique, key=len)
+            for start in range(0, len(ordered), self.bucket_size):
+                bucket = ordered[start:start + self.bucket_size]
+                for text, vec in zip(bucket, self.forward(bucket)):
+                    unique[text] = vec
+            self.batches += 1
+            self.requests += len(requests)
+            self.texts += len(unique)
+            for texts, future in requests:
+                future.set_result([unique[text] for text in texts])
+        except Exception as e:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "texts": self.texts,
+            "avg_requests_per_batch": self.requests / self.batches if self.batches else 0.0,
+            "queue_size": self._queue.qsize(),
+        }
+
+
 class EmbeddingModel(EmbeddingFunction[Documents]):
-    def __init__(self, model_name, language='en'):
+    def __init__(self, model_name, language='en', num_threads=None):
         self.model_name = model_name
         self.language = language
         self.tokenizer = None
         self.model = None
+        self._batcher = None
+        # 向量缓存的命名空间；不同后端的输出略有差异，各自独立缓存
+        self.cache_namespace = model_name
         self._fallback = False
         self._fallback_dim = 384
 
@@ -71,6 +441,7 @@ class EmbeddingModel(EmbeddingFunction[Documents]):
                 print(f"[Embedding] ✓ Successfully downloaded and cached")
             
             print(f"{'='*60}\n")
+            self._batcher = EmbeddingBatcher(self._forward, num_threads=num_threads, name=model_name)
             
         except Exception as exc:
             print(f"[Embedding] ✗ Failed to load '{model_name}': {exc}")
@@ -83,18 +454,22 @@ class EmbeddingModel(EmbeddingFunction[Documents]):
             return self.embed_query(input)
         return self.embed_documents(list(input))
 
-    def embed_documents(self, texts: Iterable[str]) -> List[List[float]]:
+    def embed_documents(self, texts: Iterable[str]) -> List[np.ndarray]:
+        """返回每个文本的 float32 向量（一维数组）"""
         texts = list(texts)
         if self._fallback or self.tokenizer is None or self.model is None:
-            return [self._hash_embed(text) for text in texts]
+            return list(hash_embed_batch(texts, self._fallback_dim))
+        if not texts:
+            return []
+        return get_embedding_cache().embed(self.cache_namespace, texts, self._batcher.embed)
 
+    def _forward(self, texts: List[str]) -> np.ndarray:
         inputs = self.tokenizer(texts, return_tensors="pt", padding=True, truncation=True, max_length=256)
         with torch.no_grad():
             outputs = self.model(**inputs)
-        embeddings = outputs.last_hidden_state[:, 0, :].tolist()
-        return embeddings
+        return outputs.last_hidden_state[:, 0, :].numpy()
 
-    def embed_query(self, text: str = None, **kwargs) -> List[float]:
+    def embed_query(self, text: str = None, **kwargs) -> np.ndarray:
         # Handle case where 'input' keyword argument is passed instead of positional
         if text is None and 'input' in kwargs:
             text = kwargs['input']
@@ -102,13 +477,107 @@ class EmbeddingModel(EmbeddingFunction[Documents]):
             raise ValueError("embed_query requires 'text' or 'input' argument")
         return self.embed_documents([text])[0]
 
-    def _hash_embed(self, text: str) -> List[float]:
-        seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest(), 16)
-        rng = random.Random(seed)
-        return [rng.random() for _ in range(self._fallback_dim)]
+    def _hash_embed(self, text: str) -> np.ndarray:
+        return hash_embed_batch([text], self._fallback_dim)[0]
+
+class OnnxEmbeddingModel(EmbeddingModel):
+    """
+    ONNX Runtime + 动态 int8 量化的 CPU 推理后端。
+    首次使用时由 torch 模型导出并量化，缓存在 model_cache/onnx/ 下；
+    与 torch 输出的一致性校验不通过或 onnxruntime 不可用时退回 torch。
+    """
+
+    PARITY_TEXTS = [
+        "hello world",
+        "今天的天气很好，我们一起去公园散步吧。",
+        "The quick brown fox jumps over the lazy dog near the riverbank at dawn.",
+    ]
+
+    def __init__(self, model_name, language='en', num_threads=None, parity_threshold=0.99):
+        super().__init__(model_name, language=language, num_threads=num_threads)
+        self.backend = "torch"
+        self.session = None
+        if self._fallback:
+            return
+        try:
+            self.session = self._load_session(num_threads)
+            min_similarity = self.check_parity()
+            if min_similarity < parity_threshold:
+                print(f"[Embedding] ✗ ONNX parity check failed for '{model_name}' "
+                      f"(min cosine {min_similarity:.4f} < {parity_threshold}), using torch")
+                self.session = None
+                return
+            print(f"[Embedding] ✓ ONNX int8 backend enabled for '{model_name}' (min cosine {min_similarity:.4f})")
+            self._batcher = EmbeddingBatcher(self._forward_onnx, name=f"{model_name}-onnx")
+            self.cache_namespace = f"{model_name}:onnx-int8"
+            self.backend = "onnx"
+        except Exception as exc:
+            print(f"[Embedding] ✗ ONNX backend unavailable for '{model_name}': {exc}, using torch")
+            self.session = None
+
+    def _onnx_dir(self) -> str:
+        return os.path.join(PROJECT_CACHE_DIR, "onnx", self.model_name.replace("/", "__"))
+
+    def _load_session(self, num_threads=None):
+        import onnxruntime as ort
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        onnx_dir = self._onnx_dir()
+        fp32_path = os.path.join(onnx_dir, "model.onnx")
+        int8_path = os.path.join(onnx_dir, "model.int8.onnx")
+        if not os.path.exists(int8_path):
+            os.makedirs(onnx_dir, exist_ok=True)
+            print(f"[Embedding] Exporting '{self.model_name}' to ONNX...")
+            dummy = self.tokenizer(["hello world"], return_tensors="pt", padding=True)
+            input_names = list(dummy.keys())
+            dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+            dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+            self.model.eval()
+            with torch.no_grad():
+                # 以关键字参数导出，避免 tokenizer 输出顺序与 forward 参数顺序不一致
+                torch.onnx.export(self.model,
+                                  (dict(dummy),),
+                                  fp32_path,
+                                  input_names=input_names,
+                                  output_names=["last_hidden_state"],
+                                  dynamic_axes=dynamic_axes,
+                                  opset_version=14)
+            quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+            print(f"[Embedding] ✓ Quantized ONNX model saved to: {int8_path}")
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return ort.InferenceSession(int8_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+    def _forward_onnx(self, texts: List[str]) -> np.ndarray:
+        inputs = self.tokenizer(texts, return_tensors="np", padding=True, truncation=True, max_length=256)
+        feed = {node.name: inputs[node.name].astype("int64")
+                for node in self.session.get_inputs() if node.name in inputs}
+        last_hidden_state = self.session.run(None, feed)[0]
+        return last_hidden_state[:, 0, :].astype(np.float32)
+
+    def check_parity(self, texts: Optional[List[str]] = None) -> float:
+        """返回 ONNX 与 torch 输出之间最小的余弦相似度"""
+        import numpy as np
+        texts = texts or self.PARITY_TEXTS
+        reference = np.asarray(self._forward(texts), dtype=np.float32)
+        candidate = np.asarray(self._forward_onnx(texts), dtype=np.float32)
+        norms = np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1)
+        similarities = (reference * candidate).sum(axis=1) / np.maximum(norms, 1e-12)
+        return float(similarities.min())
 
 class OpenAIEmbedding(EmbeddingFunction[Documents]):
-    def __init__(self, model_name="text-embedding-ada-002", base_url=None, api_key_field = "OPENAI_API_KEY"):
+    def __init__(self, model_name="text-embedding-ada-002", base_url=None, api_key_field = "OPENAI_API_KEY",
+                 max_batch_size=128, max_concurrency=4, max_retries=3):
+        """
+        Args:
+            max_batch_size: 单次请求携带的最大文本数（接口接受数组输入）
+            max_concurrency: 大列表拆分后并发请求的子批次数
+            max_retries: 每个子批次失败后的重试次数（只重试失败的子批次）
+        """
         from openai import OpenAI
         # allow overriding base URL via OPENAI_API_BASE environment variable (e.g. apiyi mirror)
         env_base = os.getenv('OPENAI_API_BASE', '')
@@ -124,27 +593,81 @@ class OpenAIEmbedding(EmbeddingFunction[Documents]):
 
         self.client = OpenAI(**client_kwargs)
         self.model_name = model_name
+        self.cache_namespace = f"openai:{model_name}"
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
 
     def __call__(self, input):
+        cache = get_embedding_cache()
+        namespace = self.cache_namespace
         if isinstance(input, str):
             input = input.replace("\n", " ")
-            return self.client.embeddings.create(input=[input], model=self.model_name).data[0].embedding
+            return cache.embed(namespace, [input], self._create)[0]
         elif isinstance(input,list):
-            return [self.client.embeddings.create(input=[sentence.replace("\n", " ")], model=self.model_name).data[0].embedding for sentence in input]
+            return cache.embed(namespace, [sentence.replace("\n", " ") for sentence in input], self._create)
+
+    def _create(self, texts: List[str]) -> List[List[float]]:
+        batches = [texts[start:start + self.max_batch_size]
+                   for start in range(0, len(texts), self.max_batch_size)]
+        if len(batches) <= 1:
+            return [vec for batch in batches for vec in self._create_batch(batch)]
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+            results = list(executor.map(self._create_batch, batches))
+        return [vec for batch_result in results for vec in batch_result]
 
-def get_embedding_model(embed_name, language='en'):
+    def _create_batch(self, texts: List[str]) -> List[List[float]]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.client.embeddings.create(input=texts, model=self.model_name)
+                # 按 index 还原顺序，返回条数不符视为失败
+                data = sorted(response.data, key=lambda item: item.index)
+                if len(data) != len(texts):
+                    raise ValueError(f"expected {len(texts)} embeddings, got {len(data)}")
+                return [item.embedding for item in data]
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = 2 ** attempt
+                print(f"[Embedding] OpenAI batch of {len(texts)} failed ({e}), retrying in {delay}s...")
+                time.sleep(delay)
+
+def embedding_stats() -> dict:
+    """向量缓存的命中统计与各模型微批处理器的合并统计"""
+    return {
+        "cache": get_embedding_cache().stats(),
+        "batchers": {batcher.name: batcher.stats() for batcher in list(_BATCHERS)},
+    }
+
+
+def embedding_model_key(embedding_model) -> str:
+    """模型的稳定标识（同一模型、同一推理后端得到同一向量），用于持久化缓存的键"""
+    name = getattr(embedding_model, "cache_namespace", None) or getattr(embedding_model, "model_name", None)
+    name = name or type(embedding_model).__name__
+    if getattr(embedding_model, "_fallback", False):
+        # 模型加载失败时的哈希向量与真实模型的向量不可混用，持久化时必须使用不同的键
+        return f"{name}:hash{getattr(embedding_model, '_fallback_dim', 0)}v{HASH_EMBED_VERSION}"
+    return name
+
+
+def get_embedding_model(embed_name, language='en', backend=None):
     """
     获取embedding模型实例（带缓存机制，避免重复加载）
     
     Args:
         embed_name: 模型名称
         language: 语言设置
+        backend: 本地模型的推理后端，"torch" 或 "onnx"（int8 量化）；
+                 为空时读取环境变量 EMBEDDING_BACKEND，默认 torch
         
     Returns:
-        EmbeddingModel或OpenAIEmbedding实例
+        EmbeddingModel、OnnxEmbeddingModel或OpenAIEmbedding实例
     """
+    backend = (backend or os.environ.get("EMBEDDING_BACKEND", "torch")).lower()
+    local_model_class = OnnxEmbeddingModel if backend == "onnx" else EmbeddingModel
+
     # 创建缓存键
-    cache_key = f"{embed_name}_{language}"
+    cache_key = f"{embed_name}_{language}_{backend}"
     
     # 如果缓存中存在，直接返回缓存的实例
     if cache_key in _embedding_model_cache:
@@ -165,17 +688,20 @@ def get_embedding_model(embed_name, language='en'):
 
     }
     
+    # 嵌入工作线程使用的 torch / onnxruntime 线程数（未设置时沿用默认值）
+    num_threads = int(os.environ.get("EMBEDDING_NUM_THREADS", "0") or 0) or None
+
     # 创建模型实例
     if embed_name in local_model_dict:
         model_name = local_model_dict[embed_name]
-        embedding = EmbeddingModel(model_name, language=language)
+        embedding = local_model_class(model_name, language=language, num_threads=num_threads)
     elif embed_name in online_model_dict:
         model_name = online_model_dict[embed_name]["model_name"]
         api_key_field = online_model_dict[embed_name]["api_key_field"]
         base_url = online_model_dict[embed_name]["url"]
         embedding = OpenAIEmbedding(model_name=model_name, base_url=base_url, api_key_field=api_key_field)
     else:
-        embedding = EmbeddingModel(embed_name, language=language)
+        embedding = local_model_class(embed_name, language=language, num_threads=num_threads)
     
     # 缓存模型实例
     _embedding_model_cache[cache_key] = embedding
@@ -0,0 +1,190 @@
+"""
+内容寻址的向量存储
+键为 hash(embedding 模型, 文本)，向量以 float32 追加写入按维度区分的二进制文件，
+读取时用内存映射（多个 worker 进程共享同一份页缓存），索引为追加写入的文本文件。
+追加不改写已有内容；进程间用文件锁串行化写入。
+"""
+import sys
+sys.path.append("../")
+import os
+import hashlib
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows 下只做进程内加锁
+    fcntl = None
+
+INDEX_FILE = "index.tsv"
+LOCK_FILE = ".lock"
+
+
+def content_key(model_key: str, text: str) -> str:
+    return hashlib.sha1(f"{model_key}\0{text}".encode("utf-8")).hexdigest()
+
+
+class _FileLock:
+    """进程间互斥（fcntl.flock），同时持有进程内的锁"""
+
+    def __init__(self, path: str, thread_lock: threading.RLock):
+        self.path = path
+        self.thread_lock = thread_lock
+        self._file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if fcntl is not None:
+            self._file = open(self.path, "a")
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self.thread_lock.release()
+
+
+class EmbeddingStore:
+    """
+    目录结构：
+        index.tsv          每行 "<键>\\t<维度>\\t<行号>"，只追加
+        vectors_<维度>.f32 连续的 float32 行，只追加
+    索引在第一次读取时加载；未命中时增量读取索引文件的新行（其他进程可能刚写入）。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._index: Optional[Dict[str, Tuple[int, int]]] = None
+        self._index_offset = 0
+        self._maps: Dict[int, np.ndarray] = {}
+
+    def _vectors_path(self, dim: int) -> str:
+        return os.path.join(self.path, f"vectors_{dim}.f32")
+
+    # --- 索引 ---
+    def _refresh_index(self):
+        """读取索引文件中上次读取位置之后的新行"""
+        if self._index is None:
+            self._index = {}
+            self._index_offset = 0
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, "rb") as f:
+            f.seek(self._index_offset)
+            data = f.read()
+        # 只处理完整的行，写了一半的行留到下次
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode("utf-8").splitlines():
+            parts = line.split("\t")
+            if len(parts) == 3:
+                self._index[parts[0]] = (int(parts[1]), int(parts[2]))
+        self._index_offset += end
+
+    def _ensure_index(self):
+        if self._index is None:
+            self._refresh_index()
+
+    def __len__(self):
+        with self._lock:
+            self._ensure_index()
+            return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    # --- 读取 ---
+    def _vectors(self, dim: int, row: int) -> Optional[np.ndarray]:
+        """返回覆盖到 row 的内存映射；文件已增长时重新映射"""
+        mapped = self._maps.get(dim)
+        if mapped is not None and row < len(mapped):
+            return mapped
+        vectors_path = self._vectors_path(dim)
+        if not os.path.exists(vectors_path):
+            return None
+        rows = os.path.getsize(vectors_path) // (dim * 4)
+        if row >= rows:
+            return None
+        mapped = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(rows, dim))
+        self._maps[dim] = mapped
+        return mapped
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """返回只读的向量（内存映射中的一行），不存在时返回 None"""
+        with self._lock:
+            self._ensure_index()
+            entry = self._index.get(key)
+            if entry is None:
+                self._refresh_index()
+                entry = self._index.get(key)
+                if entry is None:
+                    return None
+            dim, row = entry
+            mapped = self._vectors(dim, row)
+            return None if mapped is None else mapped[row]
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, np.ndarray]:
+        result = {}
+        for key in keys:
+            vector = self.get(key)
+            if vector is not None:
+                result[key] = vector
+        return result
+
+    # --- 写入 ---
+    def put_many(self, items: Dict[str, Iterable[float]]) -> int:
+        """追加写入尚不存在的键；返回新写入的条数"""
+        if not items:
+            return 0
+        os.makedirs(self.path, exist_ok=True)
+        with _FileLock(os.path.join(self.path, LOCK_FILE), self._lock):
+            self._refresh_index()
+            by_dim: Dict[int, List[tuple]] = {}
+            for key, vector in items.items():
+                if key in self._index:
+                    continue
+                vector = np.asarray(vector, dtype=np.float32).ravel()
+                by_dim.setdefault(vector.shape[0], []).append((key, vector))
+            lines = []
+            for dim, entries in by_dim.items():
+                vectors_path = self._vectors_path(dim)
+                with open(vectors_path, "ab") as f:
+                    # 截掉崩溃时可能残留的半行，保证行号与偏移一致
+                    size = f.seek(0, os.SEEK_END)
+                    start = size // (dim * 4)
+                    if size != start * dim * 4:
+                        f.truncate(start * dim * 4)
+                    f.write(np.vstack([vector for _, vector in entries]).tobytes())
+                for offset, (key, _) in enumerate(entries):
+                    lines.append(f"{key}\t{dim}\t{start + offset}\n")
+            if not lines:
+                return 0
+            # 先写向量、再写索引，索引中的行号总是已落盘的
+            with open(os.path.join(self.path, INDEX_FILE), "a", encoding="utf-8") as f:
+                f.writelines(lines)
+            self._refresh_index()
+            return len(lines)
+
+    def put(self, key: str, vector: Iterable[float]) -> bool:
+        return self.put_many({key: vector}) > 0
+
+    def embed(self, model_key: str, texts: List[str], embedding_model) -> List[np.ndarray]:
+        """按 (模型, 文本) 读取向量，缺失的批量编码后追加写入"""
+        keys = [content_key(model_key, text) for text in texts]
+        found = self.get_many(set(keys))
+        missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in found))
+        if missing:
+            vectors = embedding_model(missing)
+            new_items = {content_key(model_key, text): vector for text, vector in zip(missing, vectors)}
+            self.put_many(new_items)
+            for key, vector in new_items.items():
+                found[key] = self.get(key)
+                if found[key] is None:
+                    found[key] = np.asarray(vector, dtype=np.float32)
+        return [found[key] for key in keys]
@@ -3,11 +3,140 @@ from collections import defaultdict
 from datetime import datetime
 from sw_utils import load_json_file, save_json_file, load_jsonl_file, save_jsonl_file
 import os
+import sys
+
+
+class HistoryRecord:
+    """
+    紧凑的历史记录（__slots__），替代原先的11键字典。
+    role_code/act_type/actor_type/actor 经过 intern，virtual_time 由 virtual_timestamp 惰性格式化；
+    同时保留 record["key"] / record.get() / "key" in record 等字典式访问，兼容报告模块。
+    """
+    FIELDS = ("cur_round", "role_code", "detail", "actor", "group", "actor_type",
+              "act_type", "other_info", "record_id", "virtual_time", "virtual_timestamp")
+    _INTERNED = ("role_code", "act_type", "actor_type", "actor")
+    __slots__ = ("cur_round", "role_code", "detail", "actor", "group", "actor_type",
+                 "act_type", "other_info", "record_id", "virtual_timestamp",
+                 "_virtual_time", "_extra")
+
+    def __init__(self,
+                 cur_round: int = 0,
+                 role_code: str = "",
+                 detail: str = "",
+                 actor: str = "",
+                 group: Optional[List[str]] = None,
+                 actor_type: str = "",
+                 act_type: str = "",
+                 other_info: str = "",
+                 record_id: Optional[str] = None,
+                 virtual_timestamp: Optional[float] = None,
+                 virtual_time: Optional[str] = None,
+                 **extra):
+        self.cur_round = cur_round
+        self.role_code = _intern(role_code)
+        self.detail = detail
+        self.actor = _intern(actor)
+        self.group = group if group is not None else []
+        self.actor_type = _intern(actor_type)
+        self.act_type = _intern(act_type)
+        self.other_info = other_info
+        self.record_id = record_id
+        self.virtual_timestamp = virtual_timestamp
+        self._virtual_time = virtual_time
+        self._extra = extra or None
+
+    @property
+    def virtual_time(self) -> str:
+        if self._virtual_time is None and self.virtual_timestamp is not None:
+            self._virtual_time = datetime.fromtimestamp(self.virtual_timestamp).strftime("%Y-%m-%d %H:%M:%S")
+        return self._virtual_time or ""
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "HistoryRecord":
+        if isinstance(data, cls):
+            return data
+        data = dict(data)
+        # 兼容旧格式中的 "type" 键
+        if "act_type" not in data and "type" in data:
+            data["act_type"] = data.pop("type")
+        return cls(**data)
+
+    def to_dict(self) -> Dict[str, Any]:
+        result = {key: self[key] for key in self.FIELDS}
+        if self._extra:
+            result.update(self._extra)
+        return result
+
+    # --- 字典式访问 ---
+    def __getitem__(self, key: str):
+        if key in self.FIELDS:
+            return getattr(self, key)
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        if key == "virtual_time":
+            self._virtual_time = value
+        elif key == "virtual_timestamp":
+            self.virtual_timestamp = value
+            self._virtual_time = None
+        elif key in self.FIELDS:
+            setattr(self, key, _intern(value) if key in self._INTERNED else value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key) -> bool:
+        # 旧存档里没有时间戳的记录，保持 "virtual_timestamp" in record 为 False
+        if key in ("virtual_time", "virtual_timestamp") and self.virtual_timestamp is None:
+            return self._virtual_time is not None and key == "virtual_time"
+        return key in self.FIELDS or bool(self._extra and key in self._extra)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self.FIELDS) + (list(self._extra) if self._extra else [])
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (HistoryRecord, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return f"HistoryRecord({self.to_dict()!r})"
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        HistoryRecord.__init__(self, **state)
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
 
 
 class HistoryManager:
     def __init__(self):
-        self.detailed_history = []
+        self.detailed_history: List[HistoryRecord] = []
 
     def add_record(self, record):
         """添加一个事件记录
@@ -22,7 +151,10 @@ class HistoryManager:
             "other_info":other_info,
             "record_id":record_id
         }
+        字典会被转换为 HistoryRecord；已是 HistoryRecord 的记录直接共享，不做拷贝
         """
+        if not isinstance(record, HistoryRecord):
+            record = HistoryRecord.from_dict(record)
         self.detailed_history.append(record)
 
     def modify_record(self, record_id: str, detail: str):
@@ -70,6 +202,19 @@ class HistoryManager:
         else:
             return [record["detail"] for record in self.detailed_history[-recent_k:]]
     
+    def find_record_index(self, record_id: str) -> Optional[int]:
+        """按 record_id 查找记录下标（从尾部开始，重连客户端的游标通常在末尾附近）"""
+        for idx in range(len(self.detailed_history) - 1, -1, -1):
+            if self.detailed_history[idx]["record_id"] == record_id:
+                return idx
+        return None
+
+    def get_records_page(self, start_idx: int, limit: int):
+        """返回 [start_idx, start_idx+limit) 范围内的记录以及下一页游标"""
+        start_idx = max(0, min(start_idx, len(self.detailed_history)))
+        end_idx = min(len(self.detailed_history), start_idx + limit)
+        return self.detailed_history[start_idx:end_idx], end_idx
+
     def get_subsequent_history(self,start_idx):
         return [record["detail"] for record in self.detailed_history[start_idx:]]
     
@@ -82,10 +227,13 @@ class HistoryManager:
     def __getstate__(self):
         states = {key: value for key, value in self.__dict__.items() \
             if isinstance(value, (str, int, list, dict, bool, type(None)))}
+        states["detailed_history"] = [record.to_dict() if isinstance(record, HistoryRecord) else record
+                                      for record in self.detailed_history]
         return states
 
     def __setstate__(self, states):
         self.__dict__.update(states)
+        self.detailed_history = [HistoryRecord.from_dict(record) for record in self.detailed_history]
 
     def save_to_file(self, root_dir):
         filename = os.path.join(root_dir, f"./simulation_history.json")
@@ -0,0 +1,224 @@
+"""
+历史分层滚动摘要
+将已结束的轮次压缩为轮摘要，再将同一虚拟日的轮摘要合并为日摘要，
+使每回合的提示词只携带固定长度的摘要和一小段原始记录尾部。
+"""
+import sys
+sys.path.append("../")
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# 摘要在后台线程中生成，不阻塞回合的关键路径
+_SUMMARY_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
+
+PLACEHOLDER_TEXT = "__USER_INPUT_PLACEHOLDER__"
+
+
+def make_memory_summarizer(llm, language: str = "zh", max_words: int = 80):
+    """记忆合并用的摘要函数 List[str] -> str（与轮摘要使用同一提示词）"""
+    if language == "zh":
+        from modules.prompt.orchestrator_prompt_zh import ROUND_SUMMARY_PROMPT
+    else:
+        from modules.prompt.orchestrator_prompt_en import ROUND_SUMMARY_PROMPT
+
+    def summarize(texts: List[str]) -> str:
+        prompt = ROUND_SUMMARY_PROMPT.format(**{
+            "history": "\n".join(texts),
+            "max_words": max_words
+        })
+        return llm.chat(prompt).strip()
+
+    return summarize
+
+
+class HistorySummarizer:
+    """历史摘要器（轮摘要 -> 日摘要），结果缓存，编辑记录时失效"""
+
+    def __init__(self,
+                 history_manager,
+                 llm,
+                 language: str = "zh",
+                 tail_size: int = 5,
+                 max_days: int = 3,
+                 max_rounds: int = 5,
+                 max_chars: int = 1200,
+                 round_max_words: int = 80,
+                 day_max_words: int = 150):
+        """
+        Args:
+            history_manager: 需要摘要的 HistoryManager
+            llm: 用于生成摘要的模型
+            language: 语言设置
+            tail_size: 提示词中保留的原始记录条数
+            max_days: 摘要中最多携带的日摘要数
+            max_rounds: 摘要中最多携带的（尚未并入日摘要的）轮摘要数
+            max_chars: 摘要文本的最大长度
+        """
+        self.history_manager = history_manager
+        self.llm = llm
+        self.language = language
+        self.tail_size = tail_size
+        self.max_days = max_days
+        self.max_rounds = max_rounds
+        self.max_chars = max_chars
+        self.round_max_words = round_max_words
+        self.day_max_words = day_max_words
+
+        self.round_summaries: Dict[int, str] = {}
+        self.round_days: Dict[int, str] = {}   # 轮次 -> 虚拟日期（YYYY-MM-DD）
+        self.day_summaries: Dict[str, str] = {}
+        self._versions: Dict[int, int] = {}    # 轮次版本号，用于丢弃失效后才完成的摘要
+        self._lock = threading.Lock()
+        self._pending = None
+        self._last_len = 0
+
+        if language == "zh":
+            from modules.prompt.orchestrator_prompt_zh import ROUND_SUMMARY_PROMPT, DAY_SUMMARY_PROMPT
+        else:
+            from modules.prompt.orchestrator_prompt_en import ROUND_SUMMARY_PROMPT, DAY_SUMMARY_PROMPT
+        self._ROUND_SUMMARY_PROMPT = ROUND_SUMMARY_PROMPT
+        self._DAY_SUMMARY_PROMPT = DAY_SUMMARY_PROMPT
+
+    # --- 调度 ---
+    def schedule(self, current_round: int):
+        """在后台摘要 current_round 之前的所有已结束轮次（已有任务在运行时跳过）"""
+        self._check_reset()
+        if self._pending is not None and not self._pending.done():
+            return
+        self._pending = _SUMMARY_EXECUTOR.submit(self._safe_update, current_round)
+
+    def _safe_update(self, current_round: int):
+        try:
+            self.update(current_round)
+        except Exception as e:
+            print(f"[HistorySummarizer] Summarization failed: {e}")
+
+    def update(self, current_round: int):
+        """同步地补齐缺失的轮摘要和已结束日期的日摘要"""
+        rounds = self._group_closed_rounds(current_round)
+        for round_idx, (day, lines) in rounds.items():
+            with self._lock:
+                if round_idx in self.round_summaries:
+                    continue
+                version = self._versions.get(round_idx, 0)
+            summary = self._summarize_round(lines)
+            with self._lock:
+                if self._versions.get(round_idx, 0) != version:
+                    continue
+                self.round_summaries[round_idx] = summary
+                self.round_days[round_idx] = day
+
+        with self._lock:
+            days = sorted(set(self.round_days.values()))
+        # 最后一天可能仍在进行中，只合并已经结束的日期
+        for day in days[:-1]:
+            with self._lock:
+                if day in self.day_summaries:
+                    continue
+                day_rounds = sorted(r for r, d in self.round_days.items() if d == day)
+                versions = {r: self._versions.get(r, 0) for r in day_rounds}
+                summaries = [self.round_summaries[r] for r in day_rounds]
+            summary = self._summarize_day(day, summaries)
+            with self._lock:
+                if any(self._versions.get(r, 0) != v for r, v in versions.items()):
+                    continue
+                self.day_summaries[day] = summary
+
+    def _group_closed_rounds(self, current_round: int):
+        rounds: Dict[int, tuple] = {}
+        seen = set()
+        for record in list(self.history_manager.detailed_history):
+            # Agent 共享同一个 history_manager，同一条记录可能被追加多次
+            if id(record) in seen:
+                continue
+            seen.add(id(record))
+            round_idx = record.get("cur_round", 0)
+            if round_idx >= current_round:
+                continue
+            detail = record.get("detail", "")
+            if not detail or detail == PLACEHOLDER_TEXT:
+                continue
+            if round_idx not in rounds:
+                rounds[round_idx] = (self._record_day(record), [])
+            rounds[round_idx][1].append(detail)
+        return rounds
+
+    @staticmethod
+    def _record_day(record) -> str:
+        timestamp = record.get("virtual_timestamp")
+        if timestamp is None:
+            return ""
+        return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+
+    def _summarize_round(self, lines: List[str]) -> str:
+        prompt = self._ROUND_SUMMARY_PROMPT.format(**{
+            "history": "\n".join(lines),
+            "max_words": self.round_max_words
+        })
+        return self.llm.chat(prompt).strip()
+
+    def _summarize_day(self, day: str, summaries: List[str]) -> str:
+        prompt = self._DAY_SUMMARY_PROMPT.format(**{
+            "day": day,
+            "summaries": "\n".join(summaries),
+            "max_words": self.day_max_words
+        })
+        return self.llm.chat(prompt).strip()
+
+    # --- 失效 ---
+    def invalidate(self, record_id: str):
+        """记录被编辑后，丢弃其所在轮次以及所在日期的摘要"""
+        idx = self.history_manager.find_record_index(record_id)
+        if idx is None:
+            return
+        round_idx = self.history_manager.detailed_history[idx].get("cur_round", 0)
+        with self._lock:
+            self._versions[round_idx] = self._versions.get(round_idx, 0) + 1
+            self.round_summaries.pop(round_idx, None)
+            day = self.round_days.pop(round_idx, None)
+            if day is not None:
+                self.day_summaries.pop(day, None)
+
+    def reset(self):
+        with self._lock:
+            self.round_summaries = {}
+            self.round_days = {}
+            self.day_summaries = {}
+            self._versions = {}
+            self._last_len = 0
+
+    def _check_reset(self):
+        # 历史被外部清空（重置沙盒/清空聊天）时同步清空缓存
+        current_len = len(self.history_manager)
+        if current_len < self._last_len:
+            self.reset()
+        self._last_len = current_len
+
+    # --- 读取 ---
+    def get_summary_text(self) -> str:
+        """返回固定长度上限的摘要文本（较早的日摘要 + 最近的轮摘要）"""
+        self._check_reset()
+        with self._lock:
+            days = sorted(self.day_summaries)[-self.max_days:]
+            parts = [f"[{day}] {self.day_summaries[day]}" for day in days]
+            loose_rounds = sorted(r for r in self.round_summaries
+                                  if self.round_days.get(r) not in self.day_summaries)
+            parts += [self.round_summaries[r] for r in loose_rounds[-self.max_rounds:]]
+        text = "\n".join(parts)
+        if len(text) > self.max_chars:
+            # 优先保留最新的内容
+            text = text[-self.max_chars:]
+        return text
+
+    def build_context(self, tail_lines: Optional[List[str]] = None) -> str:
+        """摘要 + 原始记录尾部"""
+        if tail_lines is None:
+            tail_lines = self.history_manager.get_recent_history(self.tail_size)
+        summary = self.get_summary_text()
+        if not summary:
+            return "\n".join(tail_lines)
+        header = "【前情摘要】" if self.language == "zh" else "[Earlier Summary]"
+        recent = "【最近记录】" if self.language == "zh" else "[Recent Log]"
+        return f"{header}\n{summary}\n{recent}\n" + "\n".join(tail_lines)
@@ -5,11 +5,13 @@ import os
 from typing import Any, Dict, List, Optional, Literal
 from modules.embedding import get_embedding_model
 from modules.memory import build_performer_memory
+from modules.history_summarizer import make_memory_summarizer
 from modules.history_manager import HistoryManager
 from modules.personality_model import PersonalityProfile
 from modules.dual_process_agent import DualProcessAgent
 from modules.dynamic_state_manager import DynamicStateManager
 from modules.style_vector_db import StyleVectorDB
+from modules.retrieval_planner import RetrievalPlanner, RetrievalBundle
 from sw_utils import *
 import random
 import warnings
@@ -51,6 +53,8 @@ class Performer:
         if llm == None:
             llm = get_models(llm_name)
         self.llm = llm
+        # 加入房间时由 Server 注入的 HistorySummarizer，retrieve_history 用它携带更早历史的摘要
+        self._summarizer_ref = None
         
         if embedding is None:
             embedding = get_embedding_model(embedding_name, language=self.language)
@@ -80,8 +84,10 @@ class Performer:
                                                   embedding_name=embedding_name,
                                                   embedding=embedding,
                                                   db_name=self.db_name.replace("role","memory"),
+                                                  db_type=db_type,
                                                   language=self.language,
-                                                  type="naive")
+                                                  summarize_fn=make_memory_summarizer(self.llm, self.language),
+                                                  type="ga")
             self._memory_initialized = True
         else:
             # 延迟初始化
@@ -225,8 +231,9 @@ class Performer:
              world_description: str, 
              intervention: str = ""):
         action_history_text = self.retrieve_history(query = "", retrieve=False)
-        references = self.retrieve_references(query = action_history_text)
-        knowledges = self.retrieve_knowledges(query = action_history_text)
+        bundle = self.retrieve_bundle(references_query = action_history_text,
+                                      knowledges_query = action_history_text)
+        references, knowledges = bundle.references, bundle.knowledges
         
         if len(other_roles_info) == 1:
             other_roles_info_text = "没有人在这里。你不能进行涉及角色的互动。" if self.language == "zh" else "No one else is here. You can not interact with roles."
@@ -287,8 +294,9 @@ class Performer:
              temperature: float = 0.8):
         """带风格提示和温度参数的plan方法"""
         action_history_text = self.retrieve_history(query = "", retrieve=False)
-        references = self.retrieve_references(query = action_history_text)
-        knowledges = self.retrieve_knowledges(query = action_history_text)
+        bundle = self.retrieve_bundle(references_query = action_history_text,
+                                      knowledges_query = action_history_text)
+        references, knowledges = bundle.references, bundle.knowledges
         
         if len(other_roles_info) == 1:
             other_roles_info_text = "没有人在这里。你不能进行涉及角色的互动。" if self.language == "zh" else "No one else is here. You can not interact with roles."
@@ -363,8 +371,9 @@ class Performer:
                      history:str,
                      intervention:str = ""
                      ):
-        references = self.retrieve_references(npc_response)
-        knowledges = self.retrieve_knowledges(query = npc_response)
+        bundle = self.retrieve_bundle(references_query = npc_response,
+                                      knowledges_query = npc_response)
+        references, knowledges = bundle.references, bundle.knowledges
         
         if intervention:
             intervention = self._INTERVENTION_PROMPT.format(**
@@ -400,7 +409,6 @@ class Performer:
                              action_detail: str, 
                              action_maker_profile: str, 
                              intervention: str = ""):
-        references = self.retrieve_references(action_detail)
         # 当上一条为用户输入时，优先用用户输入做query并启用语义检索，扩大top_k
         use_user_query = False
         user_query_text = ""
@@ -410,10 +418,16 @@ class Performer:
                 use_user_query = True
                 user_query_text = last.get('detail', '')
         if use_user_query and user_query_text.strip():
-            history = self.retrieve_history(query = user_query_text, top_k = 6, retrieve = True)
+            bundle = self.retrieve_bundle(references_query = action_detail,
+                                          knowledges_query = action_detail,
+                                          history_query = user_query_text,
+                                          history_top_k = 6,
+                                          history_retrieve = True)
         else:
-            history = self.retrieve_history(query = action_detail)
-        knowledges = self.retrieve_knowledges(query = action_detail)
+            bundle = self.retrieve_bundle(references_query = action_detail,
+                                          knowledges_query = action_detail,
+                                          history_query = action_detail)
+        references, history, knowledges = bundle.references, bundle.history, bundle.knowledges
         
         relation = f"role_code:{action_maker_code}\n" + self.search_relation(action_maker_code)
         
@@ -453,7 +467,10 @@ class Performer:
             # 检索风格样本
             style_examples = self.style_examples.copy()
             if self.style_vector_db:
-                similar_examples = self.style_vector_db.search_similar_style(action_detail, top_k=3)
+                # 复用本回合已编码的查询向量
+                similar_examples = self.style_vector_db.search_similar_style(
+                    action_detail, top_k=3,
+                    query_vector=bundle.vector_for(action_detail, self.style_vector_db.embedding))
                 style_examples.extend([
                     {"context": ex.get("context", ""), "response": ex["text"]}
                     for ex in similar_examples
@@ -654,7 +671,6 @@ class Performer:
                             action_maker_profile: str, 
                             other_roles_info: Dict[str, Any], 
                             intervention: str = ""):
-        references = self.retrieve_references(query = action_detail)
         # 当上一条为用户输入时，优先用用户输入做query并启用语义检索，扩大top_k
         use_user_query = False
         user_query_text = ""
@@ -670,10 +686,16 @@ class Performer:
                     is_user_input = True
                     user_emphasis = f"\n\n⚠️ **重要提示**：{action_maker_name} 是真实用户，你必须直接、具体地回应他们的问题或意见。不要岔开话题或自说自话。"
         if use_user_query and user_query_text.strip():
-            history = self.retrieve_history(query = user_query_text, top_k = 6, retrieve = True)
+            bundle = self.retrieve_bundle(references_query = action_detail,
+                                          knowledges_query = action_detail,
+                                          history_query = user_query_text,
+                                          history_top_k = 6,
+                                          history_retrieve = True)
         else:
-            history = self.retrieve_history(query = action_detail)
-        knowledges = self.retrieve_knowledges(query = action_detail)
+            bundle = self.retrieve_bundle(references_query = action_detail,
+                                          knowledges_query = action_detail,
+                                          history_query = action_detail)
+        references, history, knowledges = bundle.references, bundle.history, bundle.knowledges
         
         other_roles_info_text = self.get_other_roles_info_text(other_roles_info, if_profile = False)
 
@@ -819,14 +841,18 @@ class Performer:
             return False
         return True
     
-    def retrieve_knowledges(self, query:str, top_k:int=1, max_words = 100):
+    def retrieve_bundle(self, **kwargs) -> RetrievalBundle:
+        """一次合并检索：每个不同的查询只编码一次，各集合并发查询（参数见 RetrievalPlanner.retrieve）"""
+        return RetrievalPlanner(self).retrieve(**kwargs)
+
+    def retrieve_knowledges(self, query:str, top_k:int=1, max_words = 100, query_vector = None):
         if self.world_db is None:
             return ""
-        knowledges = "\n".join(self.world_db.search(query, top_k,self.world_db_name))
+        knowledges = "\n".join(self.world_db.search(query, top_k,self.world_db_name, query_vector=query_vector))
         knowledges = knowledges[:max_words]
         return knowledges
     
-    def retrieve_references(self, query: str, top_k: int = 1):
+    def retrieve_references(self, query: str, top_k: int = 1, query_vector = None):
         # 延迟初始化数据库（如果需要）
         if not self._db_initialized and self.db is None:
             try:
@@ -865,7 +891,7 @@ class Performer:
         if self.db is None:
             return ""
         try:
-            search_results = self.db.search(query, top_k, self.db_name)
+            search_results = self.db.search(query, top_k, self.db_name, query_vector=query_vector)
             if search_results is None:
                 return ""
             return "\n".join(search_results)
@@ -874,7 +900,7 @@ class Performer:
             print(f"Warning: Database search failed: {e}")
             return ""
     
-    def retrieve_history(self, query: str, top_k: int = 5, retrieve: bool = False):
+    def retrieve_history(self, query: str, top_k: int = 5, retrieve: bool = False, query_vector = None):
         if len(self.history_manager) == 0: return ""
         if len(self.history_manager) >= top_k and retrieve:
             # 延迟初始化记忆系统（如果需要）
@@ -899,8 +925,10 @@ class Performer:
                             embedding_name=self._memory_embedding_name,
                             embedding=memory_embedding,
                             db_name=self.db_name.replace("role","memory"),
+                            db_type=self._db_type,
                             language=self._memory_language,
-                            type="naive"
+                            summarize_fn=make_memory_summarizer(self.llm, self._memory_language),
+                            type="ga"
                         )
                         self._memory_initialized = True
                 except Exception as e:
@@ -916,7 +944,10 @@ class Performer:
                 history = "\n" + "\n".join(self.history_manager.get_recent_history(top_k, include_speaker=True, performers=performers))
             else:
                 try:
-                    search_results = self.memory.search(query, top_k)
+                    if hasattr(self.memory, "sync_from_history"):
+                        # 增量写入新产生的历史记录（带虚拟时间戳）
+                        self.memory.sync_from_history(self.history_manager)
+                    search_results = self.memory.search(query, top_k, query_vector=query_vector)
                     if search_results is None:
                         search_results = []
                     history = "\n" + "\n".join(search_results) + "\n"
@@ -927,7 +958,13 @@ class Performer:
                     history = "\n" + "\n".join(self.history_manager.get_recent_history(top_k, include_speaker=True, performers=performers))
         else:
             performers = getattr(self, '_performers_ref', None)
-            history = "\n" + "\n".join(self.history_manager.get_recent_history(top_k, include_speaker=True, performers=performers))
+            recent_lines = self.history_manager.get_recent_history(top_k, include_speaker=True, performers=performers)
+            summarizer = self._summarizer_ref
+            if summarizer is not None:
+                # 更早的历史以固定长度的摘要形式保留在上下文中
+                history = "\n" + summarizer.build_context(recent_lines)
+            else:
+                history = "\n" + "\n".join(recent_lines)
         return history
         
     def get_other_roles_info_text(self, other_roles: List[str], if_relation: bool = True, if_profile: bool = True):
@@ -2,17 +2,42 @@ import sys
 sys.path.append("../")
 from sw_utils import *
 from modules.embedding import get_embedding_model
-from langchain_experimental.generative_agents import GenerativeAgentMemory
-from langchain.retrievers import TimeWeightedVectorStoreRetriever
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.llms import Tongyi,OpenAI
-from langchain_community.docstore import InMemoryDocstore
-from langchain_community.vectorstores import FAISS
-import faiss
+from modules.time_simulator import get_time_simulator
+import numpy as np
 import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# 合并记忆的摘要（LLM 调用）在后台线程中生成，不阻塞写入记忆的回合
+_CONSOLIDATION_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="memory-consolidation")
+
+# LangChain 版本的记忆仅在显式选择 type="langchain" 时使用，不再是必需依赖
+try:
+    from langchain_experimental.generative_agents import GenerativeAgentMemory
+except ImportError:
+    GenerativeAgentMemory = None
 
 def build_performer_memory(type = "ga",**kwargs):
     if type == "ga":
+        # 原生的时间加权记忆（recency / importance / relevance），无需 LangChain 与 OpenAI
+        embedding = kwargs["embedding"] if "embedding" in kwargs else None
+        if embedding is None:
+            embedding = get_embedding_model(kwargs["embedding_name"], kwargs.get("language", "en"))
+        agent_memory = TimeWeightedMemory(embedding=embedding,
+                                          decay_rate=kwargs.get("decay_rate", 0.01),
+                                          importance_fn=kwargs.get("importance_fn"),
+                                          k=kwargs.get("k", 5),
+                                          capacity=kwargs.get("capacity", 500),
+                                          eviction_policy=kwargs.get("eviction_policy", "lru"),
+                                          summarize_fn=kwargs.get("summarize_fn"))
+        return agent_memory
+
+    elif type == "langchain":
+        from langchain.retrievers import TimeWeightedVectorStoreRetriever
+        from langchain_community.llms import Tongyi,OpenAI
+        from langchain_community.docstore import InMemoryDocstore
+        from langchain_community.vectorstores import FAISS
+        import faiss
         llm_name = kwargs["llm_name"]
         embedding_name = kwargs["embedding_name"]
         db_name = kwargs["db_name"]
@@ -48,7 +73,7 @@ def build_performer_memory(type = "ga",**kwargs):
         db_name = kwargs["db_name"]
         embedding = kwargs["embedding"]
         db_type = kwargs["db_type"] if "db_type" in kwargs else "chromadb"
-        capacity= kwargs["capacity"] if "capacity" in kwargs else 5
+        capacity= kwargs["capacity"] if "capacity" in kwargs else 500
         agent_memory = RoleMemory(db_name=db_name,
                                   embedding=embedding,
                                   db_type=db_type,
@@ -58,31 +83,349 @@ def build_performer_memory(type = "ga",**kwargs):
 def relevance_score_fn(score: float) -> float:
     return 1.0 - score / math.sqrt(2)
 
-class RoleMemory_GA(GenerativeAgentMemory):
-    def init_from_data(self,data):
-        for text in data:
-            self.add_record(text)
-    
-    def add_record(self,text):
-        self.add_memory(text)
-    
-    def search(self,query,top_k):
-        fetched_memories = [doc.page_content for doc in self.fetch_memories(query)[:top_k]]
-        if len(fetched_memories)>=top_k:
-            print("-Memory Searching...")
-            print(fetched_memories)
-        return fetched_memories
-    
-    def delete_record(self, idx):
-        pass
+if GenerativeAgentMemory is not None:
+    class RoleMemory_GA(GenerativeAgentMemory):
+        def init_from_data(self,data):
+            for text in data:
+                self.add_record(text)
+        
+        def add_record(self,text):
+            self.add_memory(text)
+        
+        def search(self,query,top_k,query_vector=None):
+            fetched_memories = [doc.page_content for doc in self.fetch_memories(query)[:top_k]]
+            if len(fetched_memories)>=top_k:
+                print("-Memory Searching...")
+                print(fetched_memories)
+            return fetched_memories
+        
+        def delete_record(self, idx):
+            pass
+
+
+# 不同类型历史记录的默认重要度（未提供 importance_fn 时使用）
+IMPORTANCE_BY_ACT_TYPE = {
+    "user_input": 0.8,
+    "goal setting": 0.7,
+    "multi": 0.6,
+    "single": 0.6,
+    "move": 0.4,
+    "plan": 0.3,
+}
+DEFAULT_IMPORTANCE = 0.5
+PLACEHOLDER_TEXT = "__USER_INPUT_PLACEHOLDER__"
+
+
+class TimeWeightedMemory:
+    """
+    时间加权记忆：向量、虚拟时间戳、最近访问时间、重要度以并行数组存储，
+    检索时一次向量化计算 recency（按虚拟小时指数衰减）、importance、relevance（余弦）
+    的加权得分，并用 argpartition 取 top-k。
+    超出容量时按淘汰策略移出一批记忆，其中彼此相似的记忆合并为一条摘要记忆；
+    提供 summarize_fn 时摘要在后台生成，完成后于下一次写入或检索时加入记忆。
+    """
+
+    EVICTION_POLICIES = ("lru", "importance", "age")
+
+    def __init__(self,
+                 embedding,
+                 decay_rate: float = 0.01,
+                 importance_fn = None,
+                 k: int = 5,
+                 weights = (1.0, 1.0, 1.0),
+                 capacity: int = 500,
+                 eviction_policy: str = "lru",
+                 summarize_fn = None,
+                 cluster_threshold: float = 0.8,
+                 evict_ratio: float = 0.1):
+        """
+        Args:
+            embedding: 嵌入模型（可调用，输入文本列表返回向量列表）
+            decay_rate: 每虚拟小时的衰减率，recency = (1 - decay_rate) ** hours
+            importance_fn: 可选的重要度打分函数 text -> [0, 1]
+            weights: (recency, importance, relevance) 的权重
+            capacity: 记忆条数上限（None 表示不限）
+            eviction_policy: "lru"（最久未被检索）、"importance"（重要度最低）或 "age"（最早写入）
+            summarize_fn: 可选的摘要函数 List[str] -> str，用于合并被淘汰的相似记忆
+            cluster_threshold: 被淘汰记忆之间合并为同一簇的余弦相似度阈值
+            evict_ratio: 每次淘汰时额外腾出的容量比例，避免每写入一条就淘汰一次
+        """
+        if eviction_policy not in self.EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy: {eviction_policy}")
+        self.embedding = embedding
+        self.decay_rate = decay_rate
+        self.importance_fn = importance_fn
+        self.k = k
+        self.weights = weights
+        self.capacity = capacity
+        self.eviction_policy = eviction_policy
+        self.summarize_fn = summarize_fn
+        self.cluster_threshold = cluster_threshold
+        self.evict_ratio = evict_ratio
+        self.evictions = 0
+        self.consolidations = 0
+        self.consolidated_sources = 0
+        self.summary_failures = 0
+        self._pending_summaries = []   # [(future, created_at, importance, 质心向量, 原文)]
+
+        self.texts = []
+        self.index = {}       # 文本 -> 行号
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.created_at = np.zeros(0, dtype=np.float64)
+        self.last_accessed = np.zeros(0, dtype=np.float64)
+        self.importance = np.zeros(0, dtype=np.float32)
+        self.size = 0
+        self._history_cursor = 0
+        self._history_first_id = None
+
+    @staticmethod
+    def _now():
+        return get_time_simulator().get_virtual_timestamp()
+
+    def _grow(self, needed, dim):
+        capacity = max(needed, len(self.created_at) * 2, 16)
+        vectors = np.zeros((capacity, dim), dtype=np.float32)
+        vectors[:self.size] = self.vectors[:self.size]
+        self.vectors = vectors
+        for name, dtype in (("created_at", np.float64), ("last_accessed", np.float64), ("importance", np.float32)):
+            grown = np.zeros(capacity, dtype=dtype)
+            grown[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, grown)
+
+    def add_records(self, texts, timestamps=None, importances=None):
+        """批量写入（一次编码）；已存在的文本会被跳过"""
+        self._drain_summaries()
+        now = self._now()
+        rows = []
+        seen = set()
+        for i, text in enumerate(texts):
+            if not text or text in self.index or text in seen:
+                continue
+            seen.add(text)
+            timestamp = timestamps[i] if timestamps and timestamps[i] is not None else now
+            if importances and importances[i] is not None:
+                importance = importances[i]
+            elif self.importance_fn is not None:
+                importance = self.importance_fn(text)
+            else:
+                importance = DEFAULT_IMPORTANCE
+            rows.append((text, timestamp, importance))
+        if not rows:
+            return 0
+        vectors = np.asarray(self.embedding([text for text, _, _ in rows]), dtype=np.float32)
+        self._append(rows, vectors)
+        self._enforce_capacity()
+        return len(rows)
+
+    def _append(self, rows, vectors):
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        needed = self.size + len(rows)
+        if needed > len(self.created_at) or self.vectors.shape[1] != vectors.shape[1]:
+            if self.size == 0:
+                self.vectors = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+            self._grow(needed, vectors.shape[1])
+        start = self.size
+        self.vectors[start:needed] = vectors
+        for offset, (text, timestamp, importance) in enumerate(rows):
+            row = start + offset
+            self.texts.append(text)
+            self.index[text] = row
+            self.created_at[row] = timestamp
+            self.last_accessed[row] = timestamp
+            self.importance[row] = importance
+        self.size = needed
+
+    # --- 容量与淘汰 ---
+    def _eviction_order(self):
+        n = self.size
+        if self.eviction_policy == "lru":
+            return np.argsort(self.last_accessed[:n], kind="stable")
+        if self.eviction_policy == "importance":
+            # 重要度相同时先淘汰更早的
+            return np.lexsort((self.created_at[:n], self.importance[:n]))
+        return np.argsort(self.created_at[:n], kind="stable")
+
+    def _enforce_capacity(self):
+        if not self.capacity or self.size <= self.capacity:
+            return
+        target = max(1, int(self.capacity * (1 - self.evict_ratio)))
+        evicted = self._eviction_order()[:self.size - target]
+        clusters = self._clusters(evicted)
+        for text in [self.texts[row] for row in evicted]:
+            self.delete_record(text)
+        self.evictions += len(evicted)
+        for texts, created_at, importance, centroid in clusters:
+            if self.summarize_fn is None:
+                # 无摘要函数时按条拼接并截断
+                self._add_summary(" / ".join(texts)[:500], created_at, importance, centroid, len(texts))
+            else:
+                future = _CONSOLIDATION_EXECUTOR.submit(self.summarize_fn, texts)
+                self._pending_summaries.append((future, created_at, importance, centroid, texts))
+
+    def _clusters(self, evicted):
+        """被淘汰记忆中彼此相似的簇（单条记忆直接丢弃）：[(原文列表, 最新时间, 最高重要度, 质心)]"""
+        if len(evicted) < 2:
+            return []
+        vectors = self.vectors[evicted]
+        similarity = vectors @ vectors.T
+        assigned = np.zeros(len(evicted), dtype=bool)
+        clusters = []
+        for i in range(len(evicted)):
+            if assigned[i]:
+                continue
+            members = np.where((similarity[i] >= self.cluster_threshold) & ~assigned)[0]
+            assigned[members] = True
+            if len(members) < 2:
+                continue
+            rows = evicted[members]
+            clusters.append(([self.texts[row] for row in rows],
+                             float(self.created_at[rows].max()),
+                             float(self.importance[rows].max()),
+                             self.vectors[rows].mean(axis=0)))
+        return clusters
+
+    def _drain_summaries(self):
+        """把已完成的后台摘要加入记忆；摘要失败时退回拼接原文"""
+        if not self._pending_summaries:
+            return
+        remaining = []
+        for future, created_at, importance, centroid, texts in self._pending_summaries:
+            if not future.done():
+                remaining.append((future, created_at, importance, centroid, texts))
+                continue
+            try:
+                summary = (future.result() or "").strip()
+            except Exception as e:
+                print(f"[Memory] Consolidation summary failed: {e}")
+                summary = ""
+            if not summary:
+                self.summary_failures += 1
+                summary = " / ".join(texts)[:500]
+            self._add_summary(summary, created_at, importance, centroid, len(texts))
+        self._pending_summaries = remaining
+
+    def _add_summary(self, summary, created_at, importance, centroid, sources):
+        if not summary or summary in self.index:
+            return
+        self._append([(summary, created_at, importance)], np.asarray([centroid], dtype=np.float32))
+        self.consolidations += 1
+        self.consolidated_sources += sources
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "capacity": self.capacity,
+            "eviction_policy": self.eviction_policy,
+            "evictions": self.evictions,
+            "consolidations": self.consolidations,
+            "consolidated_sources": self.consolidated_sources,
+            "pending_summaries": len(self._pending_summaries),
+            "summary_failures": self.summary_failures,
+        }
+
+    def add_record(self, text, timestamp=None, importance=None):
+        return self.add_records([text], [timestamp], [importance]) > 0
+
+    def init_from_data(self, data):
+        self.add_records(list(data))
+
+    def clear(self):
+        """清空所有记忆（保留淘汰/合并计数）"""
+        self.texts = []
+        self.index = {}
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.created_at = np.zeros(0, dtype=np.float64)
+        self.last_accessed = np.zeros(0, dtype=np.float64)
+        self.importance = np.zeros(0, dtype=np.float32)
+        self.size = 0
+        self._history_cursor = 0
+        self._history_first_id = None
+        self._pending_summaries = []
+
+    def sync_from_history(self, history_manager):
+        """增量写入 history_manager 中新增的记录（带虚拟时间戳和按类型的重要度）"""
+        history = history_manager.detailed_history
+        first_id = history[0].get("record_id") if history else None
+        # 历史被外部清空或替换（重置沙盒/清空聊天）时，已写入的记忆随之清空，从头同步
+        if len(history) < self._history_cursor or \
+                (self._history_cursor and first_id != self._history_first_id):
+            self.clear()
+        self._history_first_id = first_id
+        records = history[self._history_cursor:]
+        self._history_cursor = len(history)
+        texts, timestamps, importances = [], [], []
+        for record in records:
+            detail = record.get("detail", "")
+            if not detail or detail == PLACEHOLDER_TEXT:
+                continue
+            texts.append(detail)
+            timestamps.append(record.get("virtual_timestamp"))
+            importances.append(None if self.importance_fn is not None
+                               else IMPORTANCE_BY_ACT_TYPE.get(record.get("act_type", ""), DEFAULT_IMPORTANCE))
+        if texts:
+            self.add_records(texts, timestamps, importances)
+
+    def scores(self, query_vector, now=None):
+        """所有记忆的综合得分（向量化）"""
+        now = self._now() if now is None else now
+        n = self.size
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        relevance = self.vectors[:n] @ query
+        hours = np.maximum(now - self.last_accessed[:n], 0.0) / 3600.0
+        recency = np.power(1.0 - self.decay_rate, hours)
+        w_recency, w_importance, w_relevance = self.weights
+        return w_recency * recency + w_importance * self.importance[:n] + w_relevance * relevance
+
+    def search(self, query, top_k=None, query_vector=None):
+        top_k = top_k or self.k
+        self._drain_summaries()
+        if self.size == 0 or not query:
+            return []
+        if query_vector is None:
+            query_vector = self.embedding([query])[0]
+        now = self._now()
+        scores = self.scores(query_vector, now)
+        top_k = min(top_k, self.size)
+        if top_k < self.size:
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            top = np.arange(self.size)
+        top = top[np.argsort(-scores[top])]
+        # 被检索到的记忆刷新访问时间（与 Generative Agents 一致）
+        self.last_accessed[top] = now
+        return [self.texts[row] for row in top]
+
+    def delete_record(self, text):
+        row = self.index.pop(text, None)
+        if row is None:
+            return False
+        last = self.size - 1
+        if row != last:
+            self.vectors[row] = self.vectors[last]
+            self.created_at[row] = self.created_at[last]
+            self.last_accessed[row] = self.last_accessed[last]
+            self.importance[row] = self.importance[last]
+            self.texts[row] = self.texts[last]
+            self.index[self.texts[row]] = row
+        self.texts.pop()
+        self.size = last
+        return True
+
+    @property
+    def len(self):
+        return self.size
 
 
 class RoleMemory:
-    def __init__(self,db_name,embedding,db_type = "chroma",capacity = 5,) -> None:
+    def __init__(self,db_name,embedding,db_type = "chroma",capacity = 500,) -> None:
         self.idx = 0
         self.capacity = capacity
         self.db_name = db_name
         self.db = build_db([],db_name,db_type,embedding,save_type="temporary")
+        # 按写入顺序记录文本，超出容量时淘汰最早的记录
+        self._texts = deque()
+        self.evictions = 0
     
     def init_from_data(self,data):
         for text in data:
@@ -90,13 +433,18 @@ class RoleMemory:
     
     def add_record(self,text):
         self.idx += 1
-        self.db.add(text, str(self.idx), db_name=self.db_name)
+        if self.db.add(text, db_name=self.db_name):
+            self._texts.append(text)
+        while self.capacity and len(self._texts) > self.capacity:
+            self.db.delete(self._texts.popleft(), self.db_name)
+            self.evictions += 1
     
-    def search(self,query,top_k):
-        return self.db.search(query, top_k,self.db_name)
+    def search(self,query,top_k,query_vector=None):
+        return self.db.search(query, top_k,self.db_name,query_vector=query_vector)
     
-    def delete_record(self, idx):
-        self.db.delete(idx)
+    def delete_record(self, text):
+        if self.db.delete(text, self.db_name) and text in self._texts:
+            self._texts.remove(text)
         
     @property
     def len(self):
@@ -0,0 +1,427 @@
+"""
+神经元匹配引擎
+将所有预设 Agent 的 Big Five、MBTI 以及兴趣/价值观/社交目标的 Embedding 预先堆叠为矩阵，
+一次用少量 NumPy 运算对全部候选打分，再用 argpartition 选出 Top-K。
+打分规则与 server.calculate_advanced_compatibility 逐项一致。
+"""
+import sys
+sys.path.append("../")
+import hashlib
+import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+BIG_FIVE_DIMS = ['openness', 'conscientiousness', 'extraversion', 'agreeableness', 'neuroticism']
+
+# 维度 -> (用户 Embedding 键, 用户侧 Jaccard 字段, 候选侧 Jaccard 字段)
+SEMANTIC_FIELDS = {
+    "values": ("values", "social_goals", "values"),
+    "interests": ("interests", "interests", "interests"),
+    "goals": ("goals", "social_goals", "social_goals"),
+}
+
+# 缺失数据时的默认分
+DEFAULT_SCORE = 0.3
+
+# 匹配结果在后台线程中预计算（保存数字孪生后），不阻塞请求
+_MATCH_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="neural-match")
+
+
+def build_user_match_profile(digital_twin: Dict[str, Any]) -> Dict[str, Any]:
+    """从数字孪生构建用于匹配计算的 profile（优先使用 personality 字段）"""
+    personality = digital_twin.get('personality', {})
+    generated_traits = digital_twin.get('generated_profile', {}).get('core_traits', {})
+    extracted_profile = digital_twin.get('extracted_profile', {})
+    return {
+        "mbti": personality.get('mbti') or generated_traits.get('mbti') or extracted_profile.get('mbti', ''),
+        "interests": extracted_profile.get('interests', []) or personality.get('values', []) or generated_traits.get('values', []),
+        "social_goals": extracted_profile.get('social_goals', []) or personality.get('values', []) or generated_traits.get('values', []),
+        "personality": personality.get('big_five') or generated_traits.get('big_five') or extracted_profile.get('personality', '')
+    }
+
+
+def embed_user_profile(user_profile: Dict[str, Any], embedding_model) -> Dict[str, Any]:
+    """批量编码用户的兴趣/价值观/社交目标文本，失败时返回已得到的部分"""
+    user_embeddings = {}
+    if not embedding_model:
+        return user_embeddings
+    try:
+        texts = {
+            "interests": " ".join(user_profile.get("interests", [])),
+            # 价值观通常存放在 social_goals 中
+            "values": " ".join(user_profile.get("social_goals", [])),
+            "goals": " ".join(user_profile.get("social_goals", [])),
+        }
+        keys = [key for key, text in texts.items() if text]
+        if keys:
+            vectors = embedding_model([texts[key] for key in keys])
+            for key, vector in zip(keys, vectors):
+                user_embeddings[key] = vector
+    except Exception as e:
+        print(f"Error generating user embeddings: {e}")
+    return user_embeddings
+
+
+def _big_five_vector(big_five) -> np.ndarray:
+    vector = np.full(len(BIG_FIVE_DIMS), np.nan)
+    if not isinstance(big_five, dict):
+        return vector
+    for col, dim in enumerate(BIG_FIVE_DIMS):
+        value = big_five.get(dim)
+        if value is None:
+            continue
+        try:
+            vector[col] = float(value)
+        except (TypeError, ValueError):
+            pass
+    return vector
+
+
+def _valid_mbti(mbti) -> bool:
+    return isinstance(mbti, str) and len(mbti) == 4
+
+
+def _map_values(raw_sim):
+    return np.select(
+        [raw_sim > 0.85, raw_sim > 0.75, raw_sim > 0.65, raw_sim > 0.5],
+        [0.7 + (raw_sim - 0.85) * 2.0,
+         0.4 + (raw_sim - 0.75) * 3.0,
+         0.2 + (raw_sim - 0.65) * 2.0,
+         (raw_sim - 0.5) * 1.33],
+        default=0.0)
+
+
+def _map_interests(raw_sim):
+    return np.select(
+        [raw_sim > 0.8, raw_sim > 0.65, raw_sim > 0.5],
+        [0.6 + (raw_sim - 0.8) * 2.0,
+         0.3 + (raw_sim - 0.65) * 2.0,
+         (raw_sim - 0.5) * 2.0],
+        default=0.0)
+
+
+def _map_goals(raw_sim):
+    return np.select(
+        [raw_sim > 0.85, raw_sim > 0.7, raw_sim > 0.5],
+        [0.7 + (raw_sim - 0.85) * 2.0,
+         0.3 + (raw_sim - 0.7) * 2.67,
+         (raw_sim - 0.5) * 1.5],
+        default=0.0)
+
+
+SIMILARITY_MAPPINGS = {"values": _map_values, "interests": _map_interests, "goals": _map_goals}
+
+
+def map_total_score(total):
+    """将加权总分做分段线性映射，拉大区分度（不含随机扰动）"""
+    return np.select(
+        [total > 0.6, total > 0.4],
+        [0.65 + (total - 0.6) * 0.85,
+         0.35 + (total - 0.4) * 1.5],
+        default=0.1 + total * 0.625)
+
+
+class _EmbeddingMatrix:
+    """一个语义维度的候选向量矩阵；缺失或维度不一致的行单独标记"""
+
+    def __init__(self, vectors: List[Optional[Any]]):
+        size = len(vectors)
+        arrays = [np.asarray(v, dtype=np.float64).ravel() if v is not None else None for v in vectors]
+        dims = [a.shape[0] for a in arrays if a is not None]
+        self.dim = max(set(dims), key=dims.count) if dims else 0
+        self.present = np.array([a is not None for a in arrays], dtype=bool)
+        # 与多数维度不一致的向量在原算法中会在 np.dot 处抛错，保留默认分
+        self.broken = np.array([a is not None and a.shape[0] != self.dim for a in arrays], dtype=bool)
+        self.matrix = np.zeros((size, self.dim), dtype=np.float64)
+        for row, a in enumerate(arrays):
+            if a is not None and not self.broken[row]:
+                self.matrix[row] = a
+        self.norms = np.linalg.norm(self.matrix, axis=1)
+
+    def cosine(self, vector) -> Optional[np.ndarray]:
+        """返回与每一行的余弦相似度（零向量为 0.0）；用户向量维度不符时返回 None"""
+        vector = np.asarray(vector, dtype=np.float64).ravel()
+        if vector.shape[0] != self.dim:
+            return None
+        norm = np.linalg.norm(vector)
+        dots = self.matrix @ vector
+        denom = self.norms * norm
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sims = np.where(denom == 0, 0.0, dots / np.where(denom == 0, 1.0, denom))
+        return sims
+
+
+class _TokenMatrix:
+    """用于 Jaccard 回退的候选词集合（稀疏的二值矩阵）"""
+
+    def __init__(self, token_lists: List[List[Any]]):
+        self.vocab: Dict[Any, int] = {}
+        rows, cols = [], []
+        for row, tokens in enumerate(token_lists):
+            for token in set(tokens or []):
+                col = self.vocab.setdefault(token, len(self.vocab))
+                rows.append(row)
+                cols.append(col)
+        self.matrix = np.zeros((len(token_lists), len(self.vocab)), dtype=np.int32)
+        if rows:
+            self.matrix[rows, cols] = 1
+        self.sizes = self.matrix.sum(axis=1)
+
+    def jaccard(self, tokens) -> np.ndarray:
+        user_tokens = set(tokens or [])
+        result = np.full(len(self.sizes), DEFAULT_SCORE)
+        if not user_tokens:
+            return result
+        cols = [self.vocab[t] for t in user_tokens if t in self.vocab]
+        inter = self.matrix[:, cols].sum(axis=1) if cols else np.zeros(len(self.sizes), dtype=np.int32)
+        union = len(user_tokens) + self.sizes - inter
+        has_tokens = self.sizes > 0
+        result[has_tokens] = inter[has_tokens] / union[has_tokens]
+        return result
+
+
+@dataclass
+class MatchScores:
+    """一次打分的结果，按候选顺序排列"""
+    personality: np.ndarray
+    values: np.ndarray
+    interests: np.ndarray
+    goals: np.ndarray
+    total: np.ndarray
+    final: np.ndarray
+
+    def breakdown(self, row: int) -> Dict[str, float]:
+        return {
+            'personality': round(float(self.personality[row]) * 100, 1),
+            'values': round(float(self.values[row]) * 100, 1),
+            'interests': round(float(self.interests[row]) * 100, 1),
+            'goals': round(float(self.goals[row]) * 100, 1)
+        }
+
+    def match_percent(self) -> np.ndarray:
+        return np.rint(self.final * 100).astype(np.int64)
+
+
+def catalogue_version(presets: List[Dict[str, Any]], model_key: str = "") -> str:
+    """预设目录中参与匹配的字段（以及所用 Embedding 模型）的内容哈希"""
+    digest = hashlib.sha1(model_key.encode('utf-8'))
+    for preset in presets:
+        fields = {key: preset.get(key) for key in
+                  ('id', 'mbti', 'big_five', 'interests', 'values', 'social_goals')}
+        digest.update(json.dumps(fields, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class NeuralMatchEngine:
+    """对一组候选（预设 Agent）做向量化的匹配打分"""
+
+    def __init__(self, presets: List[Dict[str, Any]], candidate_embeddings: List[Dict[str, Any]],
+                 model_key: str = ""):
+        self.presets = presets
+        self.version = catalogue_version(presets, model_key)
+        self.big_five = np.vstack([_big_five_vector(p.get('big_five', {})) for p in presets]) \
+            if presets else np.zeros((0, len(BIG_FIVE_DIMS)))
+
+        mbti_codes = [p.get('mbti', '') for p in presets]
+        self.mbti_valid = np.array([bool(m) and _valid_mbti(m) for m in mbti_codes], dtype=bool)
+        self.mbti = np.array([list(m) if _valid_mbti(m) else [''] * 4 for m in mbti_codes],
+                             dtype='<U1').reshape(len(presets), 4)
+
+        self.embeddings = {
+            key: _EmbeddingMatrix([(e or {}).get(key) for e in candidate_embeddings])
+            for key in SEMANTIC_FIELDS
+        }
+        self.tokens = {
+            key: _TokenMatrix([p.get(field, []) for p in presets])
+            for key, (_, _, field) in SEMANTIC_FIELDS.items()
+        }
+
+    def __len__(self):
+        return len(self.presets)
+
+    @classmethod
+    def from_presets(cls, presets: List[Dict[str, Any]], embedding_model) -> "NeuralMatchEngine":
+        from modules.preset_agents import PresetAgents
+        candidate_embeddings = [PresetAgents.get_preset_embeddings(p, embedding_model) if embedding_model else {}
+                                for p in presets]
+        model_key = ""
+        if embedding_model:
+            from modules.embedding import embedding_model_key
+            model_key = embedding_model_key(embedding_model)
+        return cls(presets, candidate_embeddings, model_key)
+
+    # --- 打分 ---
+    def _big_five_scores(self, big_five) -> np.ndarray:
+        user = _big_five_vector(big_five)
+        valid = ~np.isnan(self.big_five) & ~np.isnan(user)
+        diffs = np.where(valid, self.big_five - user, 0.0)
+        dist_sq = (diffs * diffs).sum(axis=1)
+        valid_dims = valid.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            avg_dist = np.sqrt(dist_sq / np.maximum(valid_dims, 1))
+        return np.where(valid_dims > 0, np.exp(-5.0 * (avg_dist ** 2)), DEFAULT_SCORE)
+
+    def _mbti_scores(self, mbti) -> np.ndarray:
+        scores = np.full(len(self.presets), DEFAULT_SCORE)
+        if not mbti or not _valid_mbti(mbti):
+            return scores
+        same = self.mbti == np.array(list(mbti), dtype='<U1')
+        s_ei = np.where(same[:, 0], 0.5, 1.0)
+        s_ns = np.where(same[:, 1], 1.0, 0.3)
+        s_tf = np.where(same[:, 2], 0.7, 0.5)
+        s_jp = np.where(same[:, 3], 0.7, 0.5)
+        combined = (s_ei * 0.3 + s_ns * 0.4 + s_tf * 0.15 + s_jp * 0.15)
+        return np.where(self.mbti_valid, combined, scores)
+
+    def _semantic_scores(self, key, user_profile, user_embeddings) -> np.ndarray:
+        embedding_key, user_field, _ = SEMANTIC_FIELDS[key]
+        fallback = self.tokens[key].jaccard(user_profile.get(user_field, []))
+        user_vector = (user_embeddings or {}).get(embedding_key)
+        if user_vector is None:
+            return fallback
+        matrix = self.embeddings[key]
+        # 双方都有 Embedding 时走余弦映射，否则回退到 Jaccard
+        scores = np.where(matrix.present, DEFAULT_SCORE, fallback)
+        sims = matrix.cosine(user_vector)
+        if sims is None:
+            return scores
+        usable = matrix.present & ~matrix.broken
+        return np.where(usable, SIMILARITY_MAPPINGS[key](sims), scores)
+
+    def score(self, user_profile: Dict[str, Any], user_embeddings: Optional[Dict[str, Any]] = None,
+              jitter: float = 0.03) -> MatchScores:
+        """对所有候选打分；jitter 为最终分数上的均匀随机扰动幅度"""
+        bf_score = self._big_five_scores(user_profile.get('personality', {}))
+        mbti_score = self._mbti_scores(user_profile.get('mbti', ''))
+        personality = bf_score * 0.6 + mbti_score * 0.4
+        values = self._semantic_scores("values", user_profile, user_embeddings)
+        interests = self._semantic_scores("interests", user_profile, user_embeddings)
+        goals = self._semantic_scores("goals", user_profile, user_embeddings)
+
+        total = personality * 0.50 + values * 0.30 + interests * 0.10 + goals * 0.10
+        mapped = map_total_score(total)
+        if jitter:
+            # 添加小的随机扰动，避免分数完全相同
+            mapped = mapped + np.random.uniform(-jitter, jitter, size=len(mapped))
+        final = np.clip(mapped, 0.05, 0.99)
+        return MatchScores(personality, values, interests, goals, total, final)
+
+    @staticmethod
+    def _rank_keys(match_percent: np.ndarray) -> np.ndarray:
+        # 百分比为整数，用 (百分比, -下标) 组合成唯一的键
+        size = len(match_percent)
+        return match_percent.astype(np.int64) * (size + 1) - np.arange(size)
+
+    @staticmethod
+    def rank_tail(match_percent: np.ndarray, start: int) -> np.ndarray:
+        """返回排名在 start 及之后的候选下标（集合，不保证顺序）"""
+        keys = NeuralMatchEngine._rank_keys(match_percent)
+        if start <= 0:
+            return np.arange(len(keys))
+        if start >= len(keys):
+            return np.zeros(0, dtype=np.int64)
+        return np.argpartition(-keys, start - 1)[start:]
+
+    @staticmethod
+    def rank(match_percent: np.ndarray, k: Optional[int] = None) -> np.ndarray:
+        """
+        按匹配百分比降序返回前 k 个候选的下标；同分按原顺序（与稳定排序一致）。
+        k 小于候选数时只对 argpartition 选出的部分排序。
+        """
+        keys = NeuralMatchEngine._rank_keys(match_percent)
+        size = len(keys)
+        if k is None or k >= size:
+            top = np.arange(size)
+        elif k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        else:
+            top = np.argpartition(-keys, k - 1)[:k]
+        return top[np.argsort(-keys[top])]
+
+
+_ENGINES: Dict[tuple, NeuralMatchEngine] = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+def get_match_engine(embedding_model=None) -> NeuralMatchEngine:
+    """返回当前预设目录 + Embedding 模型对应的匹配引擎（进程内缓存）"""
+    from modules.preset_agents import PresetAgents
+    presets = PresetAgents.get_preset_templates()
+    key = (id(embedding_model), id(presets), len(presets))
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get(key)
+    if engine is not None:
+        return engine
+    engine = NeuralMatchEngine.from_presets(presets, embedding_model)
+    with _ENGINES_LOCK:
+        # 目录或模型变化后旧引擎不再使用
+        _ENGINES.clear()
+        _ENGINES[key] = engine
+    return engine
+
+
+@dataclass
+class _CachedMatches:
+    twin_version: Any
+    catalogue_version: str
+    result: Any
+
+
+class MatchResultCache:
+    """
+    每个用户的匹配结果缓存，键为 (数字孪生版本, 预设目录版本)，任一变化即失效。
+    同一用户同一版本的计算只提交一次，并发的请求共享同一个 Future。
+    """
+
+    def __init__(self, max_users: int = 10000):
+        self.max_users = max_users
+        self._entries: Dict[str, _CachedMatches] = {}
+        self._pending: Dict[str, tuple] = {}   # user_id -> (twin_version, catalogue_version, Future)
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str, twin_version, catalogue_version: str):
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is None or entry.twin_version != twin_version or entry.catalogue_version != catalogue_version:
+            return None
+        return entry.result
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def schedule(self, user_id: str, twin_version, catalogue_version: str, compute) -> Future:
+        """在后台计算并缓存 compute() 的结果；已有同版本的计算时返回它的 Future"""
+        with self._lock:
+            pending = self._pending.get(user_id)
+            if pending is not None and pending[:2] == (twin_version, catalogue_version):
+                return pending[2]
+            future = _MATCH_EXECUTOR.submit(self._run, user_id, twin_version, catalogue_version, compute)
+            self._pending[user_id] = (twin_version, catalogue_version, future)
+            return future
+
+    def _run(self, user_id: str, twin_version, catalogue_version: str, compute):
+        try:
+            result = compute()
+            with self._lock:
+                if len(self._entries) >= self.max_users and user_id not in self._entries:
+                    # 超出上限时丢弃最早写入的一条
+                    self._entries.pop(next(iter(self._entries)))
+                self._entries[user_id] = _CachedMatches(twin_version, catalogue_version, result)
+            return result
+        finally:
+            with self._lock:
+                pending = self._pending.get(user_id)
+                if pending is not None and pending[:2] == (twin_version, catalogue_version):
+                    self._pending.pop(user_id, None)
+
+
+_MATCH_CACHE = MatchResultCache()
+
+
+def get_match_cache() -> MatchResultCache:
+    return _MATCH_CACHE
@@ -1,9 +1,9 @@
 import sys
 sys.path.append("../")
-import csv
 from typing import Any, Dict, List, Optional, Literal
 from sw_utils import *
 from modules.embedding import get_embedding_model
+from modules.world_assets import get_world_assets, load_locations
 
 class Orchestrator:
     # Init
@@ -24,62 +24,33 @@ class Orchestrator:
         if embedding is None:
             embedding = get_embedding_model(embedding_name, language=language)
         self.llm = llm
-        self.world_info: Dict[str, Any] = load_json_file(world_file_path)
+        # 世界设定、地点、设定条目和设定向量库按世界文件在进程内共享（只读）
+        assets = get_world_assets(world_file_path = world_file_path,
+                                  location_file_path = location_file_path,
+                                  map_file_path = map_file_path,
+                                  embedding_name = embedding_name,
+                                  embedding = embedding,
+                                  db_type = db_type)
+        self.world_info: Dict[str, Any] = assets.world_info
         self.world_name: str = self.world_info["world_name"]
         self.language: str = language
         self.description:str = self.world_info["description"] if world_description == "" else world_description
-        source = self.world_info["source"]
         
-        self.locations_info: Dict[str, Any] = {}  
-        self.locations: List[str] = []
+        # 地点和距离表在模拟中会被修改，每个 Orchestrator 持有自己的副本
+        self.locations_info: Dict[str, Any] = dict(assets.locations_info)
+        self.locations: List[str] = list(assets.locations)
+        self.edges: Dict[tuple, int] = dict(assets.edges)
         self.history: List[str] = []
-        self.edges: Dict[tuple, int] = {}  # 地点间距离
         self.prompts: List[Dict] = []
         
-        self.init_from_file(map_file_path = map_file_path,
-                            location_file_path = location_file_path)
         self.init_prompt()
 
-            
-        self.world_data,self.world_settings = build_orchestrator_data(world_file_path = world_file_path, max_words = 50)
-        self.db_name = clean_collection_name(f"settings_{source}_{embedding_name}")
-        self.db = build_db(data = [row for row in self.world_data], 
-                           db_name = self.db_name, 
-                           db_type = db_type, 
-                           embedding = embedding)
+        self.world_data,self.world_settings = assets.world_data, assets.world_settings
+        self.db_name = assets.db_name
+        self.db = assets.db
         
     def init_from_file(self, map_file_path: str, location_file_path: str, default_distance: int = 1):
-        if map_file_path and os.path.exists(map_file_path):
-            valid_locations = load_json_file(location_file_path) if "locations" not in load_json_file(location_file_path) else load_json_file(location_file_path)["locations"]
-            with open(map_file_path, mode='r',encoding="utf-8") as file:
-                csv_reader = csv.reader(file)
-                locations = next(csv_reader)[1:]  
-                for row in csv_reader:
-                    # 跳过空行
-                    if not row or len(row) == 0:
-                        continue
-                    loc1 = row[0]
-                    if not loc1 or loc1 not in valid_locations:
-                        print(f"Warning: The location {loc1} does not exist")
-                        continue
-                    self.locations_info[loc1] = valid_locations[loc1]
-                    self.locations.append(loc1)
-                    distances = row[1:]
-                    for i, distance in enumerate(distances):
-                        loc2 = locations[i]
-                        if loc2 not in valid_locations:
-                            print(f"Warning: The location {loc2} does not exist")
-                            continue
-                        if distance != '0':  # Skip self-loops
-                            self._add_edge(loc1, loc2, int(distance))
-        else:
-            valid_locations = load_json_file(location_file_path) if "locations" not in load_json_file(location_file_path) else load_json_file(location_file_path)["locations"]
-            for loc1 in valid_locations:
-                self.locations_info[loc1] = valid_locations[loc1]
-                self.locations.append(loc1)
-                for loc2 in valid_locations:
-                    if loc2 != loc1:
-                        self._add_edge(loc1, loc2, default_distance)
+        self.locations_info, self.locations, self.edges = load_locations(map_file_path, location_file_path, default_distance)
                         
     def init_prompt(self,):
         if self.language == "zh":
@@ -430,43 +430,56 @@ class PresetAgents:
             style_examples=[]
         )
 
-    # --- Embedding Cache ---
-    _EMBEDDING_CACHE = None
-    _CACHE_FILE = os.path.join(
+    # --- Embedding Store ---
+    # 内容寻址（模型 + 文本）的内存映射向量存储，修改预设内容后自然失效
+    _EMBEDDING_STORE = None
+    _EMBEDDING_STORE_DIR = os.path.join(
         os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
-        'data', 'preset_agents', 'preset_embeddings.pkl'
+        'data', 'preset_agents', 'embedding_store'
     )
 
     @staticmethod
-    def _load_embedding_cache():
-        import pickle
-        if PresetAgents._EMBEDDING_CACHE is not None:
-            return
-        
-        if os.path.exists(PresetAgents._CACHE_FILE):
-            try:
-                with open(PresetAgents._CACHE_FILE, 'rb') as f:
-                    PresetAgents._EMBEDDING_CACHE = pickle.load(f)
-            except Exception as e:
-                print(f"Error loading embedding cache: {e}")
-                PresetAgents._EMBEDDING_CACHE = {}
-        else:
-            PresetAgents._EMBEDDING_CACHE = {}
+    def get_embedding_store():
+        from modules.embedding_store import EmbeddingStore
+        if PresetAgents._EMBEDDING_STORE is None:
+            PresetAgents._EMBEDDING_STORE = EmbeddingStore(PresetAgents._EMBEDDING_STORE_DIR)
+        return PresetAgents._EMBEDDING_STORE
 
     @staticmethod
-    def _save_embedding_cache():
-        import pickle
-        try:
-            os.makedirs(os.path.dirname(PresetAgents._CACHE_FILE), exist_ok=True)
-            with open(PresetAgents._CACHE_FILE, 'wb') as f:
-                pickle.dump(PresetAgents._EMBEDDING_CACHE, f)
-        except Exception as e:
-            print(f"Error saving embedding cache: {e}")
+    def _embedding_texts(preset: Dict[str, Any]) -> Dict[str, str]:
+        texts = {
+            'interests': " ".join(preset.get('interests', [])),
+            'values': " ".join(preset.get('values', [])),
+            'goals': " ".join(preset.get('social_goals', [])),
+        }
+        return {key: text for key, text in texts.items() if text}
+
+    @staticmethod
+    def precompute_embeddings(embedding_model, presets: Optional[List[Dict[str, Any]]] = None) -> int:
+        """
+        一次批量编码整个预设目录中尚未存储的文本
+        
+        Returns:
+            int: 新写入的向量数
+        """
+        from modules.embedding import embedding_model_key
+        from modules.embedding_store import content_key
+        if presets is None:
+            presets = PresetAgents.get_preset_templates()
+        store = PresetAgents.get_embedding_store()
+        model_key = embedding_model_key(embedding_model)
+        texts = list(dict.fromkeys(text for preset in presets
+                                   for text in PresetAgents._embedding_texts(preset).values()))
+        missing = [text for text in texts if content_key(model_key, text) not in store]
+        if not missing:
+            return 0
+        vectors = embedding_model(missing)
+        return store.put_many({content_key(model_key, text): vector for text, vector in zip(missing, vectors)})
 
     @staticmethod
     def get_preset_embeddings(preset: Dict[str, Any], embedding_model) -> Dict[str, Any]:
         """
-        获取预设Agent的Embedding（优先从缓存读取）
+        获取预设Agent的Embedding（优先从向量存储读取）
         
         Args:
             preset: 预设Agent配置
@@ -475,42 +488,18 @@ class PresetAgents:
         Returns:
             Dict: 包含 'interests', 'values', 'goals' 的 embedding 向量
         """
-        PresetAgents._load_embedding_cache()
-        
-        preset_id = preset['id']
-        # 简单的缓存键生成：ID + 内容哈希（简化版只用ID，假设ID唯一且内容不变）
-        # 如果需要更严谨，可以将 interests/values 等内容拼接后 hash
-        
-        if preset_id in PresetAgents._EMBEDDING_CACHE:
-            return PresetAgents._EMBEDDING_CACHE[preset_id]
-        
-        # 计算 Embedding
         embeddings = {}
+        texts = PresetAgents._embedding_texts(preset)
+        if not texts or not embedding_model:
+            return embeddings
         try:
-            interests_text = " ".join(preset.get('interests', []))
-            values_text = " ".join(preset.get('values', []))
-            goals_text = " ".join(preset.get('social_goals', []))
-            
-            texts = [t for t in [interests_text, values_text, goals_text] if t]
-            if texts and embedding_model:
-                vecs = embedding_model(texts)
-                idx = 0
-                if interests_text:
-                    embeddings['interests'] = vecs[idx]
-                    idx += 1
-                if values_text:
-                    embeddings['values'] = vecs[idx]
-                    idx += 1
-                if goals_text:
-                    embeddings['goals'] = vecs[idx]
-                    idx += 1
-            
-            # 更新缓存
-            PresetAgents._EMBEDDING_CACHE[preset_id] = embeddings
-            PresetAgents._save_embedding_cache()
-            
+            from modules.embedding import embedding_model_key
+            keys = list(texts)
+            vectors = PresetAgents.get_embedding_store().embed(
+                embedding_model_key(embedding_model), [texts[key] for key in keys], embedding_model)
+            embeddings = dict(zip(keys, vectors))
         except Exception as e:
-            print(f"Error computing embeddings for preset {preset_id}: {e}")
+            print(f"Error computing embeddings for preset {preset.get('id')}: {e}")
             
         return embeddings
 
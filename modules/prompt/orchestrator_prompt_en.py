@@ -259,4 +259,28 @@ You are a skilled writer tasked with transforming action logs into an engaging n
    - Add body language and non-verbal cues to enhance dialogue
 
 Please transform the action logs into an engaging narrative while preserving key plot points and character developments. Focus on creating an immersive reading experience that stays true to the established world and characters.
-"""
\ No newline at end of file
+"""
+ROUND_SUMMARY_PROMPT = """
+You are a careful chronicler. Compress the following log of one conversation round into a concise summary.
+
+### Log
+{history}
+
+### Requirements
+1. Keep who said or did what, and any change in relationships or stances between characters.
+2. Keep unresolved questions, promises and open threads.
+3. Ignore inner thoughts inside 【】 and do not add anything that is not in the log.
+4. Output the summary text directly, in no more than {max_words} words.
+"""
+
+DAY_SUMMARY_PROMPT = """
+You are a careful chronicler. Below are the round summaries of {day}, in chronological order. Merge them into a single summary of the day.
+
+### Round Summaries
+{summaries}
+
+### Requirements
+1. Keep the key events of the day, changes in relationships and unresolved questions.
+2. Merge repeated content and narrate in chronological order.
+3. Output the summary text directly, in no more than {max_words} words.
+"""
@@ -252,4 +252,28 @@ LOG2STORY_PROMPT = """
 2. 可以修改对角色的行动描述，但需要保留关键信息；
 3. 注意，在记录中，【】内的内容代表人物的心理活动，这些内容不能向其他角色展露，你可以适当地以第三人称视角概括。（）内的内容代表人物的动作。「」内的内容代表角色的讲话。
 4. 添加必要的场景描述、情节连接和氛围营造,使故事更加生动。
-"""
\ No newline at end of file
+"""
+ROUND_SUMMARY_PROMPT = """
+你是一个细致的记录员。请将以下一轮对话的记录压缩为一段简洁的摘要。
+
+### 对话记录
+{history}
+
+### 要求
+1. 保留谁说了什么、做了什么，以及角色之间关系或立场的变化；
+2. 保留尚未解决的问题、约定和悬念；
+3. 忽略【】内的心理活动，不要添加记录中没有的内容；
+4. 直接输出摘要文本，不超过{max_words}字。
+"""
+
+DAY_SUMMARY_PROMPT = """
+你是一个细致的记录员。以下是{day}这一天内按时间顺序排列的多轮对话摘要，请将它们合并为一段当天的总摘要。
+
+### 各轮摘要
+{summaries}
+
+### 要求
+1. 保留当天的关键事件、角色关系的变化以及尚未解决的问题；
+2. 合并重复内容，按时间顺序叙述；
+3. 直接输出摘要文本，不超过{max_words}字。
+"""
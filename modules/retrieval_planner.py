@@ -0,0 +1,140 @@
+"""
+检索规划器
+一次回合内的参考资料、世界知识、历史记忆和风格样本检索合并为一次调用：
+每个不同的查询文本只编码一次，再用同一个向量并发查询各个集合，
+结果以 RetrievalBundle 的形式交给提示词构建。
+"""
+import sys
+sys.path.append("../")
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+_RETRIEVAL_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="retrieval")
+
+
+@dataclass
+class RetrievalBundle:
+    """一次检索的结果"""
+    references: str = ""
+    knowledges: str = ""
+    history: str = ""
+    style_examples: List[Dict[str, Any]] = field(default_factory=list)
+    # (id(embedding), query) -> 查询向量，供回合内后续的检索复用
+    vectors: Dict[tuple, Any] = field(default_factory=dict)
+
+    def vector_for(self, query: str, embedding) -> Optional[Any]:
+        if not query or embedding is None:
+            return None
+        return self.vectors.get((id(embedding), query))
+
+
+class RetrievalPlanner:
+    """为一个 Performer 规划并执行一次合并检索"""
+
+    def __init__(self, performer):
+        self.performer = performer
+
+    def _references_embedding(self):
+        performer = self.performer
+        if performer.db is not None:
+            return getattr(performer.db, "embedding", None)
+        return getattr(performer, "_db_embedding", None)
+
+    def _knowledges_embedding(self):
+        performer = self.performer
+        if performer.world_db is None:
+            return None
+        return getattr(performer.world_db, "embedding", None)
+
+    def _memory_embedding(self):
+        performer = self.performer
+        memory = getattr(performer, "memory", None)
+        if memory is not None:
+            if getattr(memory, "embedding", None) is not None:
+                return memory.embedding
+            db = getattr(memory, "db", None)
+            return getattr(db, "embedding", None) if db is not None else None
+        return getattr(performer, "_memory_embedding", None)
+
+    @staticmethod
+    def _embed_distinct(requests) -> Dict[tuple, Any]:
+        """按 embedding 模型分组，每组内的不同查询文本只做一次批量编码"""
+        groups: Dict[int, tuple] = {}
+        for query, embedding in requests:
+            if not query or embedding is None:
+                continue
+            model, queries = groups.setdefault(id(embedding), (embedding, []))
+            if query not in queries:
+                queries.append(query)
+        vectors = {}
+        for key, (model, queries) in groups.items():
+            try:
+                for query, vector in zip(queries, model(queries)):
+                    vectors[(key, query)] = vector
+            except Exception as e:
+                # 编码失败时不提供向量，由各集合自行编码查询
+                print(f"[RetrievalPlanner] Query embedding failed: {e}")
+        return vectors
+
+    def retrieve(self,
+                 references_query: Optional[str] = None,
+                 knowledges_query: Optional[str] = None,
+                 history_query: Optional[str] = None,
+                 history_top_k: int = 5,
+                 history_retrieve: bool = False,
+                 style_query: Optional[str] = None,
+                 style_top_k: int = 3) -> RetrievalBundle:
+        """
+        Args:
+            references_query: 角色资料检索的查询（None 表示不检索）
+            knowledges_query: 世界知识检索的查询（None 表示不检索）
+            history_query: 历史检索的查询（None 表示不检索）
+            history_top_k / history_retrieve: 同 Performer.retrieve_history
+            style_query: 风格样本检索的查询（None 表示不检索）
+        """
+        performer = self.performer
+        style_db = getattr(performer, "style_vector_db", None)
+
+        requests: Dict[str, tuple] = {}
+        if references_query is not None:
+            requests["references"] = (references_query, self._references_embedding())
+        if knowledges_query is not None:
+            requests["knowledges"] = (knowledges_query, self._knowledges_embedding())
+        if history_query is not None and history_retrieve \
+                and len(performer.history_manager) >= history_top_k:
+            # 只有语义检索历史时才需要查询向量
+            requests["history"] = (history_query, self._memory_embedding())
+        if style_query and style_db is not None:
+            requests["style"] = (style_query, getattr(style_db, "embedding", None))
+
+        bundle = RetrievalBundle(vectors=self._embed_distinct(requests.values()))
+
+        def vector(name):
+            query, embedding = requests.get(name, (None, None))
+            return bundle.vector_for(query, embedding)
+
+        tasks = {}
+        if references_query is not None:
+            tasks["references"] = lambda: performer.retrieve_references(
+                references_query, query_vector=vector("references"))
+        if knowledges_query is not None:
+            tasks["knowledges"] = lambda: performer.retrieve_knowledges(
+                knowledges_query, query_vector=vector("knowledges"))
+        if history_query is not None:
+            tasks["history"] = lambda: performer.retrieve_history(
+                history_query, top_k=history_top_k, retrieve=history_retrieve,
+                query_vector=vector("history"))
+        if "style" in requests:
+            tasks["style_examples"] = lambda: style_db.search_similar_style(
+                style_query, top_k=style_top_k, query_vector=vector("style"))
+
+        if len(tasks) <= 1:
+            results = {name: task() for name, task in tasks.items()}
+        else:
+            futures = {name: _RETRIEVAL_EXECUTOR.submit(task) for name, task in tasks.items()}
+            results = {name: future.result() for name, future in futures.items()}
+
+        for name, value in results.items():
+            setattr(bundle, name, value if value is not None else getattr(bundle, name))
+        return bundle
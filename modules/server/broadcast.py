@@ -0,0 +1,194 @@
+"""
+WebSocket 广播
+每条消息只序列化一次；每个连接有一个有界发送队列和独立的写协程，
+慢客户端只会积压自己的队列，不会拖慢房间内其他连接。
+队列满时按消息类型处理：增量消息丢弃最旧的，状态消息合并为最新一条，其余消息断开该连接。
+必须送达的消息遇到队列满时，先让出一次事件循环让写协程发送积压的消息，仍然放不下才断开；
+因此连续广播（中间没有 await）的突发上限约为队列长度（config.json 的 ws_send_queue_size）加上
+一次让出期间写协程能发出的消息数，超过的突发会断开发送跟不上的连接。
+"""
+import asyncio
+import json
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from fastapi import WebSocket
+
+from modules.server.tasks import spawn
+
+# 溢出策略
+DROP_OLDEST = "drop_oldest"   # 可丢弃：队列满时丢弃同类中最旧的一条
+COALESCE = "coalesce"         # 可合并：队列中同类消息只保留最新一条
+RELIABLE = "reliable"         # 必须送达：队列满且无法腾出空间时断开连接
+
+MESSAGE_POLICIES = {
+    "status_update": COALESCE,
+    "status_delta": DROP_OLDEST,
+    "input_timeout_warning": COALESCE,
+    "characters_updated": COALESCE,
+}
+
+DEFAULT_QUEUE_SIZE = 256
+
+
+def encode_message(data: dict) -> str:
+    """与 WebSocket.send_json 相同的编码方式"""
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+def message_policy(data: dict) -> str:
+    return MESSAGE_POLICIES.get(data.get("type"), RELIABLE)
+
+
+def message_key(data: dict) -> str:
+    """合并时用于判断“同类”消息的键：类型 + 载荷字段（完整状态与状态文本不会互相覆盖）"""
+    payload = data.get("data")
+    fields = ",".join(sorted(payload)) if isinstance(payload, dict) else ""
+    return f"{data.get('type', '')}:{fields}"
+
+
+class ClientSender:
+    """一个连接的有界发送队列 + 写协程"""
+
+    def __init__(self,
+                 websocket: WebSocket,
+                 client_id: str,
+                 on_failure: Optional[Callable[[str], Awaitable[None]]] = None,
+                 max_queue: int = DEFAULT_QUEUE_SIZE):
+        self.websocket = websocket
+        self.client_id = client_id
+        self.max_queue = max_queue
+        self._on_failure = on_failure
+        self._queue: deque = deque()   # [消息键, 策略, 文本]
+        self._wakeup = asyncio.Event()
+        self.closed = False
+        self.dropped = 0
+        self.coalesced = 0
+        self._task = asyncio.create_task(self._writer())
+
+    def __len__(self):
+        return len(self._queue)
+
+    def enqueue(self, text: str, key: str = "", policy: str = RELIABLE) -> bool:
+        """
+        放入发送队列（不等待发送）；返回 False 表示队列已满且消息必须送达，
+        调用方应断开该连接
+        """
+        if self.closed:
+            return False
+        if policy == COALESCE:
+            # 去掉尚未发送的同类旧消息，新消息排到队尾（保持与其他消息的先后顺序）
+            for i, entry in enumerate(self._queue):
+                if entry[0] == key:
+                    del self._queue[i]
+                    self.coalesced += 1
+                    break
+        if len(self._queue) >= self.max_queue and not self._make_room(policy):
+            return policy != RELIABLE
+        self._queue.append([key, policy, text])
+        self._wakeup.set()
+        return True
+
+    def _make_room(self, policy: str) -> bool:
+        """丢弃一条可丢弃的旧消息以腾出空间"""
+        for i, entry in enumerate(self._queue):
+            if entry[1] == DROP_OLDEST:
+                del self._queue[i]
+                self.dropped += 1
+                return True
+        # 新消息本身可丢弃时直接丢弃它
+        if policy != RELIABLE:
+            self.dropped += 1
+        return False
+
+    async def _writer(self):
+        try:
+            while True:
+                if not self._queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                _, _, text = self._queue.popleft()
+                await self.websocket.send_text(text)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"[Broadcast] Error sending to {self.client_id}: {e}")
+            self.closed = True
+            self._queue.clear()
+            if self._on_failure is not None:
+                await self._on_failure(self.client_id)
+
+    async def close(self):
+        self.closed = True
+        self._queue.clear()
+        # 写协程自身发送失败时会经由 on_failure 回到这里，不能等待自己
+        if not self._task.done() and self._task is not asyncio.current_task():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+class Broadcaster:
+    """一个房间内所有连接的发送器"""
+
+    def __init__(self, on_failure: Callable[[str], Awaitable[None]], max_queue: int = DEFAULT_QUEUE_SIZE):
+        self.senders: Dict[str, ClientSender] = {}
+        self.max_queue = max_queue
+        self._on_failure = on_failure
+
+    def add(self, client_id: str, websocket: WebSocket) -> ClientSender:
+        old = self.senders.get(client_id)
+        if old is not None:
+            old.closed = True
+            old._task.cancel()
+        sender = ClientSender(websocket, client_id, self._on_failure, self.max_queue)
+        self.senders[client_id] = sender
+        return sender
+
+    async def remove(self, client_id: str):
+        sender = self.senders.pop(client_id, None)
+        if sender is not None:
+            await sender.close()
+
+    async def _deliver(self, senders: List[ClientSender], data: dict) -> int:
+        text = encode_message(data)
+        key = message_key(data)
+        policy = message_policy(data)
+        if policy == RELIABLE and any(len(sender) >= sender.max_queue for sender in senders):
+            # 先让写协程有机会发送积压的消息，再判定溢出；一次性入队，保持各连接间的先后顺序
+            await asyncio.sleep(0)
+        count = 0
+        for sender in senders:
+            if sender.closed:
+                continue
+            count += 1
+            if not sender.enqueue(text, key, policy):
+                print(f"[Broadcast] Send queue of {sender.client_id} overflowed, disconnecting")
+                sender.closed = True
+                spawn(self._on_failure(sender.client_id), f"disconnect {sender.client_id}")
+        return count
+
+    async def send(self, client_id: str, data: dict) -> bool:
+        sender = self.senders.get(client_id)
+        if sender is None or sender.closed:
+            return False
+        return await self._deliver([sender], data) > 0
+
+    async def broadcast(self, data: dict, exclude: Optional[str] = None) -> int:
+        """序列化一次后放入每个连接的队列；返回投递的连接数"""
+        senders = [sender for client_id, sender in self.senders.items()
+                   if client_id != exclude and not sender.closed]
+        if not senders:
+            return 0
+        return await self._deliver(senders, data)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {client_id: {"queued": len(sender), "dropped": sender.dropped, "coalesced": sender.coalesced}
+                for client_id, sender in self.senders.items()}
+
+    async def close_all(self):
+        for client_id in list(self.senders):
+            await self.remove(client_id)
@@ -3,19 +3,48 @@ from fastapi import WebSocket
 from typing import Dict, List, Optional
 import uuid
 import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from functools import partial
 from ScrollWeaver import ScrollWeaver
+from modules.server.broadcast import Broadcaster
+from modules.server.room_status import RoomStatus
+from modules.server.timer_wheel import get_timer_wheel
+from modules.server.scheduler import get_work_scheduler, CRITICAL, INTERACTIVE, BACKGROUND
 from sw_utils import is_image, load_json_file
 
 # Load config similar to server.py
 config = load_json_file('config.json')
 default_icon_path = './frontend/assets/images/default-icon.jpg'
 
+# 预热房间在后台线程中构建，不占用事件循环
+_ROOM_POOL_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="room-pool")
+
+def resolve_preset_path(preset_path: str = None) -> str:
+    """未指定预设时按 config.json 的 preset_path / genre 选择，否则使用 soulverse 沙盒"""
+    base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if not preset_path:
+        if "preset_path" in config and config["preset_path"] and os.path.exists(config["preset_path"]):
+            preset_path = config["preset_path"]
+        elif "genre" in config and config["genre"]:
+            genre = config["genre"]
+            preset_path = os.path.join(base_dir, f"config/experiment_{genre}.json")
+        else:
+            preset_path = os.path.join(base_dir, 'experiment_presets/soulverse_sandbox.json')
+    
+    if not os.path.exists(preset_path):
+        print(f"Warning: Preset path {preset_path} does not exist. Using default.")
+        # Fallback logic could be added here
+    return preset_path
+
 class Room:
     def __init__(self, room_id: str, preset_path: str = None):
         self.room_id = room_id
         self.active_connections: Dict[str, WebSocket] = {}  # client_id -> WebSocket
+        # 每个连接一个有界发送队列 + 写协程，广播只序列化一次
+        self.broadcaster = Broadcaster(self._on_send_failure, max_queue=config.get("ws_send_queue_size", 256))
         self.story_task: Optional[asyncio.Task] = None
         
         # Room state
@@ -28,25 +57,19 @@ class Room:
         
         self.last_empty_time: Optional[datetime] = datetime.now() # Start empty
         self.conversation_ended: bool = False  # 对话是否已结束（所有用户退出）
+        self.closed: bool = False
+        # 连接/角色/关闭等变化时唤醒故事循环（在事件循环中按需创建，预热房间在后台线程构建）
+        self._changed: Optional[asyncio.Event] = None
+        # 空闲回收：房间变空时在计时轮上登记，有连接时取消；回调由 RoomManager 设置
+        self.on_idle_expired = None
+        self._idle_timer = None
         
         
         # Initialize ScrollWeaver
         self._init_scrollweaver(preset_path)
         
     def _init_scrollweaver(self, preset_path: str = None):
-        if not preset_path:
-             if "preset_path" in config and config["preset_path"] and os.path.exists(config["preset_path"]):
-                preset_path = config["preset_path"]
-             elif "genre" in config and config["genre"]:
-                genre = config["genre"]
-                preset_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), f"config/experiment_{genre}.json")
-             else:
-                preset_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 
-                                          'experiment_presets/soulverse_sandbox.json')
-        
-        if not os.path.exists(preset_path):
-             print(f"Warning: Preset path {preset_path} does not exist. Using default.")
-             # Fallback logic could be added here
+        preset_path = resolve_preset_path(preset_path)
         
         print(f"Initializing Room {self.room_id} with preset: {preset_path}")
         
@@ -56,6 +79,8 @@ class Room:
             role_llm_name=config["role_llm_name"],
             embedding_name=config["embedding_model_name"]
         )
+        # 带版本号的房间状态：只广播变化的字段，定期发送完整快照
+        self.status = RoomStatus(self.scrollweaver, snapshot_every=config.get("status_snapshot_every", 50))
         
         self.generator_config = {
             "rounds": config.get("rounds", 100) if self.scrollweaver.server.is_soulverse_mode else config.get("rounds", 10),
@@ -69,6 +94,7 @@ class Room:
     async def connect(self, websocket: WebSocket, client_id: str, user_id: str = None):
         await websocket.accept()
         self.active_connections[client_id] = websocket
+        self.broadcaster.add(client_id, websocket)
         
         # If room was empty, mark as active and resume story loop if needed
         was_empty = self.last_empty_time is not None
@@ -169,7 +195,7 @@ class Room:
                         traceback.print_exc()
                         # 通知前端需要手动恢复
                         try:
-                            await websocket.send_json({
+                            await self.send_json(client_id, {
                                 'type': 'agent_restore_needed',
                                 'data': {'role_code': role_code, 'message': 'Agent恢复失败，请重试'}
                             })
@@ -184,7 +210,7 @@ class Room:
                 print(f"[Room {self.room_id}] User {user_id} has no digital twin, cannot auto-bind")
                 # 通知前端需要创建数字孪生
                 try:
-                    await websocket.send_json({
+                    await self.send_json(client_id, {
                         'type': 'no_digital_twin',
                         'data': {'message': '请先创建数字孪生'}
                     })
@@ -198,9 +224,10 @@ class Room:
             self.user_client_map[user_id].add(client_id)
         
         # Move start_story_loop to here, AFTER agent is added
+        self._mark_active()
+        self.notify()
         if was_empty or was_conversation_ended:
             # 重置对话结束标志，恢复对话
-            self.last_empty_time = None
             self.conversation_ended = False
             print(f"[Room {self.room_id}] Client {client_id} connected, {'resuming' if was_conversation_ended else 'starting'} story loop")
             # Ensure story loop is running
@@ -213,10 +240,11 @@ class Room:
         
         if client_id in self.active_connections:
             del self.active_connections[client_id]
+        await self.broadcaster.remove(client_id)
             
         if not self.active_connections:
             # 所有用户已退出，结束对话
-            self.last_empty_time = datetime.now()
+            self._mark_empty()
             self.conversation_ended = True
             print(f"[Room {self.room_id}] All clients disconnected, conversation ended")
             # 注意：此时没有active_connections，无法广播消息
@@ -252,43 +280,96 @@ class Room:
         if client_id in self.possession_mode:
             del self.possession_mode[client_id]
         
+        self.notify()
         print(f"[Room {self.room_id}] Client {client_id} disconnected (was waiting input: {was_waiting_input})")
 
     async def broadcast_json(self, data: dict):
-        """Send JSON to all connected clients"""
+        """Send JSON to all connected clients (queued per connection, serialized once)"""
         if not self.active_connections:
             print(f"[Room {self.room_id}] Warning: broadcast_json called but no active connections")
             return
-            
-        disconnected = []
-        for cid, ws in list(self.active_connections.items()):  # Use list() to avoid modification during iteration
+        await self.broadcaster.broadcast(data)
+
+    async def send_json(self, client_id: str, data: dict):
+        """Send JSON to one client through its send queue (keeps ordering with broadcasts)"""
+        await self.broadcaster.send(client_id, data)
+
+    async def run_blocking(self, priority: int, func, *args):
+        """在共享调度器中运行阻塞调用（按本房间排队、受每房间并发上限约束）"""
+        return await get_work_scheduler().run(self.room_id, priority, func, *args)
+
+    async def broadcast_status(self):
+        """广播状态变化（增量或定期快照），没有变化时不发送"""
+        status = self.status.update()
+        if status:
+            await self.broadcast_json(status)
+
+    async def _on_send_failure(self, cid: str):
+        """发送失败或发送队列溢出的连接：关闭并清理状态（不再广播，避免递归）"""
+        ws = self.active_connections.pop(cid, None)
+        await self.broadcaster.remove(cid)
+        if ws is not None:
             try:
-                await ws.send_json(data)
-            except Exception as e:
-                print(f"[Room {self.room_id}] Error broadcasting to {cid}: {e}")
-                disconnected.append(cid)
+                await ws.close()
+            except Exception:
+                pass
+        if not self.active_connections:
+            self._mark_empty()
+        self.notify()
         
-        # Disconnect clients that failed - do this synchronously to avoid recursion
-        for cid in disconnected:
-            if cid in self.active_connections:
-                del self.active_connections[cid]
-            if not self.active_connections:
-                self.last_empty_time = datetime.now()
-            
-            # Clean up client state without async broadcast to avoid recursion
-            if cid in self.user_selected_roles:
-                del self.user_selected_roles[cid]
-            if cid in self.waiting_for_input:
-                del self.waiting_for_input[cid]
-            if cid in self.pending_user_inputs:
-                if not self.pending_user_inputs[cid].done():
-                    self.pending_user_inputs[cid].cancel()
-                del self.pending_user_inputs[cid]
-            if cid in self.possession_mode:
-                del self.possession_mode[cid]
+        if cid in self.user_selected_roles:
+            del self.user_selected_roles[cid]
+        if cid in self.waiting_for_input:
+            del self.waiting_for_input[cid]
+        if cid in self.pending_user_inputs:
+            if not self.pending_user_inputs[cid].done():
+                self.pending_user_inputs[cid].cancel()
+            del self.pending_user_inputs[cid]
+        if cid in self.possession_mode:
+            del self.possession_mode[cid]
+
+    def notify(self):
+        """房间状态变化（连接加入/离开、添加角色、关闭），唤醒等待中的故事循环"""
+        if self._changed is not None:
+            self._changed.set()
+
+    async def _wait_until(self, predicate):
+        """等待 predicate() 为真；期间不轮询，只在 notify() 时重新检查"""
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        while not predicate():
+            self._changed.clear()
+            await self._changed.wait()
+
+    def _mark_empty(self):
+        """房间变空：记录时间并在计时轮上登记空闲回收"""
+        self.last_empty_time = datetime.now()
+        if self.on_idle_expired is None or self._idle_timer is not None:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._idle_timer = get_timer_wheel().schedule(
+            config.get("room_idle_timeout", 600), self._idle_expired)
+
+    def _mark_active(self):
+        self.last_empty_time = None
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    async def _idle_expired(self):
+        self._idle_timer = None
+        if self.active_connections or self.closed or self.on_idle_expired is None:
+            return
+        await self.on_idle_expired(self)
 
     async def cleanup(self):
         """Cleanup room resources"""
+        self.closed = True
+        self._mark_active()
+        self.notify()
         if self.story_task:
             self.story_task.cancel()
             try:
@@ -296,9 +377,15 @@ class Room:
             except asyncio.CancelledError:
                 pass
         
+        await self.broadcaster.close_all()
         for cid in list(self.active_connections.keys()):
             await self.active_connections[cid].close()
             del self.active_connections[cid]
+        # 房间删除前把各向量库缓冲中的写入落盘
+        try:
+            await self.run_blocking(BACKGROUND, self.scrollweaver.flush_dbs)
+        except Exception as e:
+            print(f"[Room {self.room_id}] Error flushing databases: {e}")
 
     # ... Include logic from ConnectionManager but adapted for Room ...
     # Specifically, generate_story should loop and broadcast
@@ -326,7 +413,6 @@ class Room:
         
         max_attempts = 10
         attempts = 0
-        loop = asyncio.get_running_loop()
 
         while attempts < max_attempts:
             try:
@@ -394,7 +480,7 @@ class Room:
                 # 只有在同步成功后才执行消息生成
                 if sync_success:
                     try:
-                        message = await loop.run_in_executor(None, self.scrollweaver.generate_next_message)
+                        message = await self.run_blocking(CRITICAL, self.scrollweaver.generate_next_message)
                     except RuntimeError as e:
                         # Python 3.7+ wraps StopIteration in RuntimeError when raised from generator in executor
                         if "StopIteration" in str(e) or isinstance(e.__cause__, StopIteration):
@@ -513,9 +599,10 @@ class Room:
             text = message.get("text", "").strip()
             if text == "__USER_INPUT_PLACEHOLDER__":
                 message["is_placeholder"] = True
-                status = self.scrollweaver.get_current_status()
+                # 占位消息不会广播，本回合的状态变化在这里直接发出（update() 只能在会广播结果的地方调用）
+                await self.broadcast_status()
                 print(f"[Room {self.room_id}] get_next_message: got placeholder for user input")
-                return message, status
+                return message, None
             
             if not text:
                 print(f"[Room {self.room_id}] get_next_message: message text is empty (attempt {attempts + 1}/{max_attempts})")
@@ -525,7 +612,7 @@ class Room:
             if not os.path.exists(message.get("icon", "")) or not is_image(message.get("icon", "")):
                 message["icon"] = default_icon_path
             
-            status = self.scrollweaver.get_current_status()
+            status = self.status.update()
             print(f"[Room {self.room_id}] get_next_message: returning message with text length {len(text)}")
             return message, status
         
@@ -601,11 +688,7 @@ class Room:
                     'type': 'message',
                     'data': message
                 })
-                status = self.scrollweaver.get_current_status()
-                await self.broadcast_json({
-                    'type': 'status_update',
-                    'data': status
-                })
+                await self.broadcast_status()
         except Exception as e:
             print(f"Error handling user role input: {e}")
 
@@ -667,7 +750,6 @@ class Room:
             
             # 生成多个选项
             options = []
-            loop = asyncio.get_running_loop()
             
             for i, config in enumerate(style_configs[:num_options]):
                 max_retries = 3  # 每个选项最多重试3次
@@ -677,7 +759,7 @@ class Room:
                 while retry_count < max_retries and not success:
                     try:
                         # 调用Performer的plan_with_style方法生成行动，传入风格提示和温度
-                        # 使用 run_in_executor 在单独的线程中执行阻塞的 LLM 调用
+                        # 经调度器在线程池中执行阻塞的 LLM 调用（用户请求的选项，低于回合关键路径）
                         # 使用 partial 避免闭包问题
                         plan_func = partial(
                             performer.plan_with_style,
@@ -688,7 +770,7 @@ class Room:
                             style_hint=config['style_hint'],
                             temperature=config['temperature']
                         )
-                        plan = await loop.run_in_executor(None, plan_func)
+                        plan = await self.run_blocking(INTERACTIVE, plan_func)
                         
                         detail = plan.get("detail", "")
                         # 检查detail是否为空或只包含空白字符
@@ -739,9 +821,10 @@ class Room:
                     'type': 'error',
                     'data': {'message': 'Waiting for characters...'}
                 })
-                 # Wait a bit or exit loop? Let's check periodically or wait for an event?
-                 # For now, just exit and let 'start_story_loop' be called again when agents are added
-                 return
+                 # 等待添加角色（add_user_agent / add_npc_agent 之后会 notify）
+                 await self._wait_until(lambda: self.scrollweaver.server.role_codes or self.conversation_ended or self.closed)
+                 if not self.scrollweaver.server.role_codes:
+                     return
             
             print(f"[Room {self.room_id}] Story loop started with {len(self.scrollweaver.server.role_codes)} roles: {list(self.scrollweaver.server.role_codes)}")
 
@@ -758,22 +841,19 @@ class Room:
                     else:
                         # Room is empty but conversation not ended - pause story loop to save resources
                         print(f"[Room {self.room_id}] No active connections, pausing story loop")
-                        self.last_empty_time = datetime.now()
+                        self._mark_empty()
                         
-                        # Wait for connections with periodic checks
-                        empty_check_interval = 5  # Check every 5 seconds
-                        while not self.active_connections and not self.conversation_ended:
-                            await asyncio.sleep(empty_check_interval)
-                            # Check if room should be cleaned up (handled by RoomManager cleanup loop)
+                        # 等待连接加入（connect 中 notify），空闲回收由计时轮处理
+                        await self._wait_until(lambda: self.active_connections or self.conversation_ended or self.closed)
                         
                         # 如果对话已结束，退出循环
-                        if self.conversation_ended:
+                        if self.conversation_ended or self.closed:
                             print(f"[Room {self.room_id}] Conversation ended during pause, stopping story loop")
                             break
                         
                         # Connections restored - resume story loop
                         print(f"[Room {self.room_id}] Active connections restored, resuming story loop")
-                        self.last_empty_time = None
+                        self._mark_active()
                         self.conversation_ended = False  # 重置标志
                         continue
 
@@ -896,11 +976,10 @@ class Room:
                         try:
                             performer = self.scrollweaver.server.performers.get(current_role_code)
                             if performer:
-                                loop = asyncio.get_running_loop()
                                 try:
-                                    ai_interaction = await loop.run_in_executor(
-                                        None,
-                                        lambda: performer.single_role_interact(current_role_code, username, "（用户已断开，AI自动回复）", "")
+                                    ai_interaction = await self.run_blocking(
+                                        CRITICAL,
+                                        performer.single_role_interact, current_role_code, username, "（用户已断开，AI自动回复）", ""
                                     )
                                     ai_text = None
                                     if isinstance(ai_interaction, dict):
@@ -944,7 +1023,7 @@ class Room:
                     ws = self.active_connections.get(controlling_client_id)
                     if ws:
                          # Send exclusive request to this user
-                         await ws.send_json({
+                         await self.send_json(controlling_client_id, {
                             'type': 'waiting_for_user_input',
                             'data': {
                                 'role_name': username,
@@ -955,6 +1034,7 @@ class Room:
                          self.waiting_for_input[controlling_client_id] = True
                          future = asyncio.Future()
                          self.pending_user_inputs[controlling_client_id] = future
+                         input_timers = []
 
                          # Notify others? "Waiting for X..."
                          await self.broadcast_json_except(controlling_client_id, {
@@ -969,7 +1049,7 @@ class Room:
                              # Other clients should NOT enter input mode
                              try:
                                  deadline = (datetime.utcnow() + timedelta(seconds=timeout)).isoformat() + 'Z'
-                                 await ws.send_json({
+                                 await self.send_json(controlling_client_id, {
                                      'type': 'input_countdown_start',
                                      'data': {
                                          'role_name': username,
@@ -986,24 +1066,14 @@ class Room:
                              except Exception:
                                  pass
 
-                             # Start timeout reminder task
-                             reminder_task = None
-                             try:
-                                 reminder_task = asyncio.create_task(
-                                     self._send_timeout_reminders(controlling_client_id, timeout, future)
-                                 )
-                             except Exception as e:
-                                 print(f"Error starting timeout reminder task: {e}")
+                             # 超时提醒和超时都登记在计时轮上，用户回复后取消
+                             input_timers = self._schedule_input_timers(controlling_client_id, timeout, future)
 
-                             user_input_result = await asyncio.wait_for(future, timeout=timeout)
+                             user_input_result = await future
                              
-                             # Cancel reminder task if user responded
-                             if reminder_task and not reminder_task.done():
-                                 reminder_task.cancel()
-                                 try:
-                                     await reminder_task
-                                 except asyncio.CancelledError:
-                                     pass
+                             # Cancel reminders if user responded
+                             for timer in input_timers:
+                                 timer.cancel()
                              if isinstance(user_input_result, tuple):
                                  user_text, is_echoed = user_input_result
                              else:
@@ -1066,13 +1136,6 @@ class Room:
 
                          except asyncio.TimeoutError:
                              # User did not respond in time. Notify room and skip.
-                             # Cancel reminder task if still running
-                             if reminder_task and not reminder_task.done():
-                                 reminder_task.cancel()
-                                 try:
-                                     await reminder_task
-                                 except asyncio.CancelledError:
-                                     pass
                              
                              try:
                                  await self.broadcast_json({
@@ -1105,23 +1168,15 @@ class Room:
                                      performer = None
 
                                  if performer:
-                                     loop = asyncio.get_running_loop()
-                                     # Run the potentially blocking LLM call in a threadpool
-                                     try:
-                                         ai_interaction = await loop.run_in_executor(
-                                             None,
-                                             performer.single_role_interact,
-                                             current_role_code,
-                                             username,
-                                             "（用户超时，AI代替回复）",
-                                             ""
-                                         )
-                                     except TypeError:
-                                         # Fallback if run_in_executor with args not accepted: use lambda
-                                         ai_interaction = await loop.run_in_executor(
-                                             None,
-                                             lambda: performer.single_role_interact(current_role_code, username, "（用户超时，AI代替回复）", "")
-                                         )
+                                     # Run the potentially blocking LLM call on the room's critical path
+                                     ai_interaction = await self.run_blocking(
+                                         CRITICAL,
+                                         performer.single_role_interact,
+                                         current_role_code,
+                                         username,
+                                         "（用户超时，AI代替回复）",
+                                         ""
+                                     )
 
                                      ai_text = None
                                      if isinstance(ai_interaction, dict):
@@ -1160,11 +1215,7 @@ class Room:
                                              }
                                              await self.broadcast_json({'type': 'message', 'data': timeout_msg})
                                              
-                                             status = self.scrollweaver.get_current_status()
-                                             await self.broadcast_json({
-                                                 'type': 'status_update',
-                                                 'data': status
-                                             })
+                                             await self.broadcast_status()
                                          except Exception as e:
                                              print(f"[Room {self.room_id}] Error broadcasting AI replacement input: {e}")
                                              import traceback
@@ -1178,6 +1229,8 @@ class Room:
                          except Exception as e:
                              print(f"Error handling user input: {e}")
                          finally:
+                             for timer in input_timers:
+                                 timer.cancel()
                              self.waiting_for_input[controlling_client_id] = False
                              if controlling_client_id in self.pending_user_inputs:
                                  del self.pending_user_inputs[controlling_client_id]
@@ -1215,7 +1268,7 @@ class Room:
                         
                         await self.broadcast_json({'type': 'message', 'data': message})
                         if status:
-                             await self.broadcast_json({'type': 'status_update', 'data': status})
+                             await self.broadcast_json(status)
                         await asyncio.sleep(0.2)
 
         except asyncio.CancelledError:
@@ -1264,76 +1317,117 @@ class Room:
                     return
 
     async def broadcast_json_except(self, excluded_cid: str, data: dict):
-        for cid, ws in self.active_connections.items():
-            if cid != excluded_cid:
-                try:
-                    await ws.send_json(data)
-                except:
-                    pass
+        await self.broadcaster.broadcast(data, exclude=excluded_cid)
 
-    async def _send_timeout_reminders(self, client_id: str, timeout: int, future: asyncio.Future):
-        """发送超时提醒消息"""
+    def _schedule_input_timers(self, client_id: str, timeout: int, future: asyncio.Future) -> list:
+        """在计时轮上登记超时提醒和输入超时（超时时 future 以 TimeoutError 结束）"""
+        wheel = get_timer_wheel()
         reminder_intervals = config.get('user_input_timeout_reminder_intervals', [30, 15, 10])
         warning_seconds = config.get('user_input_timeout_warning_seconds', 10)
-        
-        for reminder_seconds in sorted(reminder_intervals, reverse=True):
-            if reminder_seconds >= timeout:
+        timers = []
+        for reminder_seconds in sorted(set(reminder_intervals), reverse=True):
+            if reminder_seconds >= timeout or reminder_seconds == warning_seconds:
                 continue
-            
-            try:
-                await asyncio.sleep(timeout - reminder_seconds)
-                
-                # 检查future是否已完成
-                if future.done():
-                    return
-                
-                # 检查客户端是否仍然连接
-                if client_id not in self.active_connections:
-                    return
-                
-                ws = self.active_connections.get(client_id)
-                if ws:
-                    await ws.send_json({
-                        'type': 'input_timeout_warning',
-                        'data': {
-                            'remaining_seconds': reminder_seconds,
-                            'message': f'还剩 {reminder_seconds} 秒，超时后将自动使用AI回复'
-                        }
-                    })
-            except asyncio.CancelledError:
-                return
-            except Exception as e:
-                print(f"Error sending timeout reminder: {e}")
-        
+            timers.append(wheel.schedule(timeout - reminder_seconds, self._send_timeout_warning,
+                                         client_id, future, reminder_seconds, False))
         # 最后发送一次警告（当剩余时间≤warning_seconds时）
         if warning_seconds < timeout:
-            try:
-                await asyncio.sleep(timeout - warning_seconds)
-                
-                if future.done():
-                    return
-                
-                if client_id not in self.active_connections:
-                    return
-                
-                ws = self.active_connections.get(client_id)
-                if ws:
-                    await ws.send_json({
-                        'type': 'input_timeout_warning',
-                        'data': {
-                            'remaining_seconds': warning_seconds,
-                            'message': f'⚠️ 还剩 {warning_seconds} 秒！超时后将自动使用AI回复',
-                            'urgent': True
-                        }
-                    })
-            except asyncio.CancelledError:
+            timers.append(wheel.schedule(timeout - warning_seconds, self._send_timeout_warning,
+                                         client_id, future, warning_seconds, True))
+        timers.append(wheel.schedule(timeout, self._expire_input, future))
+        return timers
+
+    @staticmethod
+    def _expire_input(future: asyncio.Future):
+        if not future.done():
+            future.set_exception(asyncio.TimeoutError())
+
+    async def _send_timeout_warning(self, client_id: str, future: asyncio.Future, remaining_seconds: int, urgent: bool):
+        """发送超时提醒消息"""
+        if future.done() or client_id not in self.active_connections:
+            return
+        try:
+            if urgent:
+                data = {
+                    'remaining_seconds': remaining_seconds,
+                    'message': f'⚠️ 还剩 {remaining_seconds} 秒！超时后将自动使用AI回复',
+                    'urgent': True
+                }
+            else:
+                data = {
+                    'remaining_seconds': remaining_seconds,
+                    'message': f'还剩 {remaining_seconds} 秒，超时后将自动使用AI回复'
+                }
+            await self.send_json(client_id, {'type': 'input_timeout_warning', 'data': data})
+        except Exception as e:
+            print(f"Error sending timeout reminder: {e}")
+
+class RoomPool:
+    """
+    预热房间池：按预设在后台线程中预先构建 Room（ScrollWeaver 初始化是阻塞的），
+    创建房间时直接取出一个并改名，再在后台补齐。
+    只为默认预设和 presets 中列出的预设预热（每个预热房间都常驻内存），其他预设的房间按需同步构建。
+    """
+
+    def __init__(self, size: int = 2, presets: List[str] = None):
+        self.size = size
+        self._warm = {os.path.abspath(resolve_preset_path(None))}
+        self._warm.update(os.path.abspath(path) for path in presets or [])
+        self._rooms: Dict[str, deque] = {}   # 预设路径 -> 预热好的 Room
+        self._building: Dict[str, int] = {}  # 预设路径 -> 正在构建的数量
+        self._lock = threading.Lock()
+
+    def warms(self, preset_path: str = None) -> bool:
+        return os.path.abspath(resolve_preset_path(preset_path)) in self._warm
+
+    def acquire(self, room_id: str, preset_path: str = None) -> Optional[Room]:
+        """取出一个预热房间（没有时返回 None），并在后台补齐该预设的池"""
+        key = resolve_preset_path(preset_path)
+        with self._lock:
+            rooms = self._rooms.get(key)
+            room = rooms.popleft() if rooms else None
+        self.refill(key)
+        if room is not None:
+            room.room_id = room_id
+            room.last_empty_time = datetime.now()
+            print(f"[RoomPool] Handed out warm room for {room_id} ({key})")
+        return room
+
+    def refill(self, preset_path: str = None):
+        if self.size <= 0 or not self.warms(preset_path):
+            return
+        key = resolve_preset_path(preset_path)
+        with self._lock:
+            missing = self.size - len(self._rooms.get(key, ())) - self._building.get(key, 0)
+            if missing <= 0:
                 return
-            except Exception as e:
-                print(f"Error sending final timeout warning: {e}")
+            self._building[key] = self._building.get(key, 0) + missing
+        for _ in range(missing):
+            _ROOM_POOL_EXECUTOR.submit(self._build, key)
+
+    def _build(self, key: str):
+        room = None
+        try:
+            room = Room(f"pool-{uuid.uuid4().hex[:8]}", key)
+        except Exception as e:
+            print(f"[RoomPool] Error building warm room for {key}: {e}")
+        finally:
+            with self._lock:
+                self._building[key] -= 1
+                if room is not None:
+                    self._rooms.setdefault(key, deque()).append(room)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {key: {"ready": len(rooms), "building": self._building.get(key, 0)}
+                    for key, rooms in self._rooms.items()}
 
 class RoomManager:
-    def __init__(self):
+    def __init__(self, pool_size: int = None):
         self._rooms: Dict[str, Room] = {}
+        if pool_size is None:
+            pool_size = config.get("room_pool_size", 2)
+        self._pool = RoomPool(pool_size, config.get("room_pool_presets", []))
         
     def get_room(self, room_id: str) -> Optional[Room]:
         return self._rooms.get(room_id)
@@ -1344,9 +1438,20 @@ class RoomManager:
         if room_id in self._rooms:
             return self._rooms[room_id]
             
-        room = Room(room_id, preset_path)
+        # 优先使用预热好的房间，池为空时同步构建
+        room = self._pool.acquire(room_id, preset_path) or Room(room_id, preset_path)
         self._rooms[room_id] = room
+        # 默认房间常驻；其他房间空闲超时后由计时轮回收
+        if room_id != "default":
+            room.on_idle_expired = self._expire_room
+            if not room.active_connections:
+                room._mark_empty()
         return room
+
+    async def _expire_room(self, room: Room):
+        if self._rooms.get(room.room_id) is room and not room.active_connections:
+            print(f"Cleaning up inactive room {room.room_id}")
+            await self.delete_room(room.room_id)
     
     async def delete_room(self, room_id: str):
         if room_id in self._rooms:
@@ -1357,36 +1462,5 @@ class RoomManager:
         return self.create_room("default")
         
     async def start_cleanup_task(self):
-        """Start the background cleanup loop"""
-        asyncio.create_task(self._cleanup_loop())
-        
-    async def _cleanup_loop(self):
-        print("Starting RoomManager cleanup loop")
-        while True:
-            try:
-                await asyncio.sleep(60) # Check every minute
-                now = datetime.now()
-                ids_to_delete = []
-                
-                # Check for inactive rooms
-                for rid, room in list(self._rooms.items()):
-                    if rid == "default": continue # Keep default room? Or clean it too? 
-                    # Let's keep default room for convenience, or maybe clean it if using resources.
-                    # Usually default room is persistent entry point.
-                    
-                    if not room.active_connections:
-                        if room.last_empty_time:
-                             elapsed = (now - room.last_empty_time).total_seconds()
-                             if elapsed > 600: # 10 minutes
-                                  ids_to_delete.append(rid)
-                        else:
-                             # Should have been set in disconnect, but if created and never connected:
-                             room.last_empty_time = now
-                
-                for rid in ids_to_delete:
-                    print(f"Cleaning up inactive room {rid}")
-                    await self.delete_room(rid)
-                    
-            except Exception as e:
-                print(f"Error in cleanup loop: {e}")
-                await asyncio.sleep(60)
+        """启动时预热默认预设的房间池（空闲房间的回收由计时轮按房间触发，不再定期扫描）"""
+        self._pool.refill()
@@ -0,0 +1,69 @@
+"""
+房间状态（带版本号）
+只记录会随模拟变化的字段（分组、地点、事件、每个角色的位置/状态/心情/能量），
+每次变化版本号加一并广播增量 status_delta；每隔若干版本以及客户端请求时发送完整快照 status_update。
+客户端收到的增量 base_version 与本地版本不一致时（增量在发送队列中被丢弃）应发送 request_status 重新同步。
+"""
+from typing import Any, Dict, Optional
+
+DEFAULT_SNAPSHOT_EVERY = 50
+
+
+def diff_fields(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    """new 中与 old 不同的字段"""
+    return {key: value for key, value in new.items() if old.get(key) != value}
+
+
+class RoomStatus:
+    def __init__(self, scrollweaver, snapshot_every: int = DEFAULT_SNAPSHOT_EVERY):
+        self.scrollweaver = scrollweaver
+        self.snapshot_every = max(1, snapshot_every)
+        self.version = 0
+        self._state: Dict[str, Any] = {}
+
+    def _advance(self) -> Optional[Dict[str, Any]]:
+        """读取当前状态；有变化时版本号加一并返回增量内容，否则返回 None"""
+        state = self.scrollweaver.get_status_state()
+        if state == self._state:
+            return None
+        old_characters = self._state.get('characters', {})
+        new_characters = state['characters']
+        changes = diff_fields({k: v for k, v in self._state.items() if k != 'characters'},
+                              {k: v for k, v in state.items() if k != 'characters'})
+        characters = {}
+        for code, fields in new_characters.items():
+            changed = diff_fields(old_characters.get(code, {}), fields)
+            if changed:
+                characters[code] = changed
+        removed = [code for code in old_characters if code not in new_characters]
+        self._state = state
+        self.version += 1
+        return {'changes': changes, 'characters': characters, 'removed': removed}
+
+    def snapshot(self) -> dict:
+        """
+        完整状态（含角色档案），附带当前版本号。
+        不推进版本：尚未广播的变化会随下一条增量到达，增量只是字段赋值，重复应用无害，
+        这样单个客户端请求快照不会让其他客户端的版本对不上
+        """
+        return self._full_status()
+
+    def _full_status(self) -> dict:
+        status = self.scrollweaver.get_current_status()
+        status['version'] = self.version
+        return {'type': 'status_update', 'data': status}
+
+    def update(self) -> Optional[dict]:
+        """
+        状态有变化时返回要广播的消息：通常为增量，版本号到达快照间隔时为完整快照；
+        没有变化时返回 None
+        """
+        base_version = self.version
+        delta = self._advance()
+        if delta is None:
+            return None
+        if self.version % self.snapshot_every == 0:
+            return self._full_status()
+        delta['version'] = self.version
+        delta['base_version'] = base_version
+        return {'type': 'status_delta', 'data': delta}
@@ -0,0 +1,218 @@
+"""
+阻塞任务调度
+房间内的 LLM 调用（生成器步进、AI 代答、行动选项等）不再共用默认线程池，而是经过统一的调度层：
+- 优先级：回合关键路径 > 用户请求的选项 > 报告类后台任务，高优先级先派发，且为关键路径预留线程
+- 公平性：同一优先级内按房间做加权公平排队（起始时间公平排队 SFQ），刷选项的房间只会排在自己后面
+- 并发上限：每个房间同时运行的任务数有上限，非关键任务至少给关键路径留出一个名额
+线程池只接收已派发的任务，排队顺序完全由调度器决定；调度状态只在事件循环中修改。
+"""
+import sys
+sys.path.append("../")
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+
+from sw_utils import load_json_file
+
+# 优先级（数值越小越先派发）
+CRITICAL = 0      # 回合关键路径：生成器步进、超时/断线时的 AI 代答
+INTERACTIVE = 1   # 用户主动请求：行动选项、数字孪生画像、匹配
+BACKGROUND = 2    # 报告、统计等可延后的任务
+PRIORITY_NAMES = {CRITICAL: "critical", INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+DEFAULT_WORKERS = 16
+DEFAULT_ROOM_CONCURRENCY = 3
+WAIT_SAMPLES = 1024
+
+
+def _call(func: Callable) -> Any:
+    try:
+        return func()
+    except StopIteration as e:
+        # StopIteration 不能设置到 asyncio.Future 上，转为 RuntimeError（调用方据 __cause__ 判断生成器结束）
+        raise RuntimeError("StopIteration raised in scheduled work") from e
+
+
+class _Job:
+    __slots__ = ("room", "priority", "func", "future", "start_tag", "enqueued_at")
+
+    def __init__(self, room: str, priority: int, func: Callable, future: asyncio.Future, start_tag: float):
+        self.room = room
+        self.priority = priority
+        self.func = func
+        self.future = future
+        self.start_tag = start_tag
+        self.enqueued_at = time.monotonic()
+
+
+class _RoomState:
+    __slots__ = ("weight", "running", "queued", "finish_tags")
+
+    def __init__(self, weight: float = 1.0):
+        self.weight = weight
+        self.running = 0
+        self.queued = 0
+        self.finish_tags = [0.0] * len(PRIORITY_NAMES)   # 每个优先级上一个任务的虚拟完成时间
+
+
+class WorkScheduler:
+    def __init__(self, max_workers: int = DEFAULT_WORKERS, room_concurrency: int = DEFAULT_ROOM_CONCURRENCY,
+                 critical_reserve: Optional[int] = None):
+        self.max_workers = max(1, max_workers)
+        self.room_concurrency = max(1, room_concurrency)
+        # 非关键任务最多占用 max_workers - critical_reserve 个线程
+        if critical_reserve is None:
+            critical_reserve = max(1, self.max_workers // 4)
+        self.critical_reserve = min(critical_reserve, self.max_workers - 1)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="room-work")
+        self._queues: List[list] = [[] for _ in PRIORITY_NAMES]
+        self._vtime = [0.0] * len(PRIORITY_NAMES)
+        self._seq = itertools.count()
+        self._rooms: Dict[str, _RoomState] = {}
+        self._weights: Dict[str, float] = {}
+        self._running = [0] * len(PRIORITY_NAMES)
+        self._waits = [deque(maxlen=WAIT_SAMPLES) for _ in PRIORITY_NAMES]
+        self._completed = [0] * len(PRIORITY_NAMES)
+
+    def set_weight(self, room: str, weight: float):
+        """房间权重（默认 1）：权重为 2 的房间在争用时获得两倍的派发份额"""
+        self._weights[room] = max(0.01, weight)
+        if room in self._rooms:
+            self._rooms[room].weight = self._weights[room]
+
+    def _room(self, room: str) -> _RoomState:
+        state = self._rooms.get(room)
+        if state is None:
+            state = _RoomState(self._weights.get(room, 1.0))
+            self._rooms[room] = state
+        return state
+
+    async def run(self, room: str, priority: int, func: Callable, *args, **kwargs) -> Any:
+        """在调度器的线程池中运行 func(*args, **kwargs)，按房间和优先级排队"""
+        loop = asyncio.get_running_loop()
+        state = self._room(room)
+        # SFQ：起始标签 = max(当前虚拟时间, 该房间同优先级上一个任务的完成标签)
+        start_tag = max(self._vtime[priority], state.finish_tags[priority])
+        state.finish_tags[priority] = start_tag + 1.0 / state.weight
+        job = _Job(room, priority, partial(func, *args, **kwargs) if args or kwargs else func,
+                   loop.create_future(), start_tag)
+        state.queued += 1
+        heapq.heappush(self._queues[priority], (start_tag, next(self._seq), job))
+        self._dispatch()
+        try:
+            return await job.future
+        finally:
+            # 调用方取消时，尚未派发的任务会在派发时被跳过
+            if not job.future.done():
+                job.future.cancel()
+
+    def _room_full(self, job: _Job) -> bool:
+        limit = self.room_concurrency if job.priority == CRITICAL else max(1, self.room_concurrency - 1)
+        return self._rooms[job.room].running >= limit
+
+    def _pick(self) -> Optional[_Job]:
+        busy = sum(self._running)
+        for priority, heap in enumerate(self._queues):
+            if priority != CRITICAL and busy >= self.max_workers - self.critical_reserve:
+                break
+            skipped = []
+            chosen = None
+            while heap:
+                entry = heapq.heappop(heap)
+                job = entry[-1]
+                if job.future.done():
+                    self._release(job.room, queued=True)
+                    continue
+                if self._room_full(job):
+                    skipped.append(entry)
+                    continue
+                chosen = job
+                break
+            for entry in skipped:
+                heapq.heappush(heap, entry)
+            if chosen is not None:
+                return chosen
+        return None
+
+    def _dispatch(self):
+        while sum(self._running) < self.max_workers:
+            job = self._pick()
+            if job is None:
+                return
+            state = self._rooms[job.room]
+            state.queued -= 1
+            state.running += 1
+            self._running[job.priority] += 1
+            self._vtime[job.priority] = max(self._vtime[job.priority], job.start_tag)
+            self._waits[job.priority].append(time.monotonic() - job.enqueued_at)
+            work = asyncio.get_running_loop().run_in_executor(self._executor, _call, job.func)
+            work.add_done_callback(partial(self._finish, job))
+
+    def _finish(self, job: _Job, work: asyncio.Future):
+        self._running[job.priority] -= 1
+        self._completed[job.priority] += 1
+        self._release(job.room, queued=False)
+        if not job.future.done():
+            if work.cancelled():
+                job.future.cancel()
+            elif work.exception() is not None:
+                job.future.set_exception(work.exception())
+            else:
+                job.future.set_result(work.result())
+        self._dispatch()
+
+    def _release(self, room: str, queued: bool):
+        state = self._rooms.get(room)
+        if state is None:
+            return
+        if queued:
+            state.queued -= 1
+        else:
+            state.running -= 1
+        # 空闲房间不保留状态；重新出现时从当前虚拟时间开始，不会因过去的空闲而获得额外份额
+        if state.running == 0 and state.queued == 0:
+            del self._rooms[room]
+
+    def stats(self) -> Dict[str, Any]:
+        """队列深度与排队等待时间（最近 WAIT_SAMPLES 个样本，毫秒）"""
+        priorities = {}
+        for priority, name in PRIORITY_NAMES.items():
+            waits = sorted(self._waits[priority])
+            priorities[name] = {
+                "queued": sum(1 for entry in self._queues[priority] if not entry[-1].future.done()),
+                "running": self._running[priority],
+                "completed": self._completed[priority],
+                "wait_p50_ms": round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0,
+                "wait_p95_ms": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+                "wait_max_ms": round(waits[-1] * 1000, 1) if waits else 0.0,
+            }
+        return {
+            "workers": self.max_workers,
+            "room_concurrency": self.room_concurrency,
+            "critical_reserve": self.critical_reserve,
+            "running": sum(self._running),
+            "priorities": priorities,
+            "rooms": {room: {"queued": state.queued, "running": state.running, "weight": state.weight}
+                      for room, state in self._rooms.items()},
+        }
+
+
+_SCHEDULER: Optional[WorkScheduler] = None
+
+
+def get_work_scheduler() -> WorkScheduler:
+    """进程内共享的调度器，线程数与每房间并发上限取自 config.json"""
+    global _SCHEDULER
+    if _SCHEDULER is None:
+        try:
+            config = load_json_file('config.json')
+        except Exception:
+            config = {}
+        _SCHEDULER = WorkScheduler(max_workers=config.get("scheduler_workers", DEFAULT_WORKERS),
+                                   room_concurrency=config.get("room_concurrency", DEFAULT_ROOM_CONCURRENCY))
+    return _SCHEDULER
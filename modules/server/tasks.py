@@ -0,0 +1,26 @@
+"""
+后台协程任务
+事件循环对任务只持有弱引用，不保存引用的 create_task 可能在运行中被回收，异常也无人记录。
+这里统一保存这些任务的引用，任务结束时移除并打印异常。
+"""
+import asyncio
+from typing import Coroutine, Set
+
+_TASKS: Set[asyncio.Task] = set()
+
+
+def _on_done(description: str, task: asyncio.Task):
+    _TASKS.discard(task)
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        print(f"[Tasks] {description} failed: {exc!r}")
+
+
+def spawn(coro: Coroutine, description: str = "background task") -> asyncio.Task:
+    """在当前事件循环中运行 coro，保留任务引用直到结束（必须在事件循环中调用）"""
+    task = asyncio.create_task(coro)
+    _TASKS.add(task)
+    task.add_done_callback(lambda done: _on_done(description, done))
+    return task
@@ -0,0 +1,142 @@
+"""
+计时轮
+所有房间的输入超时、超时提醒和空闲房间回收共用一个计时轮和一个驱动协程，
+不再为每个等待输入的客户端或每个房间各开一个 sleep 协程/轮询循环。
+没有定时器时驱动协程阻塞在事件上，不占用 CPU；有定时器时只在最近一个到期的刻度醒来。
+"""
+import asyncio
+import math
+from typing import Callable, List, Optional, Set
+
+from modules.server.tasks import spawn
+
+DEFAULT_TICK = 1.0     # 秒；定时器向上取整到刻度，不会提前触发
+DEFAULT_SLOTS = 512
+
+
+class TimerHandle:
+    __slots__ = ("due", "callback", "args", "cancelled", "_wheel")
+
+    def __init__(self, wheel: "TimerWheel", due: int, callback: Callable, args: tuple):
+        self._wheel = wheel
+        self.due = due
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self._wheel._discard(self)
+
+
+class TimerWheel:
+    """
+    哈希计时轮：刻度 t 的定时器放在 slots[t % len(slots)]，
+    超过一圈的定时器留在槽中，直到刻度到达其 due 才触发
+    """
+
+    def __init__(self, tick: float = DEFAULT_TICK, slots: int = DEFAULT_SLOTS):
+        self.tick = tick
+        self._slots: List[Set[TimerHandle]] = [set() for _ in range(slots)]
+        self._count = 0
+        self._current = 0          # 已处理到的刻度
+        self._origin: Optional[float] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return self._count
+
+    def _now_tick(self) -> int:
+        return int((asyncio.get_running_loop().time() - self._origin) / self.tick)
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._origin = asyncio.get_running_loop().time() - self._current * self.tick
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def schedule(self, delay: float, callback: Callable, *args) -> TimerHandle:
+        """
+        delay 秒后在事件循环中调用 callback(*args)；协程函数会作为任务运行。
+        必须在事件循环中调用。
+        """
+        self._ensure_running()
+        # 当前刻度可能已过去了一部分，多加一个刻度保证不早于 delay
+        due = max(self._now_tick(), self._current) + math.ceil(max(0.0, delay) / self.tick) + 1
+        handle = TimerHandle(self, due, callback, args)
+        self._slots[due % len(self._slots)].add(handle)
+        self._count += 1
+        self._wakeup.set()
+        return handle
+
+    def _discard(self, handle: TimerHandle):
+        slot = self._slots[handle.due % len(self._slots)]
+        if handle in slot:
+            slot.discard(handle)
+            self._count -= 1
+
+    def _next_due(self) -> int:
+        """最近一个到期刻度；一圈内没有时返回一圈之后（届时重新计算）"""
+        size = len(self._slots)
+        for offset in range(1, size + 1):
+            tick = self._current + offset
+            for handle in self._slots[tick % size]:
+                if handle.due == tick:
+                    return tick
+        return self._current + size
+
+    def _advance(self, now_tick: int):
+        """触发 (current, now_tick] 之间到期的定时器"""
+        size = len(self._slots)
+        end = min(now_tick, self._current + size)
+        expired = []
+        for tick in range(self._current + 1, end + 1):
+            slot = self._slots[tick % size]
+            for handle in [h for h in slot if h.due <= now_tick]:
+                slot.discard(handle)
+                expired.append(handle)
+        self._count -= len(expired)
+        self._current = now_tick
+        for handle in expired:
+            self._fire(handle)
+
+    def _fire(self, handle: TimerHandle):
+        handle.cancelled = True
+        try:
+            if asyncio.iscoroutinefunction(handle.callback):
+                spawn(handle.callback(*handle.args), f"timer callback {handle.callback.__qualname__}")
+            else:
+                handle.callback(*handle.args)
+        except Exception as e:
+            print(f"[TimerWheel] Error in timer callback {handle.callback}: {e}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                self._advance(self._now_tick())
+                self._wakeup.clear()
+                if self._count == 0:
+                    await self._wakeup.wait()
+                    continue
+                delay = self._origin + self._next_due() * self.tick - loop.time()
+                try:
+                    # 新加入的定时器可能比当前等待的更早，需要提前醒来重新计算
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, delay))
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            pass
+
+
+_WHEEL: Optional[TimerWheel] = None
+
+
+def get_timer_wheel() -> TimerWheel:
+    """进程内共享的计时轮（在事件循环中使用）"""
+    global _WHEEL
+    if _WHEEL is None:
+        _WHEEL = TimerWheel()
+    return _WHEEL
@@ -8,6 +8,7 @@ sys.path.append("../")
 from typing import List, Dict, Any, Optional
 from sw_utils import build_db
 from modules.embedding import get_embedding_model
+from modules.db.BaseDB import content_id
 
 
 class StyleVectorDB:
@@ -48,6 +49,13 @@ class StyleVectorDB:
         
         # 存储发言元数据（用于Few-Shot提取）
         self.utterances: List[Dict[str, Any]] = []  # 格式：{"text": "...", "context": "...", "timestamp": ...}
+        # 文本内容ID -> 元数据（与向量库中的文档ID一致，检索结果直接按ID取元数据）
+        self.utterance_index: Dict[str, Dict[str, Any]] = {}
+
+    def _register(self, utterance_data: Dict[str, Any]):
+        self.utterances.append(utterance_data)
+        # 重复的发言保留第一次出现时的元数据
+        self.utterance_index.setdefault(content_id(utterance_data["text"]), utterance_data)
     
     def add_utterance(self, text: str, context: str = "", metadata: Optional[Dict[str, Any]] = None):
         """
@@ -72,7 +80,7 @@ class StyleVectorDB:
         }
         if metadata:
             utterance_data.update(metadata)
-        self.utterances.append(utterance_data)
+        self._register(utterance_data)
     
     def add_utterances_batch(self, utterances: List[Dict[str, str]]):
         """
@@ -85,24 +93,24 @@ class StyleVectorDB:
         for utt in utterances:
             if utt.get("text") and utt["text"].strip():
                 texts.append(utt["text"])
-                self.utterances.append({
+                self._register({
                     "text": utt["text"],
                     "context": utt.get("context", ""),
                     "timestamp": utt.get("timestamp")
                 })
         
         if texts:
-            # 批量添加到向量数据库
-            for text in texts:
-                self.db.add(text, db_name=self.db_name)
+            # 批量添加到向量数据库（一次去重、一次编码、一次写入）
+            self.db.add_batch(texts, db_name=self.db_name)
     
-    def search_similar_style(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
+    def search_similar_style(self, query: str, top_k: int = 5, query_vector=None) -> List[Dict[str, Any]]:
         """
         检索相似风格的发言
         
         Args:
             query: 查询文本（话题或场景）
             top_k: 返回最相似的k条
+            query_vector: 预先计算好的查询向量（可选）
         
         Returns:
             相似发言列表，格式：[{"text": "...", "context": "...", "score": ...}, ...]
@@ -111,20 +119,19 @@ class StyleVectorDB:
             return []
         
         # 从向量数据库检索
-        similar_texts = self.db.search(query, top_k, self.db_name)
+        similar = self.db.search_with_scores(query, top_k, self.db_name, query_vector=query_vector)
         
-        # 匹配元数据
+        # 按文档ID匹配元数据
         results = []
-        for text in similar_texts:
-            # 找到对应的元数据
-            for utt in self.utterances:
-                if utt["text"] == text:
-                    results.append({
-                        "text": utt["text"],
-                        "context": utt.get("context", ""),
-                        "score": 1.0  # 简化处理，实际可以计算相似度分数
-                    })
-                    break
+        for text, score in similar:
+            utt = self.utterance_index.get(content_id(text))
+            if utt is None:
+                continue
+            results.append({
+                "text": utt["text"],
+                "context": utt.get("context", ""),
+                "score": score
+            })
         
         return results
     
@@ -168,6 +175,7 @@ class StyleVectorDB:
     def clear(self):
         """清空数据库"""
         self.utterances = []
+        self.utterance_index = {}
         # 注意：向量数据库的清空需要根据具体实现来处理
         # 这里简化处理，实际使用时可能需要重新创建数据库
 
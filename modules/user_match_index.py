@@ -0,0 +1,487 @@
+"""
+用户之间的近似最近邻匹配索引
+每个数字孪生的检索向量由三段拼接而成：语义段（价值观/兴趣/社交目标 Embedding 的加权和）、
+Big Five 段和 MBTI 段，各段按其在匹配打分中的权重缩放，使内积近似于最终得分中的对应部分。
+向量存入本地的 IVF 倒排索引：k-means 粗聚类 + 每个簇一个倒排表，查询时只扫描最近的 nprobe 个簇。
+保存数字孪生时增量更新；召回的候选再用 calculate_advanced_compatibility 精确重排。
+
+取舍：打分中的 Big Five 是高斯核距离、MBTI 是逐轴查表，内积只能近似它们（Big Five 用中心化后的内积代替距离，
+MBTI 按各轴的得分差编码为 ±1，E/I 以互补为佳，查询向量在该轴取反）。因此召回数取 top_k 的数倍，
+最终顺序以精确重排为准；被近似误差挤出召回范围的候选会漏掉，这是用召回率换取只扫描少数簇的代价。
+"""
+import sys
+sys.path.append("../")
+import os
+import json
+import atexit
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from modules.embedding import embedding_model_key
+from modules.neural_match import (BIG_FIVE_DIMS, build_user_match_profile, embed_user_profile,
+                                  _big_five_vector, _valid_mbti)
+
+# 索引更新（含编码）在后台线程中串行执行，不阻塞保存请求
+_INDEX_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="user-match-index")
+
+# 检索向量中各语义维度的权重（与匹配打分中的权重成比例）
+KEY_WEIGHTS = {"values": 0.6, "interests": 0.2, "goals": 0.2}
+SEMANTIC_KEYS = ("interests", "values", "goals")
+# 检索向量三段在匹配打分中的权重：性格 50%（Big Five 占 0.6、MBTI 占 0.4），语义 50%
+SEGMENT_WEIGHTS = {"semantic": 0.5, "big_five": 0.3, "mbti": 0.2}
+# MBTI 各轴"匹配/不匹配"的得分差（轴权重 × 分差），E/I 为负表示互补更好
+MBTI_AXES = (-0.3 * 0.5, 0.4 * 0.7, 0.15 * 0.2, 0.15 * 0.2)
+MBTI_LETTERS = ("E", "N", "T", "J")
+PERSONALITY_DIMS = len(BIG_FIVE_DIMS) + len(MBTI_AXES)
+# 检索向量的编码方式变化时递增，旧索引在加载时丢弃并重建
+KEY_VERSION = 2
+
+# 少于该数量时不训练聚类，直接精确扫描
+TRAIN_MIN_SIZE = 2048
+# 规模比上次训练时增长到该倍数后重新训练聚类
+RETRAIN_GROWTH = 4
+# 累计多少次更新后落盘一次（退出时也会落盘）
+SAVE_EVERY = 256
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def _kmeans(data: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """球面 k-means（按内积分配，数据范数不超过 1），返回归一化的聚类中心"""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(data @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        counts = np.bincount(assignment, minlength=k)
+        empty = counts == 0
+        if empty.any():
+            # 空簇重新取随机样本
+            sums[empty] = data[rng.choice(len(data), size=int(empty.sum()), replace=False)]
+        centroids = _normalize(sums)
+    return centroids
+
+
+class UserMatchIndex:
+    """
+    数字孪生的 IVF 索引。行号（slot）分配后不移动，删除的 slot 进入空闲表复用；
+    另外保存每个用户的三个语义 Embedding 和匹配 profile，供精确重排使用。
+    """
+
+    def __init__(self, path: Optional[str] = None, nprobe: int = 8):
+        self.path = path
+        self.nprobe = nprobe
+        self.model = None
+        self.dim = 0
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()   # 串行落盘；落盘本身不持有 _lock
+        self._generation = 0
+        self._reset()
+        if path:
+            self._load()
+
+    def _reset(self, dim: int = 0):
+        self.dim = dim
+        self.user_ids: List[Optional[str]] = []
+        self.slots: Dict[str, int] = {}
+        self.profiles: List[Optional[Dict[str, Any]]] = []
+        self.free: List[int] = []
+        self.keys = np.zeros((0, dim + PERSONALITY_DIMS), dtype=np.float32)
+        self.fields = {key: np.zeros((0, dim), dtype=np.float32) for key in SEMANTIC_KEYS}
+        self.has_field = {key: np.zeros(0, dtype=bool) for key in SEMANTIC_KEYS}
+        self.centroids: Optional[np.ndarray] = None
+        self.assignment = np.zeros(0, dtype=np.int32)
+        self.lists: Dict[int, set] = {}
+        self.trained_size = 0
+        self._updates = 0
+        self._epoch = getattr(self, "_epoch", 0) + 1   # 每次重置加一，作废进行中的训练
+        self._training = False
+        self._touched: set = set()                    # 训练期间被写入的 slot，换入新中心后重新分配
+
+    def __len__(self):
+        return len(self.slots)
+
+    # --- 持久化 ---
+    def _load(self):
+        meta_path = os.path.join(self.path, "meta.json")
+        if not os.path.exists(meta_path):
+            return
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("key_version") != KEY_VERSION:
+                print("[UserMatchIndex] Index key format changed, rebuilding from users dir")
+                return
+            arrays = np.load(os.path.join(self.path, "vectors.npz"))
+            # 两个文件分别原子替换，进程在两次替换之间退出时代号不一致，丢弃后从用户目录重建
+            if "generation" not in arrays or int(arrays["generation"]) != meta.get("generation"):
+                print("[UserMatchIndex] Index files out of sync, rebuilding from users dir")
+                return
+            self._reset(meta["dim"])
+            self.model = meta["model"]
+            self.user_ids = meta["user_ids"]
+            self.profiles = meta["profiles"]
+            self.slots = {user_id: slot for slot, user_id in enumerate(self.user_ids) if user_id is not None}
+            self.free = [slot for slot, user_id in enumerate(self.user_ids) if user_id is None]
+            self._generation = meta["generation"]
+            self.keys = arrays["keys"]
+            for key in SEMANTIC_KEYS:
+                self.fields[key] = arrays[key]
+                self.has_field[key] = arrays[f"has_{key}"]
+            if "centroids" in arrays:
+                self.centroids = arrays["centroids"]
+                self.assignment = arrays["assignment"]
+                self.trained_size = meta.get("trained_size", len(self.slots))
+                self._rebuild_lists()
+        except Exception as e:
+            print(f"[UserMatchIndex] Load error: {e}")
+            self._reset()
+
+    def _snapshot(self) -> tuple:
+        """在锁内复制要落盘的状态（只复制已使用的行）"""
+        rows = len(self.user_ids)
+        self._generation += 1
+        arrays = {"keys": self.keys[:rows].copy(), "generation": np.array(self._generation)}
+        for key in SEMANTIC_KEYS:
+            arrays[key] = self.fields[key][:rows].copy()
+            arrays[f"has_{key}"] = self.has_field[key][:rows].copy()
+        if self.centroids is not None:
+            arrays["centroids"] = self.centroids
+            arrays["assignment"] = self.assignment[:rows].copy()
+        # profile 只会被整体替换，浅拷贝列表即可
+        meta = {"model": self.model, "dim": self.dim, "user_ids": list(self.user_ids),
+                "profiles": list(self.profiles), "trained_size": self.trained_size,
+                "key_version": KEY_VERSION, "generation": self._generation}
+        return arrays, meta
+
+    def save(self):
+        """在锁内复制状态，在锁外写入临时文件后原子替换，写盘期间查询和更新不受影响"""
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._updates:
+                    return
+                arrays, meta = self._snapshot()
+                self._updates = 0
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                vectors_tmp = os.path.join(self.path, "vectors.tmp.npz")
+                meta_tmp = os.path.join(self.path, "meta.tmp.json")
+                np.savez(vectors_tmp, **arrays)
+                with open(meta_tmp, "w", encoding="utf-8") as f:
+                    json.dump(meta, f, ensure_ascii=False)
+                os.replace(vectors_tmp, os.path.join(self.path, "vectors.npz"))
+                os.replace(meta_tmp, os.path.join(self.path, "meta.json"))
+            except Exception:
+                with self._lock:
+                    self._updates += 1
+                raise
+
+    # --- 写入 ---
+    @staticmethod
+    def key_vector(profile: Dict[str, Any], embeddings: Dict[str, Any], query: bool = False) -> Optional[np.ndarray]:
+        """
+        检索向量 = [√w·语义, √w·Big Five, √w·MBTI]，两个向量的内积即各段相似度按权重之和。
+        缺失的段为零向量（对应打分中缺失数据的低默认分）。query=True 时 MBTI 的 E/I 轴取反，
+        使互补的候选内积更大。没有任何语义 Embedding 时返回 None
+        """
+        parts = [KEY_WEIGHTS[key] * _normalize(np.asarray(embeddings[key], dtype=np.float32).ravel())
+                 for key in KEY_WEIGHTS if embeddings.get(key) is not None]
+        if not parts:
+            return None
+        semantic = _normalize(np.sum(parts, axis=0))
+        # Big Five 取值 0~1，中心化后缩放到单位球内
+        big_five = np.nan_to_num(_big_five_vector(profile.get("personality")) - 0.5) * (2.0 / np.sqrt(len(BIG_FIVE_DIMS)))
+        mbti = np.zeros(len(MBTI_AXES))
+        code = profile.get("mbti")
+        if _valid_mbti(code):
+            for axis, (letter, gap) in enumerate(zip(MBTI_LETTERS, MBTI_AXES)):
+                sign = 1.0 if code[axis].upper() == letter else -1.0
+                mbti[axis] = sign * np.sqrt(abs(gap)) * (np.sign(gap) if query else 1.0)
+            mbti /= np.sqrt(sum(abs(gap) for gap in MBTI_AXES))
+        return np.concatenate([np.sqrt(SEGMENT_WEIGHTS["semantic"]) * semantic,
+                               np.sqrt(SEGMENT_WEIGHTS["big_five"]) * big_five,
+                               np.sqrt(SEGMENT_WEIGHTS["mbti"]) * mbti]).astype(np.float32)
+
+    def lookup(self, user_id: str, content_hash: str, model: str) -> Optional[tuple]:
+        """索引中该用户的内容哈希与模型都一致时返回 (profile, embeddings)，否则返回 None"""
+        with self._lock:
+            slot = self.slots.get(user_id)
+            if slot is None or self.model != model or self.profiles[slot].get("content_hash") != content_hash:
+                return None
+            _, profile, embeddings = self.candidate(slot)
+            return profile, embeddings
+
+    def upsert(self, user_id: str, profile: Dict[str, Any], embeddings: Dict[str, Any], model: str):
+        """写入或更新一个用户；没有任何语义 Embedding 的用户从索引中移除"""
+        key = self.key_vector(profile, embeddings)
+        with self._lock:
+            if key is None:
+                self.remove(user_id)
+                return
+            dim = key.shape[0] - PERSONALITY_DIMS
+            if self.model != model or self.dim != dim:
+                if self.slots:
+                    print(f"[UserMatchIndex] Embedding model changed ({self.model} -> {model}), resetting index")
+                self._reset(dim)
+                self.model = model
+            slot = self.slots.get(user_id)
+            if slot is None:
+                slot = self.free.pop() if self.free else self._grow()
+                self.slots[user_id] = slot
+                self.user_ids[slot] = user_id
+            self.profiles[slot] = profile
+            self.keys[slot] = key
+            for field in SEMANTIC_KEYS:
+                present = embeddings.get(field) is not None
+                self.has_field[field][slot] = present
+                self.fields[field][slot] = np.asarray(embeddings[field], dtype=np.float32).ravel() if present else 0.0
+            self._assign(slot)
+            if self._training:
+                self._touched.add(slot)
+            self._updates += 1
+            should_train = self._should_train()
+            should_save = self._updates >= SAVE_EVERY
+        # 训练和落盘都在锁外进行
+        if should_train:
+            self.train()
+        if should_save:
+            self.save()
+
+    def remove(self, user_id: str):
+        with self._lock:
+            slot = self.slots.pop(user_id, None)
+            if slot is None:
+                return
+            self.user_ids[slot] = None
+            self.profiles[slot] = None
+            if self.centroids is not None:
+                self.lists.get(int(self.assignment[slot]), set()).discard(slot)
+            self.free.append(slot)
+            self._updates += 1
+
+    def _grow(self) -> int:
+        """追加一个 slot，底层数组按倍数扩容"""
+        slot = len(self.user_ids)
+        self.user_ids.append(None)
+        self.profiles.append(None)
+        if slot >= len(self.keys):
+            capacity = max(16, len(self.keys) * 2)
+
+            def grown(array, fill=0):
+                result = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+                result[:len(array)] = array
+                return result
+
+            self.keys = grown(self.keys)
+            for field in SEMANTIC_KEYS:
+                self.fields[field] = grown(self.fields[field])
+                self.has_field[field] = grown(self.has_field[field], False)
+            self.assignment = grown(self.assignment, -1)
+        return slot
+
+    # --- 聚类 ---
+    def _assign(self, slot: int):
+        if self.centroids is None:
+            return
+        old = int(self.assignment[slot])
+        if old >= 0:
+            self.lists.get(old, set()).discard(slot)
+        cluster = int(np.argmax(self.centroids @ self.keys[slot]))
+        self.assignment[slot] = cluster
+        self.lists.setdefault(cluster, set()).add(slot)
+
+    def _rebuild_lists(self):
+        self.lists = {}
+        for slot in self.slots.values():
+            self.lists.setdefault(int(self.assignment[slot]), set()).add(slot)
+
+    def _live_slots(self) -> np.ndarray:
+        return np.fromiter(self.slots.values(), dtype=np.int64, count=len(self.slots))
+
+    def _should_train(self) -> bool:
+        size = len(self.slots)
+        if self._training or size < TRAIN_MIN_SIZE:
+            return False
+        return self.centroids is None or size >= self.trained_size * RETRAIN_GROWTH
+
+    def train(self):
+        """
+        按当前数据重新训练聚类中心（簇数约为 sqrt(N)）并重建倒排表。
+        在锁内复制数据，k-means 和全量分配在锁外的副本上进行，再在锁内换入；
+        训练期间写入的 slot 换入后按新中心重新分配，训练期间索引被重置时结果作废
+        """
+        with self._lock:
+            slots = self._live_slots()
+            if self._training or len(slots) < TRAIN_MIN_SIZE:
+                return
+            self._training = True
+            self._touched = set()
+            epoch = self._epoch
+            data = self.keys[slots].copy()
+        try:
+            n_clusters = int(np.sqrt(len(slots)))
+            # 在样本上训练即可得到足够好的粗聚类
+            sample_size = min(len(slots), n_clusters * 64)
+            sample = data[np.random.default_rng(0).choice(len(slots), size=sample_size, replace=False)]
+            centroids = _kmeans(sample, n_clusters).astype(np.float32)
+            assignment = np.argmax(data @ centroids.T, axis=1)
+        except Exception:
+            with self._lock:
+                self._training = False
+            raise
+        with self._lock:
+            if self._epoch != epoch:
+                return
+            self._training = False
+            self.centroids = centroids
+            self.assignment[slots] = assignment
+            self.trained_size = len(slots)
+            self._rebuild_lists()
+            for slot in self._touched:
+                if self.user_ids[slot] is not None:
+                    self._assign(slot)
+            self._touched = set()
+            self._updates += 1
+        print(f"[UserMatchIndex] Trained {n_clusters} clusters over {len(slots)} twins")
+
+    # --- 查询 ---
+    def search(self, profile: Dict[str, Any], embeddings: Dict[str, Any], top_k: int,
+               exclude: Optional[str] = None) -> List[int]:
+        """返回近似最匹配的 top_k 个 slot"""
+        key = self.key_vector(profile, embeddings, query=True)
+        with self._lock:
+            if key is None or key.shape[0] != self.keys.shape[1] or not self.slots:
+                return []
+            if self.centroids is None:
+                candidates = self._live_slots()
+            else:
+                probes = np.argsort(-(self.centroids @ key))[:self.nprobe]
+                candidates = np.fromiter(
+                    (slot for cluster in probes for slot in self.lists.get(int(cluster), ())),
+                    dtype=np.int64)
+            if exclude is not None and exclude in self.slots:
+                candidates = candidates[candidates != self.slots[exclude]]
+            if len(candidates) == 0:
+                return []
+            scores = self.keys[candidates] @ key
+            if top_k < len(candidates):
+                top = np.argpartition(-scores, top_k - 1)[:top_k]
+            else:
+                top = np.arange(len(candidates))
+            return [int(candidates[i]) for i in top[np.argsort(-scores[top])]]
+
+    def candidate(self, slot: int) -> tuple:
+        """返回 (user_id, profile, embeddings)，用于精确重排"""
+        with self._lock:
+            embeddings = {field: self.fields[field][slot].copy()
+                          for field in SEMANTIC_KEYS if self.has_field[field][slot]}
+            return self.user_ids[slot], self.profiles[slot], embeddings
+
+
+def candidate_profile(user_profile: Dict[str, Any]) -> Dict[str, Any]:
+    """把用户的匹配 profile 转成 calculate_advanced_compatibility 的候选侧格式"""
+    big_five = user_profile.get("personality")
+    return {
+        "mbti": user_profile.get("mbti", ""),
+        "interests": user_profile.get("interests", []),
+        "social_goals": user_profile.get("social_goals", []),
+        "values": user_profile.get("social_goals", []),
+        "big_five": big_five if isinstance(big_five, dict) else {},
+    }
+
+
+_INDEX: Optional[UserMatchIndex] = None
+_INDEX_LOCK = threading.Lock()
+
+
+def get_user_match_index(path: str) -> UserMatchIndex:
+    global _INDEX
+    with _INDEX_LOCK:
+        if _INDEX is None:
+            _INDEX = UserMatchIndex(path)
+            atexit.register(_INDEX.save)
+        return _INDEX
+
+
+def _content_hash(stored: Dict[str, Any]) -> str:
+    payload = json.dumps(stored, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def index_user(index: UserMatchIndex, user_id: str, digital_twin: Dict[str, Any], embedding_model):
+    """
+    返回数字孪生的匹配 profile 和 Embedding。
+    索引中已有内容相同（同一模型）的条目时直接读取，只在数字孪生变化或缺失时重新编码并写入索引
+    """
+    profile = build_user_match_profile(digital_twin)
+    stored = dict(profile, name=digital_twin.get("name") or user_id)
+    content_hash = _content_hash(stored)
+    model = embedding_model_key(embedding_model)
+    cached = index.lookup(user_id, content_hash, model)
+    if cached is not None:
+        return profile, cached[1]
+    embeddings = embed_user_profile(profile, embedding_model)
+    stored["content_hash"] = content_hash
+    index.upsert(user_id, stored, embeddings, model)
+    return profile, embeddings
+
+
+def schedule_index_user(index: UserMatchIndex, user_id: str, digital_twin: Dict[str, Any], embedding_model):
+    """在后台更新索引，失败只打印日志"""
+    def task():
+        try:
+            index_user(index, user_id, digital_twin, embedding_model)
+        except Exception as e:
+            print(f"[UserMatchIndex] Failed to index {user_id}: {e}")
+    return _INDEX_EXECUTOR.submit(task)
+
+
+def build_from_users_dir(index: UserMatchIndex, users_dir: str, embedding_model):
+    """扫描 users_dir 下所有用户文件，补齐索引中缺失或模型不一致的数字孪生"""
+    from sw_utils import load_json_file
+    model = embedding_model_key(embedding_model)
+    count = 0
+    for filename in sorted(os.listdir(users_dir)):
+        if not filename.endswith(".json"):
+            continue
+        user_id = filename[:-len(".json")]
+        if index.model == model and user_id in index.slots:
+            continue
+        try:
+            digital_twin = load_json_file(os.path.join(users_dir, filename)).get("digital_twin")
+        except Exception as e:
+            print(f"[UserMatchIndex] Skip {filename}: {e}")
+            continue
+        if digital_twin:
+            index_user(index, user_id, digital_twin, embedding_model)
+            count += 1
+    index.save()
+    return count
+
+
+_BUILD_FUTURE = None
+
+
+def ensure_index_built(index: UserMatchIndex, users_dir: str, embedding_model):
+    """进程内第一次使用时在后台补齐索引（只提交一次）"""
+    global _BUILD_FUTURE
+    with _INDEX_LOCK:
+        if _BUILD_FUTURE is None:
+            def task():
+                try:
+                    count = build_from_users_dir(index, users_dir, embedding_model)
+                    print(f"[UserMatchIndex] Indexed {count} digital twins from {users_dir}")
+                except Exception as e:
+                    print(f"[UserMatchIndex] Build failed: {e}")
+            _BUILD_FUTURE = _INDEX_EXECUTOR.submit(task)
+        return _BUILD_FUTURE
@@ -0,0 +1,130 @@
+"""
+世界静态资源（按预设共享）
+世界设定、地点、地图距离、设定条目以及设定向量库在进程内只加载一次，
+由使用同一份世界文件的所有房间只读共享；各 Orchestrator 只复制会在模拟中修改的地点/距离表。
+"""
+import sys
+sys.path.append("../")
+import csv
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from sw_utils import load_json_file, build_orchestrator_data, build_db, clean_collection_name
+
+
+@dataclass(frozen=True)
+class WorldAssets:
+    """一份世界文件对应的只读资源"""
+    world_info: Dict[str, Any]
+    locations_info: Dict[str, Any]
+    locations: Tuple[str, ...]
+    edges: Dict[tuple, int]
+    world_data: Tuple[str, ...]
+    world_settings: Tuple[Dict[str, Any], ...]
+    db: Any
+    db_name: str
+
+
+def load_locations(map_file_path: str, location_file_path: str, default_distance: int = 1):
+    """
+    读取地点和距离表
+
+    Returns:
+        (locations_info, locations, edges)
+    """
+    locations_info: Dict[str, Any] = {}
+    locations: List[str] = []
+    edges: Dict[tuple, int] = {}
+
+    def add_edge(code1, code2, distance):
+        edges[(code1, code2)] = distance
+        edges[(code2, code1)] = distance
+
+    location_data = load_json_file(location_file_path)
+    valid_locations = location_data["locations"] if "locations" in location_data else location_data
+    if map_file_path and os.path.exists(map_file_path):
+        with open(map_file_path, mode='r', encoding="utf-8") as file:
+            csv_reader = csv.reader(file)
+            header = next(csv_reader)[1:]
+            for row in csv_reader:
+                # 跳过空行
+                if not row or len(row) == 0:
+                    continue
+                loc1 = row[0]
+                if not loc1 or loc1 not in valid_locations:
+                    print(f"Warning: The location {loc1} does not exist")
+                    continue
+                locations_info[loc1] = valid_locations[loc1]
+                locations.append(loc1)
+                for i, distance in enumerate(row[1:]):
+                    loc2 = header[i]
+                    if loc2 not in valid_locations:
+                        print(f"Warning: The location {loc2} does not exist")
+                        continue
+                    if distance != '0':  # Skip self-loops
+                        add_edge(loc1, loc2, int(distance))
+    else:
+        for loc1 in valid_locations:
+            locations_info[loc1] = valid_locations[loc1]
+            locations.append(loc1)
+            for loc2 in valid_locations:
+                if loc2 != loc1:
+                    add_edge(loc1, loc2, default_distance)
+    return locations_info, locations, edges
+
+
+_ASSETS: Dict[tuple, WorldAssets] = {}
+_ASSETS_LOCK = threading.Lock()
+# 每个键一把锁：不同世界可以并行加载，同一世界只加载一次
+_KEY_LOCKS: Dict[tuple, threading.Lock] = {}
+
+
+def _mtime(path: Optional[str]) -> float:
+    return os.path.getmtime(path) if path and os.path.exists(path) else 0.0
+
+
+def get_world_assets(world_file_path: str,
+                     location_file_path: str,
+                     map_file_path: Optional[str] = "",
+                     embedding_name: str = "bge-small",
+                     embedding=None,
+                     db_type: str = "chroma") -> WorldAssets:
+    """返回（必要时加载）世界资源；世界/地点/地图文件被修改后重新加载"""
+    key = (os.path.abspath(world_file_path), os.path.abspath(location_file_path),
+           os.path.abspath(map_file_path) if map_file_path else "",
+           _mtime(world_file_path), _mtime(location_file_path), _mtime(map_file_path),
+           embedding_name, id(embedding), db_type)
+    with _ASSETS_LOCK:
+        assets = _ASSETS.get(key)
+        if assets is not None:
+            return assets
+        key_lock = _KEY_LOCKS.setdefault(key, threading.Lock())
+    with key_lock:
+        with _ASSETS_LOCK:
+            assets = _ASSETS.get(key)
+        if assets is not None:
+            return assets
+        world_info = load_json_file(world_file_path)
+        locations_info, locations, edges = load_locations(map_file_path, location_file_path)
+        world_data, world_settings = build_orchestrator_data(world_file_path=world_file_path, max_words=50)
+        db_name = clean_collection_name(f"settings_{world_info['source']}_{embedding_name}")
+        db = build_db(data=list(world_data),
+                      db_name=db_name,
+                      db_type=db_type,
+                      embedding=embedding)
+        assets = WorldAssets(world_info=world_info,
+                             locations_info=locations_info,
+                             locations=tuple(locations),
+                             edges=edges,
+                             world_data=tuple(world_data),
+                             world_settings=tuple(world_settings),
+                             db=db,
+                             db_name=db_name)
+        with _ASSETS_LOCK:
+            _ASSETS[key] = assets
+            _KEY_LOCKS.pop(key, None)
+        print(f"[WorldAssets] Loaded {world_info.get('world_name', world_file_path)} "
+              f"({len(locations)} locations, {len(world_data)} settings)")
+        return assets
@@ -0,0 +1,48 @@
+"""
+预计算预设Agent的Embedding
+将整个预设目录的兴趣/价值观/社交目标文本批量编码，写入内容寻址的向量存储
+（data/preset_agents/embedding_store），服务启动后各 worker 直接内存映射读取。
+"""
+import os
+import sys
+import argparse
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.preset_agents import PresetAgents
+from modules.embedding import get_embedding_model
+from sw_utils import load_json_file
+
+
+def precompute_preset_embeddings(embedding_name: str = "bge-small",
+                                 language: str = "zh",
+                                 backend: str = None) -> int:
+    """
+    预计算所有预设Agent的Embedding
+    
+    Args:
+        embedding_name: 嵌入模型名称
+        language: 语言设置
+        backend: 本地模型的推理后端（torch / onnx）
+    
+    Returns:
+        新写入的向量数
+    """
+    embedding_model = get_embedding_model(embedding_name, language=language, backend=backend)
+    presets = PresetAgents.get_preset_templates()
+    written = PresetAgents.precompute_embeddings(embedding_model, presets)
+    print(f"预设数: {len(presets)}，新写入向量: {written}，存储中共 {len(PresetAgents.get_embedding_store())} 条")
+    return written
+
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    config = load_json_file(os.path.join(base_dir, "config.json"))
+    
+    parser = argparse.ArgumentParser(description="预计算预设Agent的Embedding")
+    parser.add_argument("--embedding", default=config.get("embedding_model_name", "bge-small"),
+                        help="嵌入模型名称（默认读取 config.json 的 embedding_model_name）")
+    parser.add_argument("--language", default="zh", help="语言设置")
+    parser.add_argument("--backend", default=None, help="本地模型的推理后端：torch 或 onnx")
+    args = parser.parse_args()
+    
+    precompute_preset_embeddings(args.embedding, args.language, args.backend)
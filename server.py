@@ -18,6 +18,11 @@ from modules.daily_report import DailyReportGenerator, generate_daily_report
 from modules.soul_api_mock import get_soul_profile
 from modules.profile_extractor import ProfileExtractor, extract_profile_from_text, extract_profile_from_qa
 from modules.preset_agents import PresetAgents
+from modules.server.scheduler import get_work_scheduler, INTERACTIVE
+from modules.embedding import embedding_stats
+from modules.neural_match import build_user_match_profile, embed_user_profile, get_match_engine, get_match_cache
+from modules.user_match_index import (get_user_match_index, schedule_index_user, ensure_index_built,
+                                     index_user, candidate_profile)
 from fastapi import UploadFile, File, Form
 import base64
 try:
@@ -63,6 +68,9 @@ PRESETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'experime
 USERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'users')
 os.makedirs(USERS_DIR, exist_ok=True)
 
+# 用户之间匹配的 ANN 索引目录
+USER_MATCH_INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'user_match_index')
+
 # 简单的用户会话存储（内存中，实际生产环境应使用数据库或Redis）
 user_sessions: dict[str, dict] = {}  # session_id -> user_data
 
@@ -135,12 +143,16 @@ async def load_preset(request: Request):
             # Note: Room class needs get_initial_data method? Or we access scrollweaver directly?
             # Let's add get_initial_data to Room or access it here.
             
+            # 只发送最近一页历史，更早的记录由客户端按游标分页拉取
+            history_page = room.scrollweaver.get_history_page(limit=config.get("history_page_size", 50))
             initial_data = {
                 'characters': room.scrollweaver.get_characters_info(),
                 'map': room.scrollweaver.get_map_info(),
                 'settings': room.scrollweaver.get_settings_info(),
-                'status': room.scrollweaver.get_current_status(),
-                'history_messages': room.scrollweaver.get_history_messages(save_dir=config.get("save_dir","")),
+                'status': room.status.snapshot()['data'],
+                'history_messages': history_page['messages'],
+                'history_cursor': history_page['cursor'],
+                'history_start': history_page['start'],
                 'room_id': room.room_id
             }
             
@@ -189,13 +201,13 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, client_id: str)
         map_info = room.scrollweaver.get_map_info()
         settings_info = room.scrollweaver.get_settings_info()
         
-        await websocket.send_json({
+        await room.send_json(client_id, {
             'type': 'initial_state',
             'data': {
                 'characters': characters_info,
                 'map': map_info,
                 'settings': settings_info,
-                'status': room.scrollweaver.get_current_status()
+                'status': room.status.snapshot()['data']
             }
         })
         
@@ -216,7 +228,7 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, client_id: str)
                     if role_code:
                         # 权限验证：确保用户只能控制自己的数字孪生
                         if not role_code.startswith('digital_twin_user_'):
-                            await websocket.send_json({
+                            await room.send_json(client_id, {
                                 'type': 'error',
                                 'data': {'message': '只能控制自己的数字孪生'}
                             })
@@ -224,7 +236,7 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, client_id: str)
                             # 权限验证通过，处理用户输入
                             await room.handle_user_role_input(client_id, role_code, text)
                     else:
-                        await websocket.send_json({
+                        await room.send_json(client_id, {
                             'type': 'error',
                             'data': {'message': '未绑定数字孪生，无法发送消息'}
                         })
@@ -275,8 +287,28 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, client_id: str)
                     if room.story_task:
                         room.story_task.cancel()
             
+            elif msg_type == 'sync_history':
+                # 重连客户端携带最后看到的游标/uuid，只返回增量
+                try:
+                    page = room.scrollweaver.get_history_page(
+                        cursor=data.get('cursor'),
+                        record_id=data.get('last_record_id'),
+                        limit=data.get('limit') or config.get("history_page_size", 50)
+                    )
+                    await room.send_json(client_id, {'type': 'history_page', 'data': page})
+                except Exception as e:
+                    print(f"Error syncing history: {e}")
+                    await room.send_json(client_id, {
+                        'type': 'error',
+                        'data': {'message': f'同步历史记录失败: {str(e)}'}
+                    })
+
+            elif msg_type == 'request_status':
+                # 客户端发现状态增量版本不连续时请求完整快照
+                await room.send_json(client_id, room.status.snapshot())
+
             elif msg_type == 'request_characters':
-                 await websocket.send_json({
+                 await room.send_json(client_id, {
                      'type': 'characters_updated',
                      'data': {'characters': room.scrollweaver.get_characters_info()}
                  })
@@ -292,7 +324,7 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, client_id: str)
                                 options = await room.generate_auto_action_options(client_id, user_role_code, num_options=3)
                                 if options and len(options) > 0:
                                     # 发送多个选项给前端
-                                    await websocket.send_json({
+                                    await room.send_json(client_id, {
                                         'type': 'auto_complete_options',
                                         'data': {
                                             'options': options,
@@ -300,7 +332,7 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, client_id: str)
                                         }
                                     })
                                 else:
-                                    await websocket.send_json({
+                                    await room.send_json(client_id, {
                                         'type': 'error',
                                         'data': {'message': 'AI生成行动失败，请重试'}
                                     })
@@ -308,22 +340,22 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, client_id: str)
                                 print(f"Error generating auto action options: {e}")
                                 import traceback
                                 traceback.print_exc()
-                                await websocket.send_json({
+                                await room.send_json(client_id, {
                                     'type': 'error',
                                     'data': {'message': f'生成行动时出错: {str(e)}'}
                                 })
                         else:
-                            await websocket.send_json({
+                            await room.send_json(client_id, {
                                 'type': 'error',
                                 'data': {'message': '输入已完成，无法生成建议'}
                             })
                     else:
-                        await websocket.send_json({
+                        await room.send_json(client_id, {
                             'type': 'error',
                             'data': {'message': '未选择角色或不在等待输入状态'}
                         })
                 else:
-                    await websocket.send_json({
+                    await room.send_json(client_id, {
                         'type': 'error',
                         'data': {'message': '当前不在等待输入状态'}
                     })
@@ -361,27 +393,27 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, client_id: str)
                                     }
                                 })
                                 
-                                await websocket.send_json({
+                                await room.send_json(client_id, {
                                     'type': 'auto_complete_success',
                                     'data': {'message': '已选择AI生成的行动'}
                                 })
                             else:
-                                await websocket.send_json({
+                                await room.send_json(client_id, {
                                     'type': 'error',
                                     'data': {'message': '无效的选项'}
                                 })
                         else:
-                            await websocket.send_json({
+                            await room.send_json(client_id, {
                                 'type': 'error',
                                 'data': {'message': '输入已完成，无法选择建议'}
                             })
                     else:
-                        await websocket.send_json({
+                        await room.send_json(client_id, {
                             'type': 'error',
                             'data': {'message': '未选择角色或不在等待输入状态'}
                         })
                 else:
-                    await websocket.send_json({
+                    await room.send_json(client_id, {
                         'type': 'error',
                         'data': {'message': '当前不在等待输入状态'}
                     })
@@ -912,9 +944,9 @@ async def generate_digital_twin_profile(request: Request):
         model_name = config.get("role_llm_name", "gpt-3.5-turbo")
         llm = get_models(model_name)
         
-        # Async call to prevent blocking server
-        loop = asyncio.get_running_loop()
-        response = await loop.run_in_executor(None, llm.chat, prompt)
+        # Async call to prevent blocking server（按用户排队，与房间任务共享调度器）
+        requester = get_user_id_from_session(request) or "anonymous"
+        response = await get_work_scheduler().run(f"user:{requester}", INTERACTIVE, llm.chat, prompt)
         
         # 5. 解析响应
         try:
@@ -981,6 +1013,14 @@ async def save_digital_twin(request: Request):
         with open(user_file, 'w', encoding='utf-8') as f:
             json.dump(user_data, f, ensure_ascii=False, indent=2)
         
+        # 在后台更新用户匹配索引，并预计算新数字孪生的匹配结果
+        try:
+            schedule_index_user(get_user_match_index(USER_MATCH_INDEX_DIR), user_id, agent_info,
+                                get_match_embedding_model())
+            schedule_neural_matches(user_id, agent_info, get_twin_version(user_file))
+        except Exception as e:
+            print(f"Error scheduling match updates: {e}")
+        
         return {
             "success": True,
             "message": "数字孪生已保存",
@@ -1303,6 +1343,8 @@ async def restore_user_agent(request: Request):
         
         # 记录用户 Agent 映射
         room.user_agents[user_id] = role_code
+        # 唤醒等待角色的故事循环
+        room.notify()
         
         # 注意：不需要重置generator_initialized，新agent会在下一个轮次自然参与
         
@@ -1392,6 +1434,41 @@ async def check_room_exists(room_id: str):
         traceback.print_exc()
         return {"success": False, "exists": False, "message": str(e)}
 
+@app.get("/api/scheduler-stats")
+async def scheduler_stats():
+    """阻塞任务调度器的队列深度与排队等待时间"""
+    return {"success": True, "data": get_work_scheduler().stats()}
+
+@app.get("/api/embedding-stats")
+async def embedding_cache_stats():
+    """向量缓存命中率与各模型微批处理器的批次统计"""
+    return {"success": True, "data": embedding_stats()}
+
+@app.get("/api/memory-stats")
+async def memory_stats(room_id: str = None):
+    """房间内各角色记忆的淘汰与合并计数"""
+    room = room_manager.get_room(room_id) if room_id else None
+    if not room:
+        room = room_manager.get_or_create_default_room()
+    return {"success": True, "data": room.scrollweaver.get_memory_stats()}
+
+@app.get("/api/history")
+async def get_history(room_id: str, cursor: Optional[int] = None, last_record_id: Optional[str] = None, limit: Optional[int] = None):
+    """按游标分页获取房间历史消息（重连增量同步）"""
+    room = room_manager.get_room(room_id)
+    if not room:
+        raise HTTPException(status_code=404, detail="Room does not exist")
+    try:
+        page = room.scrollweaver.get_history_page(
+            cursor=cursor,
+            record_id=last_record_id,
+            limit=limit or config.get("history_page_size", 50)
+        )
+        return {"success": True, **page}
+    except Exception as e:
+        print(f"Error getting history: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/api/characters")
 async def get_characters(request: Request, room_id: str = None):
     """获取房间中的agents列表"""
@@ -1518,6 +1595,7 @@ async def add_preset_npc(request: Request):
             preset_id=preset_id,
             initial_location="location_lounge" # 默认位置
         )
+        room.notify()
         
         # 强制更新一次状态
         characters_info = room.scrollweaver.get_characters_info()
@@ -1566,6 +1644,82 @@ async def add_preset_npc(request: Request):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def get_match_embedding_model():
+    """匹配计算使用默认房间的 Embedding 模型"""
+    default_room = room_manager.get_or_create_default_room()
+    return default_room.scrollweaver.server.embedding
+
+def get_twin_version(user_file: str):
+    """数字孪生版本：用户文件的修改时间和大小（保存数字孪生时都会改写该文件）"""
+    stat = os.stat(user_file)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def compute_neural_matches(digital_twin: dict, embedding_model, engine) -> dict:
+    """计算用户与所有预设 agents 的匹配（确定性部分），随机遭遇只保存候选池"""
+    # 构建用户 agent 的 profile（用于匹配计算）
+    user_profile = build_user_match_profile(digital_twin)
+    
+    # 调试输出：用户profile
+    print(f"\n========== Neural Matching Debug ==========")
+    print(f"User Profile:")
+    print(f"  MBTI: {user_profile.get('mbti')}")
+    print(f"  Big Five: {user_profile.get('personality')}")
+    print(f"  Interests: {user_profile.get('interests')[:3] if user_profile.get('interests') else 'None'}...")
+    print(f"  Values: {user_profile.get('social_goals')[:3] if user_profile.get('social_goals') else 'None'}...")
+    print(f"==========================================\n")
+    
+    # 预计算用户Embedding（一次批量编码）
+    user_embeddings = embed_user_profile(user_profile, embedding_model)
+    
+    # 所有预设 agents 的特征已堆叠为矩阵，一次向量化打分
+    scores = engine.score(user_profile, user_embeddings)
+    match_percent = scores.match_percent()
+    
+    def to_match(row):
+        preset = engine.presets[row]
+        return {
+            "id": preset.get('id'),
+            "name": preset.get('name'),
+            "role": preset.get('description', ''),
+            "match": int(match_percent[row]),
+            "match_breakdown": scores.breakdown(row),  # 添加详细breakdown
+            "avatar": get_avatar_color(preset.get('id')),
+            "status": "online",
+            "preset": preset
+        }
+    
+    # 按匹配度排序：只需完整排出前 5（调试输出）和后半部分的随机池
+    top_rows = engine.rank(match_percent, k=5)
+    
+    # 调试输出：排序后的结果
+    print(f"\n========== Sorted Matches ==========")
+    for i, row in enumerate(top_rows, 1):
+        print(f"{i}. {engine.presets[row].get('name'):15s} | {int(match_percent[row])}%")
+    print(f"====================================\n")
+    
+    # 随机遭遇的候选池（从匹配度较低的agents中选择，增加多样性）
+    remaining_count = max(0, len(engine) - 3)
+    if remaining_count >= 4:
+        # 如果剩余agents足够多，从后半部分（低匹配度）中随机选择
+        random_rows = sorted(engine.rank_tail(match_percent, 3 + remaining_count // 2).tolist())
+    else:
+        # agents不够多，就从所有剩余中随机选
+        random_rows = sorted(engine.rank_tail(match_percent, 3).tolist())
+    
+    return {
+        "matched_twins": [to_match(row) for row in top_rows[:3]],
+        "random_pool": [to_match(row) for row in random_rows],
+        "random_count": min(2, len(random_rows))
+    }
+
+def schedule_neural_matches(user_id: str, digital_twin: dict, twin_version):
+    """在后台（重新）计算用户的匹配结果并写入缓存"""
+    embedding_model = get_match_embedding_model()
+    engine = get_match_engine(embedding_model)
+    return get_match_cache().schedule(
+        user_id, twin_version, engine.version,
+        lambda: compute_neural_matches(digital_twin, embedding_model, engine))
+
 @app.post("/api/neural-match")
 async def neural_match(request: Request):
     """神经元匹配：计算用户数字孪生与预设 agents 的匹配度"""
@@ -1579,144 +1733,93 @@ async def neural_match(request: Request):
         if not os.path.exists(user_file):
             raise HTTPException(status_code=404, detail="用户尚未创建数字孪生")
         
-        user_data = load_json_file(user_file)
-        digital_twin = user_data.get('digital_twin')
+        # 结果按 (数字孪生版本, 预设目录版本) 缓存，命中时只需随机抽取遭遇
+        twin_version = get_twin_version(user_file)
+        engine = get_match_engine(get_match_embedding_model())
+        result = get_match_cache().get(user_id, twin_version, engine.version)
+        if result is None:
+            user_data = load_json_file(user_file)
+            digital_twin = user_data.get('digital_twin')
+            if not digital_twin:
+                raise HTTPException(status_code=404, detail="用户尚未创建数字孪生")
+            result = await asyncio.wrap_future(schedule_neural_matches(user_id, digital_twin, twin_version))
+        
+        # 2 个随机遭遇（真正的"偶然遭遇"，不是高匹配）
+        import random
+        random_encounters = random.sample(result["random_pool"], result["random_count"])
+        
+        return {
+            "success": True,
+            "matched_twins": result["matched_twins"],
+            "random_twins": random_encounters
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error in neural_match: {e}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/user-match")
+async def user_match(request: Request):
+    """用户之间的匹配：ANN 索引召回其他用户的数字孪生，再精确重排"""
+    try:
+        user_id = get_user_id_from_session(request)
+        if not user_id:
+            raise HTTPException(status_code=401, detail="未登录")
+        
+        try:
+            data = await request.json()
+        except Exception:
+            data = {}
+        top_k = max(1, min(int(data.get('top_k', 5)), 50))
+        
+        user_file = os.path.join(USERS_DIR, f"{user_id}.json")
+        if not os.path.exists(user_file):
+            raise HTTPException(status_code=404, detail="用户尚未创建数字孪生")
+        digital_twin = load_json_file(user_file).get('digital_twin')
         if not digital_twin:
             raise HTTPException(status_code=404, detail="用户尚未创建数字孪生")
         
-        # 获取所有预设 agents
-        preset_templates = PresetAgents.get_preset_templates()
-        
-        # 构建用户 agent 的 profile（用于匹配计算）
-        # 优先使用 personality 字段 (新版结构)
-        personality = digital_twin.get('personality', {})
-        generated_traits = digital_twin.get('generated_profile', {}).get('core_traits', {})
-        extracted_profile = digital_twin.get('extracted_profile', {})
+        embedding_model = get_match_embedding_model()
+        index = get_user_match_index(USER_MATCH_INDEX_DIR)
+        # 首次使用时在后台从用户目录补齐索引
+        ensure_index_built(index, USERS_DIR, embedding_model)
         
-        user_profile = {
-            "mbti": personality.get('mbti') or generated_traits.get('mbti') or extracted_profile.get('mbti', ''),
-            "interests": extracted_profile.get('interests', []) or personality.get('values', []) or generated_traits.get('values', []),
-            "social_goals": extracted_profile.get('social_goals', []) or personality.get('values', []) or generated_traits.get('values', []),
-            "personality": personality.get('big_five') or generated_traits.get('big_five') or extracted_profile.get('personality', '')
-        }
+        # 数字孪生未变化时直接读取索引中的条目，只有内容变化（或尚未入索引）时才重新编码
+        user_profile, user_embeddings = await get_work_scheduler().run(
+            f"user:{user_id}", INTERACTIVE, index_user, index, user_id, digital_twin, embedding_model)
         
-        # 计算匹配度
+        # 检索向量只是最终得分的近似，召回数倍于 top_k 的候选，再用完整的匹配算法精确重排
+        slots = index.search(user_profile, user_embeddings, top_k=max(top_k * 10, 50), exclude=user_id)
         matches = []
-        
-        # 调试输出：用户profile
-        print(f"\n========== Neural Matching Debug ==========")
-        print(f"User Profile:")
-        print(f"  MBTI: {user_profile.get('mbti')}")
-        print(f"  Big Five: {user_profile.get('personality')}")
-        print(f"  Interests: {user_profile.get('interests')[:3] if user_profile.get('interests') else 'None'}...")
-        print(f"  Values: {user_profile.get('social_goals')[:3] if user_profile.get('social_goals') else 'None'}...")
-        print(f"==========================================\n")
-        
-        # 预计算用户Embedding（避免重复计算）
-        user_embeddings = {}
-        # Use default room for embedding model access
-        default_room = room_manager.get_or_create_default_room()
-        embedding_model = default_room.scrollweaver.server.embedding
-        
-        if embedding_model:
-            try:
-                # 准备用户文本数据
-                user_interests_text = " ".join(user_profile.get("interests", []))
-                user_values_text = " ".join(user_profile.get("social_goals", [])) # Values usually in social_goals or values
-                user_goals_text = " ".join(user_profile.get("social_goals", []))
-                
-                # 批量生成Embedding
-                texts_to_embed = [t for t in [user_interests_text, user_values_text, user_goals_text] if t]
-                if texts_to_embed:
-                    embeddings = embedding_model(texts_to_embed)
-                    idx = 0
-                    if user_interests_text:
-                        user_embeddings["interests"] = embeddings[idx]
-                        idx += 1
-                    if user_values_text:
-                        user_embeddings["values"] = embeddings[idx]
-                        idx += 1
-                    if user_goals_text:
-                        user_embeddings["goals"] = embeddings[idx]
-                        idx += 1
-            except Exception as e:
-                print(f"Error generating user embeddings: {e}")
-
-        for preset in preset_templates:
-            preset_profile = {
-                "interests": preset.get('interests', []),
-                "mbti": preset.get('mbti', ''),
-                "social_goals": preset.get('social_goals', []),
-                "personality": preset.get('personality', ''),
-                "big_five": preset.get('big_five', {}),
-                "values": preset.get('values', [])
-            }
-            
-            # 使用高级匹配算法
-            # 获取预设Agent的Embedding (带缓存)
-            preset_embeddings = PresetAgents.get_preset_embeddings(preset, embedding_model)
-            
-            compatibility_result = calculate_advanced_compatibility(user_profile, preset_profile, user_embeddings, preset_embeddings)
-            compatibility = compatibility_result['score']
-            breakdown = compatibility_result['breakdown']
-            
-            # 调试输出：每个preset的匹配度
-            # print(f"[Match] {preset.get('name'):15s} | MBTI: {preset.get('mbti'):4s} | Score: {compatibility*100:5.1f}%")
-            # print(f"  Breakdown: {breakdown}")
-            
-            # 获取预设 agent 的动漫化图片（如果有）
-            anime_images = None
-            # 注意：预设 agents 可能没有动漫化图片，只有用户数字孪生才有
-            
+        for slot in slots:
+            other_id, other_profile, other_embeddings = index.candidate(slot)
+            if other_id is None or other_profile is None:
+                continue
+            result = calculate_advanced_compatibility(
+                user_profile, candidate_profile(other_profile), user_embeddings, other_embeddings)
             matches.append({
-                "id": preset.get('id'),
-                "name": preset.get('name'),
-                "role": preset.get('description', ''),
-                "match": round(compatibility * 100),
-                "match_breakdown": breakdown,  # 添加详细breakdown
-                "avatar": get_avatar_color(preset.get('id')),
-                "status": "online",
-                "preset": preset
+                "user_id": other_id,
+                "name": other_profile.get('name', other_id),
+                "mbti": other_profile.get('mbti', ''),
+                "match": round(result['score'] * 100),
+                "match_breakdown": result['breakdown'],
+                "avatar": get_avatar_color(other_id),
+                "status": "online"
             })
-        
-        # 按匹配度排序
         matches.sort(key=lambda x: x['match'], reverse=True)
         
-        # 调试输出：排序后的结果
-        print(f"\n========== Sorted Matches ==========")
-        for i, match in enumerate(matches[:5], 1):
-            print(f"{i}. {match['name']:15s} | {match['match']}%")
-        print(f"====================================\n")
-        
-        # Top 3 完美共鸣
-        top_matches = matches[:3]
-        
-        # 2 个随机遭遇（从匹配度较低的agents中选择，增加多样性）
-        import random
-        # 从后50%的agents中随机选择（真正的"偶然遭遇"，不是高匹配）
-        all_remaining = matches[3:]
-        if len(all_remaining) >= 4:
-            # 如果剩余agents足够多，从后半部分（低匹配度）中随机选择
-            lower_half_start = len(all_remaining) // 2
-            random_pool = all_remaining[lower_half_start:]
-            random_encounters = random.sample(random_pool, min(2, len(random_pool)))
-        elif len(all_remaining) >= 2:
-            # agents不够多，就从所有剩余中随机选
-            random_encounters = random.sample(all_remaining, 2)
-        elif len(all_remaining) == 1:
-            random_encounters = all_remaining
-        else:
-            random_encounters = []
-        
         return {
             "success": True,
-            "matched_twins": top_matches,
-            "random_twins": random_encounters
+            "matched_users": matches[:top_k],
+            "indexed_users": len(index)
         }
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error in neural_match: {e}")
+        print(f"Error in user_match: {e}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
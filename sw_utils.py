@@ -129,13 +129,18 @@ def build_orchestrator_data(world_file_path,max_words = 30):
     return data,settings
 
 def build_db(data, db_name, db_type, embedding, save_type="persistent"):
-    if not data or not db_name:
+    """
+    db_type: "numpy"（进程内 float32 矩阵，可选 faiss）或 "chroma"（默认）
+    """
+    if not db_name:
         return None
-    if True:
+    if db_type in ("numpy", "faiss"):
+        from modules.db.NumpyDB import NumpyDB
+        db = NumpyDB(embedding,save_type)
+    else:
         from modules.db.ChromaDB import ChromaDB
         db = ChromaDB(embedding,save_type)
-        db_name = db_name
-        db.init_from_data(data,db_name)
+    db.init_from_data(data,db_name)
     return db
 
 def get_root_dir():
@@ -149,6 +154,9 @@ def create_dir(dirname):
 
 def get_logger(experiment_name):
     logger = logging.getLogger(experiment_name)
+    # 同一实验（多个房间）共用一个文件 handler，避免重复创建文件和重复写日志
+    if any(isinstance(handler, logging.FileHandler) for handler in logger.handlers):
+        return logger
     logger.setLevel(logging.INFO)
     current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     create_dir(f"{get_root_dir()}/log/{experiment_name}")